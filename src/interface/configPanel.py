@@ -173,6 +173,10 @@ class ConfigPanel(panel.Panel):
     
     self.valsLock.acquire()
     if ordering: self.sortOrdering = ordering
+    
+    # sorting by value queries every option, so fetch them in a single GETCONF
+    if FIELD_VALUE in self.sortOrdering: self._prefetchValues(self.confContents)
+    
     self.confContents.sort(key=lambda i: (i.getAttr(self.sortOrdering)))
     self.valsLock.release()
   
@@ -221,9 +225,13 @@ class ConfigPanel(panel.Panel):
     valueWidth = self._config["features.config.state.colWidth.value"]
     descriptionWidth = max(0, width - scrollOffset - optionWidth - valueWidth - 2)
     
+    visibleEntries = self.confContents[scrollLoc:scrollLoc + height - detailPanelHeight - 1]
+    self._prefetchValues(visibleEntries)
+    
     for lineNum in range(scrollLoc, len(self.confContents)):
       entry = self.confContents[lineNum]
       drawLine = lineNum + detailPanelHeight + 1 - scrollLoc
+      if drawLine >= height: break
       
       optionLabel = uiTools.cropStr(entry.get(FIELD_OPTION), optionWidth)
       valueLabel = uiTools.cropStr(entry.get(FIELD_VALUE), valueWidth)
@@ -243,6 +251,19 @@ class ConfigPanel(panel.Panel):
     
     self.valsLock.release()
   
+  def _prefetchValues(self, entries):
+    """
+    Populates the torTools cache with the values of the given entries via a
+    single GETCONF, so their following lookups don't each need a round trip.
+    
+    Arguments:
+      entries - ConfigEntry instances whose values are about to be fetched
+    """
+    
+    if self.configType == TOR_STATE and entries:
+      options = [entry.get(FIELD_OPTION) for entry in entries]
+      torTools.getConn().getOptionMany(options, [], True)
+  
   def _drawSelectionPanel(self, cursorSelection, width, detailPanelHeight, titleLabel):
     """
     Renders a panel for the selected configuration option.
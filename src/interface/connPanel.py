@@ -2,13 +2,17 @@
 # connPanel.py -- Lists network connections used by tor.
 # Released under the GPL v3 (http://www.gnu.org/licenses/gpl.html)
 
+import os
+import re
+import csv
 import time
 import socket
+import struct
 import curses
 from threading import RLock
 from TorCtl import TorCtl
 
-from util import log, connections, hostnames, panel, torTools, uiTools
+from util import log, connections, connHistory, geoip, hostnames, panel, torTools, uiTools
 
 # Scrubs private data from any connection that might belong to client or exit
 # traffic. This is a little overly conservative, hiding anything that isn't
@@ -31,11 +35,34 @@ DIR_SERVERS = [("86.59.21.38", "80"),         # tor26
                ("193.23.244.244", "80"),      # dannenberg
                ("208.83.223.34", "443"),      # urras
                ("82.94.251.203", "80")]       # Tonga
+DIR_SERVER_SET = set(DIR_SERVERS)
+
+# private address ranges (RFC 1918), as (network, netmask) integer tuples
+PRIVATE_NETWORKS = ((0x0A000000, 0xFF000000),  # 10.0.0.0/8
+                    (0xAC100000, 0xFFF00000),  # 172.16.0.0/12
+                    (0xC0A80000, 0xFFFF0000))  # 192.168.0.0/16
+
+# addresses covered by the 'private' keyword of exit policies
+POLICY_PRIVATE_NETWORKS = PRIVATE_NETWORKS + ((0x00000000, 0xFF000000),  # 0.0.0.0/8
+                                              (0x7F000000, 0xFF000000),  # 127.0.0.0/8
+                                              (0xA9FE0000, 0xFFFF0000))  # 169.254.0.0/16
+
+# maximum number of (address, port) exit policy decisions that are memoized
+EXIT_POLICY_CACHE_SIZE = 5000
 
 # enums for listing types
 LIST_IP, LIST_HOSTNAME, LIST_FINGERPRINT, LIST_NICKNAME = range(4)
 LIST_LABEL = {LIST_IP: "IP Address", LIST_HOSTNAME: "Hostname", LIST_FINGERPRINT: "Fingerprint", LIST_NICKNAME: "Nickname"}
 
+# formats connections can be exported as, and the fields of each record
+EXPORT_CSV, EXPORT_JSON = range(2)
+EXPORT_FIELDS = ("type", "localAddress", "localPort", "foreignAddress", "foreignPort", "country", "fingerprint", "nickname", "age")
+JSON_ESCAPED_CHARS = re.compile("[\x00-\x1f\x7f-\xff\"\\\\]")
+
+# enums for attributes connections can be aggregated by
+GROUP_NONE, GROUP_COUNTRY, GROUP_PORT, GROUP_FAMILY, GROUP_PREFIX = range(5)
+GROUP_LABEL = {GROUP_NONE: "None", GROUP_COUNTRY: "Country", GROUP_PORT: "Foreign Port", GROUP_FAMILY: "Relay Family", GROUP_PREFIX: "/16 Prefix"}
+
 # attributes for connection types
 TYPE_COLORS = {"inbound": "green", "outbound": "blue", "client": "cyan", "directory": "magenta", "control": "red", "family": "magenta", "localhost": "yellow"}
 TYPE_WEIGHTS = {"inbound": 0, "outbound": 1, "client": 2, "directory": 3, "control": 4, "family": 5, "localhost": 6} # defines ordering
@@ -47,23 +74,25 @@ CONN_TYPE, CONN_L_IP, CONN_L_PORT, CONN_F_IP, CONN_F_PORT, CONN_COUNTRY, CONN_TI
 CONN_COUNT_LABELS = ["inbound", "outbound", "client", "directory", "control"]
 
 # enums for sorting types (note: ordering corresponds to SORT_TYPES for easy lookup)
-# TODO: add ORD_BANDWIDTH -> (ORD_BANDWIDTH, "Bandwidth", lambda x, y: ???)
+# the functions provide the sort key of a connection entry, listing sorts
+# depend on the panel's listing type so they're handled by the panel
+# TODO: add ORD_BANDWIDTH -> (ORD_BANDWIDTH, "Bandwidth", lambda x: ???)
 ORD_TYPE, ORD_FOREIGN_LISTING, ORD_SRC_LISTING, ORD_DST_LISTING, ORD_COUNTRY, ORD_FOREIGN_PORT, ORD_SRC_PORT, ORD_DST_PORT, ORD_TIME = range(9)
 SORT_TYPES = [(ORD_TYPE, "Connection Type",
-                lambda x, y: TYPE_WEIGHTS[x[CONN_TYPE]] - TYPE_WEIGHTS[y[CONN_TYPE]]),
+                lambda x: TYPE_WEIGHTS[x[CONN_TYPE]]),
               (ORD_FOREIGN_LISTING, "Listing (Foreign)", None),
               (ORD_SRC_LISTING, "Listing (Source)", None),
               (ORD_DST_LISTING, "Listing (Dest.)", None),
               (ORD_COUNTRY, "Country Code",
-                lambda x, y: cmp(x[CONN_COUNTRY], y[CONN_COUNTRY])),
+                lambda x: x[CONN_COUNTRY]),
               (ORD_FOREIGN_PORT, "Port (Foreign)",
-                lambda x, y: int(x[CONN_F_PORT]) - int(y[CONN_F_PORT])),
+                lambda x: int(x[CONN_F_PORT])),
               (ORD_SRC_PORT, "Port (Source)",
-                lambda x, y: int(x[CONN_F_PORT] if x[CONN_TYPE] == "inbound" else x[CONN_L_PORT]) - int(y[CONN_F_PORT] if y[CONN_TYPE] == "inbound" else y[CONN_L_PORT])),
+                lambda x: int(x[CONN_F_PORT] if x[CONN_TYPE] == "inbound" else x[CONN_L_PORT])),
               (ORD_DST_PORT, "Port (Dest.)",
-                lambda x, y: int(x[CONN_L_PORT] if x[CONN_TYPE] == "inbound" else x[CONN_F_PORT]) - int(y[CONN_L_PORT] if y[CONN_TYPE] == "inbound" else y[CONN_F_PORT])),
+                lambda x: int(x[CONN_L_PORT] if x[CONN_TYPE] == "inbound" else x[CONN_F_PORT])),
               (ORD_TIME, "Connection Time",
-                lambda x, y: cmp(-x[CONN_TIME], -y[CONN_TIME]))]
+                lambda x: -x[CONN_TIME])]
 
 # provides bi-directional mapping of sorts with their associated labels
 def getSortLabel(sortType, withColor = False):
@@ -105,6 +134,208 @@ def getSortType(sortLabel):
     if sortLabel == label: return type
   raise ValueError(sortLabel)
 
+class ConnClassifier:
+  """
+  Lookups for categorizing tor's connections, built from our configuration and
+  client circuits (and remade when either changes) so classifying each
+  connection is a handful of hash lookups.
+  """
+  
+  def __init__(self, listenPort, dirPort, socksPort, controlPort, clientRelays):
+    """
+    Creates a classifier for the given configuration.
+    
+    Arguments:
+      listenPort   - port for inbound relay connections
+      dirPort      - port for inbound directory connections
+      socksPort    - port for client applications
+      controlPort  - port for controllers
+      clientRelays - first hops of our circuits, either nicknames or
+                     "$fingerprint" entries (optionally followed by "~nickname"
+                     or "=nickname")
+    """
+    
+    self.inboundPorts = set((listenPort, dirPort))
+    self.socksPort = socksPort
+    self.controlPort = controlPort
+    self.clientNicknames = set()
+    self.clientFingerprints = set()
+    
+    for clientRelay in clientRelays:
+      if clientRelay.startswith("$"):
+        self.clientFingerprints.add(clientRelay[1:].replace("=", "~").split("~")[0])
+      else: self.clientNicknames.add(clientRelay)
+  
+  def getType(self, lPort, fIp, fPort, fingerprint):
+    """
+    Provides the type of a connection ("inbound", "client", "control",
+    "directory", or "outbound").
+    
+    Arguments:
+      lPort       - local port of the connection
+      fIp         - foreign address of the connection
+      fPort       - foreign port of the connection
+      fingerprint - fingerprint of the foreign relay, "UNKNOWN" if not a relay
+    """
+    
+    if lPort in self.inboundPorts: return "inbound"
+    elif lPort == self.socksPort: return "client"
+    elif lPort == self.controlPort: return "control"
+    elif self.isClientRelay(fingerprint): return "client"
+    elif (fIp, fPort) in DIR_SERVER_SET: return "directory"
+    else: return "outbound"
+  
+  def isClientRelay(self, fingerprint):
+    """
+    True if the relay is the first hop of one of our circuits, false otherwise.
+    
+    Arguments:
+      fingerprint - relay fingerprint
+    """
+    
+    if fingerprint in self.clientFingerprints: return True
+    elif self.clientNicknames and fingerprint != "UNKNOWN":
+      relayRecord = torTools.getConn().getRelay(fingerprint)
+      return relayRecord != None and relayRecord[torTools.RELAY_NICKNAME] in self.clientNicknames
+    else: return False
+
+class ConnSnapshot:
+  """
+  Listing of tor's connections at a point in time. Snapshots aren't modified
+  once made, so they can be shared without copying (for instance, pausing
+  just keeps a reference to the snapshot being shown).
+  """
+  
+  def __init__(self, connections = (), connectionCount = (0,) * 5, familyResolutions = None, sortKeys = None, groups = None):
+    """
+    Creates a snapshot with the given contents.
+    
+    Arguments:
+      connections       - connection entries, tuples of the form:
+                          (type, local IP, local port, foreign IP, foreign port,
+                          country code, connection time, isPrivate)
+      connectionCount   - counts of inbound, outbound, client, directory, and
+                          control connections
+      familyResolutions - mapping of family entries' (ip, port) to their
+                          fingerprint
+      sortKeys          - sort keys of the connections if they've been sorted
+      groups            - aggregated listing from ConnAggregate.getGroups(),
+                          None if connections aren't being grouped
+    """
+    
+    self.connections = tuple(connections)
+    self.connectionCount = tuple(connectionCount)
+    self.familyResolutions = familyResolutions or {}
+    self.sortKeys = sortKeys
+    self.groups = groups
+    
+    # mapping of connection entries to their position, made when first needed
+    self._positions = None
+  
+  def getPosition(self, entry):
+    """
+    Provides the position of the given entry in our connections, None if it
+    isn't present.
+    
+    Arguments:
+      entry - connection entry to be looked up
+    """
+    
+    positions = self._positions
+    if positions == None:
+      # reversed so duplicate entries resolve to their first position
+      positions = {}
+      for i in range(len(self.connections) - 1, -1, -1):
+        positions[self.connections[i]] = i
+      
+      self._positions = positions
+    
+    return positions.get(entry)
+
+class ConnAggregate:
+  """
+  Counts of each connection type for groups of connections (by country, port,
+  etc). These are adjusted as connections are added and removed rather than
+  recomputed from the listing.
+  """
+  
+  def __init__(self, groupBy):
+    """
+    Creates an empty aggregate.
+    
+    Arguments:
+      groupBy - attribute connections are grouped by (GROUP_* enum)
+    """
+    
+    self.groupBy = groupBy
+    self._groups = {}   # group label => [count of each connection type]
+    self._members = {}  # (ip, port) => (group label, type index, entry)
+  
+  def hasMember(self, connKey, typeIndex):
+    """
+    Checks if the given connection has been added with this type.
+    
+    Arguments:
+      connKey   - (foreign ip, foreign port) tuple of the connection
+      typeIndex - index of the connection's type in CONN_COUNT_LABELS
+    """
+    
+    return self._members.get(connKey, (None, None, None))[1] == typeIndex
+  
+  def getMembers(self, connKeys = None):
+    """
+    Provides the connection entries that have been added, either for the
+    given connections or all of them if None.
+    
+    Arguments:
+      connKeys - (foreign ip, foreign port) tuples of the connections
+    """
+    
+    if connKeys == None: return [member[2] for member in self._members.values()]
+    else: return [self._members[connKey][2] for connKey in connKeys if connKey in self._members]
+  
+  def add(self, connKey, typeIndex, groupLabel, entry):
+    """
+    Adds a connection to the given group, replacing any prior membership.
+    
+    Arguments:
+      connKey    - (foreign ip, foreign port) tuple of the connection
+      typeIndex  - index of the connection's type in CONN_COUNT_LABELS
+      groupLabel - group the connection belongs to
+      entry      - connection entry, kept so its group can be recomputed
+    """
+    
+    self.remove(connKey)
+    
+    if not groupLabel in self._groups: self._groups[groupLabel] = [0] * len(CONN_COUNT_LABELS)
+    self._groups[groupLabel][typeIndex] += 1
+    self._members[connKey] = (groupLabel, typeIndex, entry)
+  
+  def remove(self, connKey):
+    """
+    Drops a connection, doing nothing if it isn't a member.
+    
+    Arguments:
+      connKey - (foreign ip, foreign port) tuple of the connection
+    """
+    
+    if not connKey in self._members: return
+    groupLabel, typeIndex = self._members.pop(connKey)[:2]
+    
+    groupCounts = self._groups[groupLabel]
+    groupCounts[typeIndex] -= 1
+    if not sum(groupCounts): del self._groups[groupLabel]
+  
+  def getGroups(self):
+    """
+    Provides a tuple of (group label, total, type counts) entries, ordered by
+    their total (largest first).
+    """
+    
+    groups = [(label, sum(counts), tuple(counts)) for label, counts in self._groups.items()]
+    groups.sort(key = lambda x: (-x[1], x[0]))
+    return tuple(groups)
+
 class ConnPanel(TorCtl.PostEventListener, panel.Panel):
   """
   Lists tor related connection data.
@@ -122,17 +353,36 @@ class ConnPanel(TorCtl.PostEventListener, panel.Panel):
     self.lastUpdate = -1              # time last stats was retrived
     self.localhostEntry = None        # special connection - tuple with (entry for this node, fingerprint)
     self.sortOrdering = [ORD_TYPE, ORD_FOREIGN_LISTING, ORD_FOREIGN_PORT]
-    self.fingerprintLookupCache = {}                              # cache of (ip, port) -> fingerprint
-    self.nicknameLookupCache = {}                                 # cache of (ip, port) -> nickname
-    self.fingerprintMappings = _getFingerprintMappings(self.conn) # mappings of ip -> [(port, fingerprint, nickname), ...]
+    self.groupBy = GROUP_NONE         # attribute connections are aggregated by
+    self.fingerprintLookupCache = {}  # cache of (ip, port) -> fingerprint
+    self.nicknameLookupCache = {}     # cache of (ip, port) -> nickname
+    
+    # reverse indexes for the fingerprintLookupCache, so entries can be
+    # invalidated without scanning the cache:
+    # fingerprint => set of (ip, port) keys resolving to it
+    # ip => set of (ip, port) keys with that address
+    self._fingerprintLookupKeys = {}
+    self._addressLookupKeys = {}
     self.providedGeoipWarning = False
     self.orconnStatusCache = []           # cache for 'orconn-status' calls
     self.orconnStatusCacheValid = False   # indicates if cache has been invalidated
-    self.clientConnectionCache = None     # listing of nicknames for our client connections
-    self.clientConnectionLock = RLock()   # lock for clientConnectionCache
+    self.classifier = None                # ConnClassifier, None if it needs to be remade
+    self.classifierLock = RLock()         # lock for remaking the classifier
     self.isDisabled = isDisabled          # prevent panel from updating entirely
     self.lastConnResults = None           # used to check if connection results have changed
     
+    # Sort keys of connection entries, cached until the listing information
+    # they're derived from changes. Keys are for the ordering and listing type
+    # in _sortKeyArgs.
+    self._sortKeys = {}
+    self._sortKeyArgs = None
+    self._invalidSortAddresses = set() # addresses with invalid cached keys
+    
+    # aggregated listing of connections (None if GROUP_NONE), kept up to date
+    # as connections come and go
+    self._aggregate = None
+    self._familyKeys = {} # cache of fingerprint => family group label
+    
     self.isCursorEnabled = True
     self.cursorSelection = None
     self.cursorLoc = 0              # fallback cursor location if selection disappears
@@ -140,12 +390,6 @@ class ConnPanel(TorCtl.PostEventListener, panel.Panel):
     # parameters used for pausing
     self.isPaused = False
     self.pauseTime = 0              # time when paused
-    self.connectionsBuffer = []     # location where connections are stored while paused
-    self.connectionCountBuffer = []
-    self.familyResolutionsBuffer = {}
-    
-    # mapping of ip/port to fingerprint of family entries, used in hack to short circuit (ip / port) -> fingerprint lookups
-    self.familyResolutions = {}
     
     # mapping of family entries to fingerprints
     self.familyFingerprints = {}
@@ -161,56 +405,69 @@ class ConnPanel(TorCtl.PostEventListener, panel.Panel):
     self.isBridge = False           # true if BridgeRelay is set
     self.exitPolicy = ""
     self.exitRejectPrivate = True   # true if ExitPolicyRejectPrivate is 0
+    self.compiledExitPolicy = ExitPolicy("", True)
     
     self.resetOptions()
     
-    # connection results are tuples of the form:
-    # (type, local IP, local port, foreign IP, foreign port, country code)
-    self.connections = []
+    # Connection listings are immutable ConnSnapshots, which are replaced
+    # (rather than modified) by resolution and sorting. While paused the
+    # displayed snapshot is kept in _pausedSnapshot.
+    self._snapshot = ConnSnapshot()
+    self._pausedSnapshot = None
     self.connectionsLock = RLock()    # limits modifications of connections
     
-    # count of total inbound, outbound, client, directory, and control connections
-    self.connectionCount = [0] * 5
-    
     self.reset()
   
   def resetOptions(self):
-    self.familyResolutions = {}
     self.familyFingerprints = {}
     
+    # ports used to classify connections might have changed
+    self.classifierLock.acquire()
+    self.classifier = None
+    self.classifierLock.release()
+    
     try:
+      conn = torTools.getConn()
+      
+      # fetches all of the options we need in a single GETCONF
+      confVals = conn.getOptionMany(("Nickname", "ORPort", "DirPort", "ControlPort",
+        "ORListenAddress", "SocksPort", "MyFamily", "BridgeRelay",
+        "ExitPolicyRejectPrivate"), suppressExc = False)
+      
       self.address = "" # fetched when needed if unset
-      self.nickname = self.conn.get_option("Nickname")[0][1]
+      self.nickname = confVals["Nickname"]
       if self.nickname == None: self.nickname = "Unnamed"
       
-      self.orPort = self.conn.get_option("ORPort")[0][1]
-      self.dirPort = self.conn.get_option("DirPort")[0][1]
-      self.controlPort = self.conn.get_option("ControlPort")[0][1]
+      self.orPort = confVals["ORPort"]
+      self.dirPort = confVals["DirPort"]
+      self.controlPort = confVals["ControlPort"]
       
       # uses ports to identify type of connections (ORListenAddress port overwrites ORPort if set)
-      listenAddr = self.conn.get_option("ORListenAddress")[0][1]
+      listenAddr = confVals["ORListenAddress"]
       if listenAddr and ":" in listenAddr:
         self.listenPort = listenAddr[listenAddr.find(":") + 1:]
       else: self.listenPort = self.orPort
       
-      self.socksPort = torTools.getConn().getOption("SocksPort", "0")
+      self.socksPort = confVals["SocksPort"] or "0"
       
       # entry is None if not set, otherwise of the format "$<fingerprint>,$<fingerprint>"
-      familyEntry = self.conn.get_option("MyFamily")[0][1]
+      familyEntry = confVals["MyFamily"]
       if familyEntry: self.family = familyEntry.split(",")
       else: self.family = []
       
-      self.isBridge = self.conn.get_option("BridgeRelay")[0][1] == "1"
+      self.isBridge = confVals["BridgeRelay"] == "1"
       
-      policyEntries = torTools.getConn().getOption("ExitPolicy", multiple=True)
+      policyEntries = conn.getOption("ExitPolicy", multiple=True)
       if not policyEntries: policyEntries = [] # if ExitPolicy is undefined, policyEntries is None
       self.exitPolicy = ",".join(policyEntries)
       self.exitPolicy = self.exitPolicy.replace("\\t", " ").replace("\"", "")
       
-      if self.exitPolicy: self.exitPolicy += "," + self.conn.get_info("exit-policy/default")["exit-policy/default"]
-      else: self.exitPolicy = self.conn.get_info("exit-policy/default")["exit-policy/default"]
+      defaultPolicy = conn.getInfo("exit-policy/default", "", False)
+      if self.exitPolicy and defaultPolicy: self.exitPolicy += "," + defaultPolicy
+      elif defaultPolicy: self.exitPolicy = defaultPolicy
       
-      self.exitRejectPrivate = self.conn.get_option("ExitPolicyRejectPrivate")[0][1] == "1"
+      self.exitRejectPrivate = confVals["ExitPolicyRejectPrivate"] == "1"
+      self.compiledExitPolicy = ExitPolicy(self.exitPolicy, self.exitRejectPrivate)
       
       self._resolveFamilyEntries()
     except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed):
@@ -224,61 +481,59 @@ class ConnPanel(TorCtl.PostEventListener, panel.Panel):
       self.isBridge = False
       self.exitPolicy = ""
       self.exitRejectPrivate = True
+      self.compiledExitPolicy = ExitPolicy("", True)
+  
+  # events are irrelevant while the panel's disabled, so they're dropped
+  # rather than invalidating caches and resolving family entries
+  def listen(self, event):
+    if not self.isDisabled: TorCtl.PostEventListener.listen(self, event)
   
   # change in client circuits
   def circ_status_event(self, event):
-    self.clientConnectionLock.acquire()
-    self.clientConnectionCache = None
-    self.clientConnectionLock.release()
+    self.classifierLock.acquire()
+    self.classifier = None
+    self.classifierLock.release()
   
-  # when consensus changes update fingerprint mappings
-  # TODO: should also be taking NS events into account
+  # when consensus changes fingerprint resolutions may no longer be valid (the
+  # consensus index itself is kept current by torTools)
   def new_consensus_event(self, event):
     self.orconnStatusCacheValid = False
     self.fingerprintLookupCache.clear()
     self.nicknameLookupCache.clear()
-    self.fingerprintMappings = _getFingerprintMappings(self.conn, event.nslist)
+    self._fingerprintLookupKeys.clear()
+    self._addressLookupKeys.clear()
+    
+    self.connectionsLock.acquire()
+    self._sortKeys = {}
+    self.connectionsLock.release()
+    
+    # all resolutions have been dropped, so family groups might have changed
+    self._regroupConnections()
+    
     if self.listingType != LIST_HOSTNAME: self.sortConnections()
   
   def new_desc_event(self, event):
     self.orconnStatusCacheValid = False
-    self._resolveFamilyEntries()
     
+    # Family nicknames only need to be resolved again if they're unresolved or
+    # the descriptor for their fingerprint has changed (resolutions are
+    # otherwise provided by the torTools descriptor cache).
+    familyChanged = len(self.familyFingerprints) < len(self.family)
+    familyChanged |= bool(set(self.familyFingerprints.values()).intersection(event.idlist))
+    if familyChanged: self._resolveFamilyEntries()
+    
+    self.connectionsLock.acquire()
     for fingerprint in event.idlist:
-      # clears entries with this fingerprint from the cache
-      if fingerprint in self.fingerprintLookupCache.values():
-        invalidEntries = set(k for k, v in self.fingerprintLookupCache.iteritems() if v == fingerprint)
-        for k in invalidEntries:
-          # nicknameLookupCache keys are a subset of fingerprintLookupCache
-          del self.fingerprintLookupCache[k]
-          if k in self.nicknameLookupCache.keys(): del self.nicknameLookupCache[k]
-      
-      # gets consensus data for the new description
-      try: nsData = self.conn.get_network_status("id/%s" % fingerprint)
-      except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed): return
-      
-      if len(nsData) > 1:
-        # multiple records for fingerprint (shouldn't happen)
-        log.log(log.WARN, "Multiple consensus entries for fingerprint: %s" % fingerprint)
-        return
-      nsEntry = nsData[0]
-      
-      # updates fingerprintMappings with new data
-      if nsEntry.ip in self.fingerprintMappings.keys():
-        # if entry already exists with the same orport, remove it
-        orportMatch = None
-        for entryPort, entryFingerprint, entryNickname in self.fingerprintMappings[nsEntry.ip]:
-          if entryPort == nsEntry.orport:
-            orportMatch = (entryPort, entryFingerprint, entryNickname)
-            break
-        
-        if orportMatch: self.fingerprintMappings[nsEntry.ip].remove(orportMatch)
-        
-        # add new entry
-        self.fingerprintMappings[nsEntry.ip].append((nsEntry.orport, nsEntry.idhex, nsEntry.nickname))
-      else:
-        self.fingerprintMappings[nsEntry.ip] = [(nsEntry.orport, nsEntry.idhex, nsEntry.nickname)]
-    if self.listingType != LIST_HOSTNAME: self.sortConnections()
+      if fingerprint in self._familyKeys: del self._familyKeys[fingerprint]
+    self.connectionsLock.release()
+    
+    self._invalidateLookups(event.idlist)
+  
+  # relays with changed consensus entries might have moved, so resolutions for
+  # both their fingerprint and address are dropped
+  def ns_event(self, event):
+    self.orconnStatusCacheValid = False
+    self._invalidateLookups([nsEntry.idhex for nsEntry in event.nslist], [nsEntry.ip for nsEntry in event.nslist])
   
   def reset(self):
     """
@@ -288,12 +543,10 @@ class ConnPanel(TorCtl.PostEventListener, panel.Panel):
     if self.isDisabled: return
     
     # inaccessable during startup so might need to be refetched
-    try:
-      if not self.address: self.address = self.conn.get_info("address")["address"]
-    except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed): pass
+    if not self.address: self.address = torTools.getConn().getInfo("address")
     
     self.connectionsLock.acquire()
-    self.clientConnectionLock.acquire()
+    self.classifierLock.acquire()
     
     # temporary variables for connections and count
     connectionsTmp = []
@@ -301,94 +554,79 @@ class ConnPanel(TorCtl.PostEventListener, panel.Panel):
     familyResolutionsTmp = {}
     
     # used (with isBridge) to determine if inbound connections should be scrubbed
-    isGuard = False
-    try:
-      myFingerprint = self.conn.get_info("fingerprint")
-      nsCall = self.conn.get_network_status("id/%s" % myFingerprint)
-      if nsCall: isGuard = "Guard" in nsCall[0].flags
-      else: raise TorCtl.ErrorReply # network consensus couldn't be fetched
-    except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed): pass
+    torConn = torTools.getConn()
+    isGuard = "Guard" in torConn.getMyFlags([])
     
     try:
-      if self.clientConnectionCache == None:
-        # client connection cache was invalidated
-        self.clientConnectionCache = _getClientConnections(self.conn)
+      if self.classifier == None:
+        # classifier was invalidated by a change in circuits or config
+        self.classifier = ConnClassifier(self.listenPort, self.dirPort, self.socksPort, self.controlPort, _getClientConnections(self.conn))
       
       connTimes = {} # mapping of ip/port to connection time
-      for entry in (self.connections if not self.isPaused else self.connectionsBuffer):
+      for entry in self._snapshot.connections:
         connTimes[(entry[CONN_F_IP], entry[CONN_F_PORT])] = entry[CONN_TIME]
       
       results = connections.getResolver("tor").getConnections()
       if results == self.lastConnResults: return # contents haven't changed
       
+      history = connHistory.getHistory()
+      aggregate = self._aggregate
+      currentConnections = set() # ip/port of resolved connections
+      
       for lIp, lPort, fIp, fPort in results:
         fingerprint = self.getFingerprint(fIp, fPort)
         
+        type = self.classifier.getType(lPort, fIp, fPort, fingerprint)
+        connectionCountTmp[CONN_COUNT_LABELS.index(type)] += 1
+        
         isPrivate = False
-        if lPort in (self.listenPort, self.dirPort):
-          type = "inbound"
-          connectionCountTmp[0] += 1
-          if SCRUB_PRIVATE_DATA and fIp not in self.fingerprintMappings.keys(): isPrivate = isGuard or self.isBridge
-        elif lPort == self.socksPort:
-          type = "client"
-          connectionCountTmp[2] += 1
-        elif lPort == self.controlPort:
-          type = "control"
-          connectionCountTmp[4] += 1
-        else:
-          nickname = self.getNickname(fIp, fPort)
-          
-          isClient = False
-          for clientName in self.clientConnectionCache:
-            if nickname == clientName or (len(clientName) > 1 and clientName[0] == "$" and fingerprint == clientName[1:]):
-              isClient = True
-              break
-          
-          if isClient:
-            type = "client"
-            connectionCountTmp[2] += 1
-          elif (fIp, fPort) in DIR_SERVERS:
-            type = "directory"
-            connectionCountTmp[3] += 1
-          else:
-            type = "outbound"
-            connectionCountTmp[1] += 1
-            if SCRUB_PRIVATE_DATA and fIp not in self.fingerprintMappings.keys(): isPrivate = isExitAllowed(fIp, fPort, self.exitPolicy, self.exitRejectPrivate)
+        if SCRUB_PRIVATE_DATA and type in ("inbound", "outbound") and not torConn.getRelaysAt(fIp):
+          if type == "inbound": isPrivate = isGuard or self.isBridge
+          else: isPrivate = self.compiledExitPolicy.isExitAllowed(fIp, fPort)
         
         # replace nat address with external version if available and the
         # external address isn't a private IP
-        # TODO: range should restrict to the following address ranges:
-        #   10.*, 172.16.* - 172.31.*, 192.168.*
-        # being lazy right now - fix the 172.* range when rewriting
-        isPrivateIp = fIp.startswith("10.") or fIp.startswith("192.168.") or fIp.startswith("172.")
-        if self.address and type != "control" and not isPrivateIp: lIp = self.address
+        if self.address and type != "control" and not isPrivateAddress(fIp): lIp = self.address
         
-        try:
-          countryCodeQuery = "ip-to-country/%s" % fIp
-          countryCode = self.conn.get_info(countryCodeQuery)[countryCodeQuery]
-        except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed):
-          countryCode = "??"
+        countryCode = geoip.getCountry(fIp)
+        if countryCode == None:
+          countryCode = geoip.UNKNOWN_COUNTRY
           if not self.providedGeoipWarning:
             log.log(log.WARN, "Tor geoip database is unavailable.")
             self.providedGeoipWarning = True
         
         if (fIp, fPort) in connTimes: connTime = connTimes[(fIp, fPort)]
-        else: connTime = time.time()
+        else:
+          connTime = time.time()
+          
+          # connections present when we start aren't new
+          if self.lastConnResults != None: history.recordOpen(type, connTime)
+        
+        entry = (type, lIp, lPort, fIp, fPort, countryCode, connTime, isPrivate)
+        connectionsTmp.append(entry)
+        currentConnections.add((fIp, fPort))
         
-        connectionsTmp.append((type, lIp, lPort, fIp, fPort, countryCode, connTime, isPrivate))
+        # only new connections (or ones that have changed type) need to be
+        # added to the aggregates
+        typeIndex = CONN_COUNT_LABELS.index(type)
+        if aggregate and not aggregate.hasMember((fIp, fPort), typeIndex):
+          aggregate.add((fIp, fPort), typeIndex, self._getGroupLabel(entry, aggregate.groupBy), entry)
+      
+      # records connections that have closed since the last refresh, their
+      # lifetimes being since we first saw them
+      closeTime = time.time()
+      for entry in self._snapshot.connections:
+        entryType, fIp, fPort = entry[CONN_TYPE], entry[CONN_F_IP], entry[CONN_F_PORT]
+        
+        if entryType in connHistory.TYPES and not (fIp, fPort) in currentConnections:
+          history.recordClose(entryType, entry[CONN_TIME], closeTime, self.getFingerprint(fIp, fPort))
+          if aggregate: aggregate.remove((fIp, fPort))
       
       # appends localhost connection to allow user to look up their own consensus entry
-      selfFingerprint = None
-      try:
-        selfFingerprint = self.conn.get_info("fingerprint")["fingerprint"]
-      except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed): pass
+      selfFingerprint = torConn.getInfo("fingerprint")
       
       if self.address and selfFingerprint:
-        try:
-          countryCodeQuery = "ip-to-country/%s" % self.address
-          selfCountryCode = self.conn.get_info(countryCodeQuery)[countryCodeQuery]
-        except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed):
-          selfCountryCode = "??"
+        selfCountryCode = geoip.getCountry(self.address, geoip.UNKNOWN_COUNTRY)
         
         if (self.address, self.orPort) in connTimes: connTime = connTimes[(self.address, self.orPort)]
         else: connTime = time.time()
@@ -401,71 +639,69 @@ class ConnPanel(TorCtl.PostEventListener, panel.Panel):
       # appends family connections
       tmpCounter = 0 # used for unique port of unresolved family entries (funky hack)
       for familyEntry in self.family:
-        # TODO: turns out that "ns/name/<OR nickname>" accpets fingerprint
-        # identifiers, so all this nickname -> fingerprint work is unnecessary,
-        # but used for fingerprint lookup performance in draw... this could be
-        # improved (might be completely unnecessary due to the fingerprint
-        # lookup cache)
-        fingerprint = None
-        if familyEntry in self.familyFingerprints:
-          fingerprint = self.familyFingerprints[familyEntry]
+        # nicknames that weren't resolved earlier are retried via the
+        # descriptor cache, and the address comes from the consensus index
+        fingerprint = self.familyFingerprints.get(familyEntry)
+        if not fingerprint: fingerprint = torConn.getRelayFingerprint(familyEntry)
         
-        try:
-          if fingerprint: nsCall = self.conn.get_network_status("id/%s" % fingerprint)
-          else: nsCall = self.conn.get_network_status("name/%s" % familyEntry)
-          if nsCall: familyAddress, familyPort = nsCall[0].ip, nsCall[0].orport
-          else: raise TorCtl.ErrorReply # network consensus couldn't be fetched
-          
-          countryCodeQuery = "ip-to-country/%s" % familyAddress
-          familyCountryCode = self.conn.get_info(countryCodeQuery)[countryCodeQuery]
+        relayRecord = None
+        if fingerprint: relayRecord = torConn.getRelay(fingerprint)
+        
+        if relayRecord:
+          familyAddress, familyPort = relayRecord[torTools.RELAY_ADDRESS], relayRecord[torTools.RELAY_OR_PORT]
+          familyCountryCode = geoip.getCountry(familyAddress, geoip.UNKNOWN_COUNTRY)
           
           if (familyAddress, familyPort) in connTimes: connTime = connTimes[(familyAddress, familyPort)]
           else: connTime = time.time()
           
-          if fingerprint: familyResolutionsTmp[(familyAddress, familyPort)] = fingerprint
+          familyResolutionsTmp[(familyAddress, familyPort)] = fingerprint
           connectionsTmp.append(("family", familyAddress, familyPort, familyAddress, familyPort, familyCountryCode, connTime, False))
-        except (socket.error, TorCtl.ErrorReply):
+        else:
           # use dummy entry for sorting - the draw function notes that entries are unknown
           portIdentifier = str(65536 + tmpCounter)
           if fingerprint: familyResolutionsTmp[("256.255.255.255", portIdentifier)] = fingerprint
           connectionsTmp.append(("family", "256.255.255.255", portIdentifier, "256.255.255.255", portIdentifier, "??", time.time(), False))
           tmpCounter += 1
-        except TorCtl.TorCtlClosed:
-          pass # connections aren't shown when control port is unavailable
       
       self.lastUpdate = time.time()
       
-      # assigns results
-      if self.isPaused:
-        self.connectionsBuffer = connectionsTmp
-        self.connectionCountBuffer = connectionCountTmp
-        self.familyResolutionsBuffer = familyResolutionsTmp
-      else:
-        self.connections = connectionsTmp
-        self.connectionCount = connectionCountTmp
-        self.familyResolutions = familyResolutionsTmp
-        
-        # hostnames are sorted at draw - otherwise now's a good time
-        if self.listingType != LIST_HOSTNAME: self.sortConnections()
+      # assigns results (if paused this is shown when we're unpaused)
+      groupsTmp = None
+      if aggregate: groupsTmp = aggregate.getGroups()
+      
+      self._snapshot = ConnSnapshot(connectionsTmp, connectionCountTmp, familyResolutionsTmp, None, groupsTmp)
+      
+      # hostnames are sorted at draw - otherwise now's a good time
+      if self.listingType != LIST_HOSTNAME: self.sortConnections()
       self.lastConnResults = results
     finally:
       self.connectionsLock.release()
-      self.clientConnectionLock.release()
+      self.classifierLock.release()
   
   def handleKey(self, key):
     # cursor or scroll movement
     
     #if key in (curses.KEY_UP, curses.KEY_DOWN, curses.KEY_PPAGE, curses.KEY_NPAGE):
-    if uiTools.isScrollKey(key):
+    if uiTools.isScrollKey(key) and self.groupBy != GROUP_NONE:
+      # aggregated listing, which scrolls without a cursor
+      pageHeight = self.getPreferredSize()[0] - 2
+      
+      self.connectionsLock.acquire()
+      groupCount = len(self.getSnapshot().groups or ())
+      self.scroll = uiTools.getScrollPosition(key, self.scroll, pageHeight, groupCount)
+      self.connectionsLock.release()
+    elif uiTools.isScrollKey(key):
       pageHeight = self.getPreferredSize()[0] - 1
       if self.showingDetails: pageHeight -= 8
       
       self.connectionsLock.acquire()
       try:
+        snapshot = self.getSnapshot()
+        
         # determines location parameter to use
         if self.isCursorEnabled:
-          try: currentLoc = self.connections.index(self.cursorSelection)
-          except ValueError: currentLoc = self.cursorLoc # fall back to nearby entry
+          currentLoc = snapshot.getPosition(self.cursorSelection)
+          if currentLoc == None: currentLoc = self.cursorLoc # fall back to nearby entry
         else: currentLoc = self.scroll
         
         # location offset
@@ -474,16 +710,16 @@ class ConnPanel(TorCtl.PostEventListener, panel.Panel):
         elif key == curses.KEY_PPAGE: shift = -pageHeight + 1 if self.isCursorEnabled else -pageHeight
         elif key == curses.KEY_NPAGE: shift = pageHeight - 1 if self.isCursorEnabled else pageHeight
         elif key == curses.KEY_HOME: shift = -currentLoc
-        elif key == curses.KEY_END: shift = len(self.connections) # always below the lower bound
+        elif key == curses.KEY_END: shift = len(snapshot.connections) # always below the lower bound
         newLoc = currentLoc + shift
         
         # restricts to valid bounds
-        maxLoc = len(self.connections) - 1 if self.isCursorEnabled else len(self.connections) - pageHeight
+        maxLoc = len(snapshot.connections) - 1 if self.isCursorEnabled else len(snapshot.connections) - pageHeight
         newLoc = max(0, min(newLoc, maxLoc))
         
         # applies to proper parameter
-        if self.isCursorEnabled and self.connections:
-          self.cursorSelection, self.cursorLoc = self.connections[newLoc], newLoc
+        if self.isCursorEnabled and snapshot.connections:
+          self.cursorSelection, self.cursorLoc = snapshot.connections[newLoc], newLoc
         else: self.scroll = newLoc
       finally:
         self.connectionsLock.release()
@@ -499,194 +735,234 @@ class ConnPanel(TorCtl.PostEventListener, panel.Panel):
     try:
       # hostnames frequently get updated so frequent sorting needed
       if self.listingType == LIST_HOSTNAME: self.sortConnections()
+      snapshot = self.getSnapshot()
       
       if self.showLabel:
         # notes the number of connections for each type if above zero
         countLabel = ""
-        for i in range(len(self.connectionCount)):
-          if self.connectionCount[i] > 0: countLabel += "%i %s, " % (self.connectionCount[i], CONN_COUNT_LABELS[i])
+        for i in range(len(snapshot.connectionCount)):
+          if snapshot.connectionCount[i] > 0: countLabel += "%i %s, " % (snapshot.connectionCount[i], CONN_COUNT_LABELS[i])
         if countLabel: countLabel = " (%s)" % countLabel[:-2] # strips ending ", " and encases in parentheses
-        self.addstr(0, 0, "Connections%s:" % countLabel, curses.A_STANDOUT)
+        
+        groupLabel = ""
+        if self.groupBy != GROUP_NONE: groupLabel = " by %s" % GROUP_LABEL[self.groupBy]
+        self.addstr(0, 0, "Connections%s%s:" % (groupLabel, countLabel), curses.A_STANDOUT)
       
-      if self.connections:
+      if self.groupBy != GROUP_NONE:
+        self._drawGroups(snapshot.groups or (), width, height)
+      elif snapshot.connections:
         listingHeight = height - 1
         currentTime = time.time() if not self.isPaused else self.pauseTime
         
         if self.showingDetails:
           listingHeight -= 8
-          isScrollBarVisible = len(self.connections) > height - 9
+          isScrollBarVisible = len(snapshot.connections) > height - 9
           if width > 80: subwindow.hline(8, 80, curses.ACS_HLINE, width - 81)
         else:
-          isScrollBarVisible = len(self.connections) > height - 1
+          isScrollBarVisible = len(snapshot.connections) > height - 1
         xOffset = 3 if isScrollBarVisible else 0 # content offset for scroll bar
         
         # ensure cursor location and scroll top are within bounds
-        self.cursorLoc = max(min(self.cursorLoc, len(self.connections) - 1), 0)
-        self.scroll = max(min(self.scroll, len(self.connections) - listingHeight), 0)
+        self.cursorLoc = max(min(self.cursorLoc, len(snapshot.connections) - 1), 0)
+        self.scroll = max(min(self.scroll, len(snapshot.connections) - listingHeight), 0)
         
         if self.isCursorEnabled:
           # update cursorLoc with selection (or vice versa if selection not found)
-          if self.cursorSelection not in self.connections:
-            self.cursorSelection = self.connections[self.cursorLoc]
-          else: self.cursorLoc = self.connections.index(self.cursorSelection)
+          selectionLoc = snapshot.getPosition(self.cursorSelection)
+          if selectionLoc == None: self.cursorSelection = snapshot.connections[self.cursorLoc]
+          else: self.cursorLoc = selectionLoc
           
           # shift scroll if necessary for cursor to be visible
           if self.cursorLoc < self.scroll: self.scroll = self.cursorLoc
           elif self.cursorLoc - listingHeight + 1 > self.scroll: self.scroll = self.cursorLoc - listingHeight + 1
         
-        lineNum = (-1 * self.scroll) + 1
-        for entry in self.connections:
-          if lineNum >= 1:
-            type = entry[CONN_TYPE]
-            isPrivate = entry[CONN_PRIVATE]
-            color = TYPE_COLORS[type]
+        # only formats the entries that are visible
+        lineNum = 1
+        for entry in snapshot.connections[self.scroll:self.scroll + listingHeight]:
+          type = entry[CONN_TYPE]
+          isPrivate = entry[CONN_PRIVATE]
+          color = TYPE_COLORS[type]
+          
+          # adjustments to measurements for 'xOffset' are to account for scroll bar
+          if self.listingType == LIST_IP:
+            # base data requires 73 characters
+            src = "%s:%s" % (entry[CONN_L_IP], entry[CONN_L_PORT])
+            dst = "%s:%s %s" % (entry[CONN_F_IP], entry[CONN_F_PORT], "" if type == "control" else "(%s)" % entry[CONN_COUNTRY])
             
-            # adjustments to measurements for 'xOffset' are to account for scroll bar
-            if self.listingType == LIST_IP:
-              # base data requires 73 characters
-              src = "%s:%s" % (entry[CONN_L_IP], entry[CONN_L_PORT])
-              dst = "%s:%s %s" % (entry[CONN_F_IP], entry[CONN_F_PORT], "" if type == "control" else "(%s)" % entry[CONN_COUNTRY])
-              
-              if isPrivate: dst = "<scrubbed>"
-              
-              src, dst = "%-21s" % src, "%-26s" % dst
-              
-              etc = ""
-              if width > 115 + xOffset:
-                # show fingerprint (column width: 42 characters)
-                etc += "%-40s  " % self.getFingerprint(entry[CONN_F_IP], entry[CONN_F_PORT])
-                
-              if width > 127 + xOffset:
-                # show nickname (column width: remainder)
-                nickname = self.getNickname(entry[CONN_F_IP], entry[CONN_F_PORT])
-                nicknameSpace = width - 118 - xOffset
-                
-                # truncates if too long
-                if len(nickname) > nicknameSpace: nickname = "%s..." % nickname[:nicknameSpace - 3]
-                
-                etc += ("%%-%is  " % nicknameSpace) % nickname
-            elif self.listingType == LIST_HOSTNAME:
-              # base data requires 80 characters
-              src = "localhost:%-5s" % entry[CONN_L_PORT]
-              
-              # space available for foreign hostname (stretched to claim any free space)
-              foreignHostnameSpace = width - 42 - xOffset
-              
-              etc = ""
-              if width > 102 + xOffset:
-                # shows ip/locale (column width: 22 characters)
-                foreignHostnameSpace -= 22
-                
-                if isPrivate: ipEntry = "<scrubbed>"
-                else: ipEntry = "%s %s" % (entry[CONN_F_IP], "" if type == "control" else "(%s)" % entry[CONN_COUNTRY])
-                etc += "%-20s  " % ipEntry
-              
-              if width > 134 + xOffset:
-                # show fingerprint (column width: 42 characters)
-                foreignHostnameSpace -= 42
-                etc += "%-40s  " % self.getFingerprint(entry[CONN_F_IP], entry[CONN_F_PORT])
+            if isPrivate: dst = "<scrubbed>"
+            
+            src, dst = "%-21s" % src, "%-26s" % dst
+            
+            etc = ""
+            if width > 115 + xOffset:
+              # show fingerprint (column width: 42 characters)
+              etc += "%-40s  " % self.getFingerprint(entry[CONN_F_IP], entry[CONN_F_PORT])
               
-              if width > 151 + xOffset:
-                # show nickname (column width: min 17 characters, uses half of the remainder)
-                nickname = self.getNickname(entry[CONN_F_IP], entry[CONN_F_PORT])
-                nicknameSpace = 15 + (width - xOffset - 151) / 2
-                foreignHostnameSpace -= (nicknameSpace + 2)
-                
-                if len(nickname) > nicknameSpace: nickname = "%s..." % nickname[:nicknameSpace - 3]
-                etc += ("%%-%is  " % nicknameSpace) % nickname
+            if width > 127 + xOffset:
+              # show nickname (column width: remainder)
+              nickname = self.getNickname(entry[CONN_F_IP], entry[CONN_F_PORT])
+              nicknameSpace = width - 118 - xOffset
               
-              if isPrivate: dst = "<scrubbed>"
-              else:
-                try: hostname = hostnames.resolve(entry[CONN_F_IP])
-                except ValueError: hostname = None
-                
-                # truncates long hostnames
-                portDigits = len(str(entry[CONN_F_PORT]))
-                if hostname and (len(hostname) + portDigits) > foreignHostnameSpace - 1:
-                  hostname = hostname[:(foreignHostnameSpace - portDigits - 4)] + "..."
-                
-                dst = "%s:%s" % (hostname if hostname else entry[CONN_F_IP], entry[CONN_F_PORT])
+              # truncates if too long
+              if len(nickname) > nicknameSpace: nickname = "%s..." % nickname[:nicknameSpace - 3]
               
-              dst = ("%%-%is" % foreignHostnameSpace) % dst
-            elif self.listingType == LIST_FINGERPRINT:
-              # base data requires 75 characters
-              src = "localhost"
-              if entry[CONN_TYPE] == "control": dst = "localhost"
-              else: dst = self.getFingerprint(entry[CONN_F_IP], entry[CONN_F_PORT])
-              dst = "%-40s" % dst
+              etc += ("%%-%is  " % nicknameSpace) % nickname
+          elif self.listingType == LIST_HOSTNAME:
+            # base data requires 80 characters
+            src = "localhost:%-5s" % entry[CONN_L_PORT]
+            
+            # space available for foreign hostname (stretched to claim any free space)
+            foreignHostnameSpace = width - 42 - xOffset
+            
+            etc = ""
+            if width > 102 + xOffset:
+              # shows ip/locale (column width: 22 characters)
+              foreignHostnameSpace -= 22
               
-              etc = ""
-              if width > 92 + xOffset:
-                # show nickname (column width: min 17 characters, uses remainder if extra room's available)
-                nickname = self.getNickname(entry[CONN_F_IP], entry[CONN_F_PORT])
-                nicknameSpace = width - 78 - xOffset if width < 126 else width - 106 - xOffset
-                if len(nickname) > nicknameSpace: nickname = "%s..." % nickname[:nicknameSpace - 3]
-                etc += ("%%-%is  " % nicknameSpace) % nickname
+              if isPrivate: ipEntry = "<scrubbed>"
+              else: ipEntry = "%s %s" % (entry[CONN_F_IP], "" if type == "control" else "(%s)" % entry[CONN_COUNTRY])
+              etc += "%-20s  " % ipEntry
+            
+            if width > 134 + xOffset:
+              # show fingerprint (column width: 42 characters)
+              foreignHostnameSpace -= 42
+              etc += "%-40s  " % self.getFingerprint(entry[CONN_F_IP], entry[CONN_F_PORT])
+            
+            if width > 151 + xOffset:
+              # show nickname (column width: min 17 characters, uses half of the remainder)
+              nickname = self.getNickname(entry[CONN_F_IP], entry[CONN_F_PORT])
+              nicknameSpace = 15 + (width - xOffset - 151) / 2
+              foreignHostnameSpace -= (nicknameSpace + 2)
               
-              if width > 125 + xOffset:
-                # shows ip/port/locale (column width: 28 characters)
-                if isPrivate: ipEntry = "<scrubbed>"
-                else: ipEntry = "%s:%s %s" % (entry[CONN_F_IP], entry[CONN_F_PORT], "" if type == "control" else "(%s)" % entry[CONN_COUNTRY])
-                etc += "%-26s  " % ipEntry
+              if len(nickname) > nicknameSpace: nickname = "%s..." % nickname[:nicknameSpace - 3]
+              etc += ("%%-%is  " % nicknameSpace) % nickname
+            
+            if isPrivate: dst = "<scrubbed>"
             else:
-              # base data uses whatever extra room's available (using minimun of 50 characters)
-              src = self.nickname
-              if entry[CONN_TYPE] == "control": dst = self.nickname
-              else: dst = self.getNickname(entry[CONN_F_IP], entry[CONN_F_PORT])
-              
-              # space available for foreign nickname
-              foreignNicknameSpace = width - len(self.nickname) - 27 - xOffset
-              
-              etc = ""
-              if width > 92 + xOffset:
-                # show fingerprint (column width: 42 characters)
-                foreignNicknameSpace -= 42
-                etc += "%-40s  " % self.getFingerprint(entry[CONN_F_IP], entry[CONN_F_PORT])
+              try: hostname = hostnames.resolve(entry[CONN_F_IP])
+              except ValueError: hostname = None
               
-              if width > 120 + xOffset:
-                # shows ip/port/locale (column width: 28 characters)
-                foreignNicknameSpace -= 28
-                
-                if isPrivate: ipEntry = "<scrubbed>"
-                else: ipEntry = "%s:%s %s" % (entry[CONN_F_IP], entry[CONN_F_PORT], "" if type == "control" else "(%s)" % entry[CONN_COUNTRY])
-                etc += "%-26s  " % ipEntry
+              # truncates long hostnames
+              portDigits = len(str(entry[CONN_F_PORT]))
+              if hostname and (len(hostname) + portDigits) > foreignHostnameSpace - 1:
+                hostname = hostname[:(foreignHostnameSpace - portDigits - 4)] + "..."
               
-              dst = ("%%-%is" % foreignNicknameSpace) % dst
+              dst = "%s:%s" % (hostname if hostname else entry[CONN_F_IP], entry[CONN_F_PORT])
             
-            timeLabel = uiTools.getTimeLabel(currentTime - entry[CONN_TIME], 1)
-            if type == "inbound": src, dst = dst, src
-            elif type == "family" and int(entry[CONN_L_PORT]) > 65535:
-              # this belongs to an unresolved family entry - replaces invalid data with "UNKNOWN"
-              timeLabel = "---"
-              
-              if self.listingType == LIST_IP:
-                src = "%-21s" % "UNKNOWN"
-                dst = "%-26s" % "UNKNOWN"
-              elif self.listingType == LIST_HOSTNAME:
-                src = "%-15s" % "UNKNOWN"
-                dst = ("%%-%is" % len(dst)) % "UNKNOWN"
-                if len(etc) > 0: etc = etc.replace("256.255.255.255 (??)", "UNKNOWN" + " " * 13)
-              else:
-                ipStart = etc.find("256")
-                if ipStart > -1: etc = etc[:ipStart] + ("%%-%is" % len(etc[ipStart:])) % "UNKNOWN"
+            dst = ("%%-%is" % foreignHostnameSpace) % dst
+          elif self.listingType == LIST_FINGERPRINT:
+            # base data requires 75 characters
+            src = "localhost"
+            if entry[CONN_TYPE] == "control": dst = "localhost"
+            else: dst = self.getFingerprint(entry[CONN_F_IP], entry[CONN_F_PORT])
+            dst = "%-40s" % dst
+            
+            etc = ""
+            if width > 92 + xOffset:
+              # show nickname (column width: min 17 characters, uses remainder if extra room's available)
+              nickname = self.getNickname(entry[CONN_F_IP], entry[CONN_F_PORT])
+              nicknameSpace = width - 78 - xOffset if width < 126 else width - 106 - xOffset
+              if len(nickname) > nicknameSpace: nickname = "%s..." % nickname[:nicknameSpace - 3]
+              etc += ("%%-%is  " % nicknameSpace) % nickname
             
-            padding = width - (len(src) + len(dst) + len(etc) + 27) - xOffset # padding needed to fill full line
-            lineEntry = "<%s>%s  -->  %s  %s%s%5s (<b>%s</b>)%s</%s>" % (color, src, dst, etc, " " * padding, timeLabel, type.upper(), " " * (9 - len(type)), color)
+            if width > 125 + xOffset:
+              # shows ip/port/locale (column width: 28 characters)
+              if isPrivate: ipEntry = "<scrubbed>"
+              else: ipEntry = "%s:%s %s" % (entry[CONN_F_IP], entry[CONN_F_PORT], "" if type == "control" else "(%s)" % entry[CONN_COUNTRY])
+              etc += "%-26s  " % ipEntry
+          else:
+            # base data uses whatever extra room's available (using minimun of 50 characters)
+            src = self.nickname
+            if entry[CONN_TYPE] == "control": dst = self.nickname
+            else: dst = self.getNickname(entry[CONN_F_IP], entry[CONN_F_PORT])
+            
+            # space available for foreign nickname
+            foreignNicknameSpace = width - len(self.nickname) - 27 - xOffset
+            
+            etc = ""
+            if width > 92 + xOffset:
+              # show fingerprint (column width: 42 characters)
+              foreignNicknameSpace -= 42
+              etc += "%-40s  " % self.getFingerprint(entry[CONN_F_IP], entry[CONN_F_PORT])
             
-            if self.isCursorEnabled and entry == self.cursorSelection:
-              lineEntry = "<h>%s</h>" % lineEntry
+            if width > 120 + xOffset:
+              # shows ip/port/locale (column width: 28 characters)
+              foreignNicknameSpace -= 28
+              
+              if isPrivate: ipEntry = "<scrubbed>"
+              else: ipEntry = "%s:%s %s" % (entry[CONN_F_IP], entry[CONN_F_PORT], "" if type == "control" else "(%s)" % entry[CONN_COUNTRY])
+              etc += "%-26s  " % ipEntry
+            
+            dst = ("%%-%is" % foreignNicknameSpace) % dst
+          
+          timeLabel = uiTools.getTimeLabel(currentTime - entry[CONN_TIME], 1)
+          if type == "inbound": src, dst = dst, src
+          elif type == "family" and int(entry[CONN_L_PORT]) > 65535:
+            # this belongs to an unresolved family entry - replaces invalid data with "UNKNOWN"
+            timeLabel = "---"
             
-            yOffset = 0 if not self.showingDetails else 8
-            self.addfstr(lineNum + yOffset, xOffset, lineEntry)
+            if self.listingType == LIST_IP:
+              src = "%-21s" % "UNKNOWN"
+              dst = "%-26s" % "UNKNOWN"
+            elif self.listingType == LIST_HOSTNAME:
+              src = "%-15s" % "UNKNOWN"
+              dst = ("%%-%is" % len(dst)) % "UNKNOWN"
+              if len(etc) > 0: etc = etc.replace("256.255.255.255 (??)", "UNKNOWN" + " " * 13)
+            else:
+              ipStart = etc.find("256")
+              if ipStart > -1: etc = etc[:ipStart] + ("%%-%is" % len(etc[ipStart:])) % "UNKNOWN"
+          
+          padding = width - (len(src) + len(dst) + len(etc) + 27) - xOffset # padding needed to fill full line
+          lineEntry = "<%s>%s  -->  %s  %s%s%5s (<b>%s</b>)%s</%s>" % (color, src, dst, etc, " " * padding, timeLabel, type.upper(), " " * (9 - len(type)), color)
+          
+          if self.isCursorEnabled and entry == self.cursorSelection:
+            lineEntry = "<h>%s</h>" % lineEntry
+          
+          yOffset = 0 if not self.showingDetails else 8
+          self.addfstr(lineNum + yOffset, xOffset, lineEntry)
           lineNum += 1
         
         if isScrollBarVisible:
           topY = 9 if self.showingDetails else 1
           bottomEntry = self.scroll + height - 9 if self.showingDetails else self.scroll + height - 1
-          self.addScrollBar(self.scroll, bottomEntry, len(self.connections), topY)
+          self.addScrollBar(self.scroll, bottomEntry, len(snapshot.connections), topY)
     finally:
       self.connectionsLock.release()
   
+  def _drawGroups(self, groups, width, height):
+    """
+    Draws the aggregated listing, with a row for each group's connection
+    counts. Rows are colored by the group's most common connection type.
+    
+    Arguments:
+      groups - group entries from ConnAggregate.getGroups()
+      width  - panel width
+      height - panel height
+    """
+    
+    listingHeight = height - 2
+    self.scroll = max(min(self.scroll, len(groups) - listingHeight), 0)
+    
+    isScrollBarVisible = len(groups) > listingHeight
+    xOffset = 3 if isScrollBarVisible else 0 # content offset for scroll bar
+    labelWidth = max(20, width - xOffset - 11 * (len(CONN_COUNT_LABELS) + 1) - 1)
+    
+    header = "%%-%is %%10s" % labelWidth % (GROUP_LABEL[self.groupBy], "total")
+    for connType in CONN_COUNT_LABELS: header += " %10s" % connType
+    self.addstr(1, xOffset, header, curses.A_UNDERLINE)
+    
+    lineNum = 2
+    for groupLabel, total, counts in groups[self.scroll:self.scroll + listingHeight]:
+      line = "%%-%is %%10i" % labelWidth % (uiTools.cropStr(groupLabel, labelWidth), total)
+      for count in counts: line += " %10i" % count
+      
+      commonType = CONN_COUNT_LABELS[list(counts).index(max(counts))]
+      self.addstr(lineNum, xOffset, line, uiTools.getColor(TYPE_COLORS[commonType]))
+      lineNum += 1
+    
+    if isScrollBarVisible:
+      self.addScrollBar(self.scroll, self.scroll + listingHeight, len(groups), 2)
+  
   def getFingerprint(self, ipAddr, port):
     """
     Makes an effort to match connection to fingerprint - if there's multiple
@@ -699,8 +975,9 @@ class ConnPanel(TorCtl.PostEventListener, panel.Panel):
       return self.localhostEntry[1]
     
     # checks if this belongs to a family entry
-    if (ipAddr, port) in self.familyResolutions.keys():
-      return self.familyResolutions[(ipAddr, port)]
+    familyResolutions = self.getSnapshot().familyResolutions
+    if (ipAddr, port) in familyResolutions:
+      return familyResolutions[(ipAddr, port)]
     
     port = int(port)
     if (ipAddr, port) in self.fingerprintLookupCache:
@@ -713,22 +990,22 @@ class ConnPanel(TorCtl.PostEventListener, panel.Panel):
       if not self.orconnStatusCacheValid:
         self.orconnStatusCache, isOdd = [], True
         self.orconnStatusCacheValid = True
-        try:
-          for entry in self.conn.get_info("orconn-status")["orconn-status"].split():
+        orconnStatus = torTools.getConn().getInfo("orconn-status")
+        
+        if orconnStatus != None:
+          for entry in orconnStatus.split():
             if isOdd: self.orconnStatusCache.append(entry)
             isOdd = not isOdd
-        except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed): self.orconnStatusCache = None
+        else: self.orconnStatusCache = None
       
-      if ipAddr in self.fingerprintMappings.keys():
-        potentialMatches = self.fingerprintMappings[ipAddr]
-        
-        if len(potentialMatches) == 1: match = potentialMatches[0][1]
-        else:
-          # multiple potential matches - look for exact match with port
-          for (entryPort, entryFingerprint, entryNickname) in potentialMatches:
-            if entryPort == port:
-              match = entryFingerprint
-              break
+      torConn = torTools.getConn()
+      potentialMatches = torConn.getRelaysAt(ipAddr)
+      
+      if len(potentialMatches) == 1: match = potentialMatches[0][torTools.RELAY_FINGERPRINT]
+      elif potentialMatches:
+        # multiple potential matches - look for exact match with port
+        relayRecord = torConn.getRelayAt(ipAddr, port)
+        if relayRecord: match = relayRecord[torTools.RELAY_FINGERPRINT]
         
         if not match:
           # still haven't found it - use trick from Mike's ConsensusTracker,
@@ -737,30 +1014,30 @@ class ConnPanel(TorCtl.PostEventListener, panel.Panel):
           # ... list a bandwidth of 0
           # ... have 'opt hibernating' set
           operativeMatches = list(potentialMatches)
-          for entryPort, entryFingerprint, entryNickname in potentialMatches:
-            # gets router description to see if 'down' is set
-            toRemove = False
-            try:
-              nsCall = self.conn.get_network_status("id/%s" % entryFingerprint)
-              if not nsCall: raise TorCtl.ErrorReply() # network consensus couldn't be fetched
-              else: nsEntry = nsCall[0]
-              
-              descLookupCmd = "desc/id/%s" % entryFingerprint
-              descEntry = TorCtl.Router.build_from_desc(self.conn.get_info(descLookupCmd)[descLookupCmd].split("\n"), nsEntry)
-              toRemove = descEntry.down
-            except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed): pass # ns or desc lookup fails... also weird
+          for relayRecord in potentialMatches:
+            entryFingerprint = relayRecord[torTools.RELAY_FINGERPRINT]
+            entryNickname = relayRecord[torTools.RELAY_NICKNAME]
+            toRemove = "Running" not in relayRecord[torTools.RELAY_FLAGS] or relayRecord[torTools.RELAY_BANDWIDTH] == 0
+            
+            # checks the router description to see if it's hibernating (if the
+            # desc lookup fails then this is also weird, but keep the match)
+            if not toRemove:
+              hibernating = torConn.getRelayDescriptorField(entryFingerprint, "hibernating", "0")
+              toRemove = hibernating.strip() == "1"
             
             # eliminates connections not reported by orconn-status -
             # this has *very* little impact since few ips have multiple relays
             if self.orconnStatusCache and not toRemove: toRemove = entryNickname not in self.orconnStatusCache
             
-            if toRemove: operativeMatches.remove((entryPort, entryFingerprint, entryNickname))
+            if toRemove: operativeMatches.remove(relayRecord)
           
-          if len(operativeMatches) == 1: match = operativeMatches[0][1]
+          if len(operativeMatches) == 1: match = operativeMatches[0][torTools.RELAY_FINGERPRINT]
       
       if not match: match = "UNKNOWN"
       
       self.fingerprintLookupCache[(ipAddr, port)] = match
+      self._fingerprintLookupKeys.setdefault(match, set()).add((ipAddr, port))
+      self._addressLookupKeys.setdefault(ipAddr, set()).add((ipAddr, port))
       return match
   
   def getNickname(self, ipAddr, port):
@@ -774,12 +1051,10 @@ class ConnPanel(TorCtl.PostEventListener, panel.Panel):
     else:
       match = self.getFingerprint(ipAddr, port)
       
-      try:
-        if match != "UNKNOWN":
-          nsCall = self.conn.get_network_status("id/%s" % match)
-          if nsCall: match = nsCall[0].nickname
-          else: raise TorCtl.ErrorReply # network consensus couldn't be fetched
-      except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed): return "UNKNOWN" # don't cache result
+      if match != "UNKNOWN":
+        relayRecord = torTools.getConn().getRelay(match)
+        if relayRecord: match = relayRecord[torTools.RELAY_NICKNAME]
+        else: return "UNKNOWN" # don't cache result
       
       self.nicknameLookupCache[(ipAddr, port)] = match
       return match
@@ -791,58 +1066,417 @@ class ConnPanel(TorCtl.PostEventListener, panel.Panel):
     
     if isPause == self.isPaused: return
     
+    # snapshots are immutable, so pausing just retains a reference to the
+    # current one (resolution continues to provide new snapshots, which are
+    # already sorted when we're unpaused)
+    self.connectionsLock.acquire()
     self.isPaused = isPause
     if isPause:
       self.pauseTime = time.time()
-      self.connectionsBuffer = list(self.connections)
-      self.connectionCountBuffer = list(self.connectionCount)
-      self.familyResolutionsBuffer = dict(self.familyResolutions)
-    else:
-      self.connections = list(self.connectionsBuffer)
-      self.connectionCount = list(self.connectionCountBuffer)
-      self.familyResolutions = dict(self.familyResolutionsBuffer)
+      self._pausedSnapshot = self._snapshot
+    else: self._pausedSnapshot = None
+    self.connectionsLock.release()
+  
+  def getSnapshot(self):
+    """
+    Provides the ConnSnapshot being displayed, this being the one from when we
+    were paused if we're presently paused.
+    """
+    
+    snapshot = self._pausedSnapshot
+    if snapshot == None: snapshot = self._snapshot
+    return snapshot
+  
+  def exportConnections(self, path, exportFormat = None):
+    """
+    Writes the displayed connections to the given path as either CSV or JSON
+    lines (one object per connection), providing the number of connections
+    written. Scrubbed addresses, ports, and countries are left empty (null in
+    JSON). This overwrites the file if it already exists, and raises an IOError
+    if there's a problem.
+    
+    Rows are written as they're formatted from a snapshot of the connections,
+    so the listing isn't locked while writing and large exports don't need to
+    be held in memory. Fingerprints and nicknames come from our lookup caches
+    without modifying them (see _getExportIdentity).
+    
+    Arguments:
+      path         - path where to save the connections
+      exportFormat - EXPORT_CSV or EXPORT_JSON, if None then this is CSV for
+                     paths ending in ".csv" and JSON lines otherwise
+    """
+    
+    if exportFormat == None:
+      exportFormat = EXPORT_CSV if path.lower().endswith(".csv") else EXPORT_JSON
+    
+    self.connectionsLock.acquire()
+    snapshot = self.getSnapshot()
+    localhostEntry = self.localhostEntry
+    currentTime = self.pauseTime if self.isPaused else time.time()
+    self.connectionsLock.release()
+    
+    # make dir if the path doesn't already exist
+    baseDir = os.path.dirname(path)
+    if baseDir and not os.path.exists(baseDir): os.makedirs(baseDir)
+    
+    exportFile = open(path, "w")
+    rowCount = 0
+    
+    try:
+      if exportFormat == EXPORT_CSV:
+        csvWriter = csv.writer(exportFile)
+        csvWriter.writerow(EXPORT_FIELDS)
       
-      # pause buffer connections may be unsorted
-      if self.listingType != LIST_HOSTNAME: self.sortConnections()
+      for entry in snapshot.connections:
+        fIp, fPort, countryCode = entry[CONN_F_IP], int(entry[CONN_F_PORT]), entry[CONN_COUNTRY]
+        if entry[CONN_PRIVATE]: fIp, fPort, countryCode = None, None, None
+        
+        fingerprint, nickname = self._getExportIdentity(snapshot, localhostEntry, entry[CONN_F_IP], entry[CONN_F_PORT])
+        age = max(0, int(currentTime - entry[CONN_TIME]))
+        
+        record = (entry[CONN_TYPE], entry[CONN_L_IP], int(entry[CONN_L_PORT]), fIp, fPort, countryCode, fingerprint, nickname, age)
+        
+        if exportFormat == EXPORT_CSV:
+          csvWriter.writerow(["" if value == None else value for value in record])
+        else:
+          fields = ["\"%s\": %s" % (EXPORT_FIELDS[i], _getJsonValue(record[i])) for i in range(len(EXPORT_FIELDS))]
+          exportFile.write("{%s}\n" % ", ".join(fields))
+        
+        rowCount += 1
+    finally:
+      exportFile.close()
+    
+    return rowCount
+  
+  def setGrouping(self, groupBy):
+    """
+    Sets the attribute connections are aggregated by, GROUP_NONE for the
+    regular listing. Aggregates are built from the current connections, then
+    adjusted as they change.
+    
+    Arguments:
+      groupBy - GROUP_* enum for how connections should be grouped
+    """
+    
+    self.connectionsLock.acquire()
+    
+    try:
+      if groupBy == self.groupBy: return
+      self.groupBy = groupBy
+      self.scroll = 0
+      
+      if groupBy == GROUP_NONE: self._aggregate = None
+      else: self._aggregate = self._getAggregate(self._snapshot.connections)
+      self._snapshot = _getGroupedSnapshot(self._snapshot, self._aggregate)
+      
+      if self._pausedSnapshot != None:
+        # the paused listing gets its own aggregates so it stays unchanged
+        pausedAggregate = None
+        if groupBy != GROUP_NONE: pausedAggregate = self._getAggregate(self._pausedSnapshot.connections)
+        self._pausedSnapshot = _getGroupedSnapshot(self._pausedSnapshot, pausedAggregate)
+    finally:
+      self.connectionsLock.release()
   
   def sortConnections(self):
     """
     Sorts connections according to currently set ordering. This takes into
-    account secondary and tertiary sub-keys in case of ties.
-    """
-    
-    # Current implementation is very inefficient, but since connection lists
-    # are decently small (count get up to arounk 1k) this shouldn't be a big
-    # whoop. Suggestions for improvements are welcome!
-    
-    sorts = []
-    
-    # wrapper function for using current listed data (for 'LISTING' sorts)
-    if self.listingType == LIST_IP:
-      listingWrapper = lambda ip, port: _ipToInt(ip)
-    elif self.listingType == LIST_HOSTNAME:
-      # alphanumeric hostnames followed by unresolved IP addresses
-      listingWrapper = lambda ip, port: _getHostname(ip).upper() if _getHostname(ip) else "zzzzz%099i" % _ipToInt(ip)
-    elif self.listingType == LIST_FINGERPRINT:
-      # alphanumeric fingerprints followed by UNKNOWN entries
-      listingWrapper = lambda ip, port: self.getFingerprint(ip, port) if self.getFingerprint(ip, port) != "UNKNOWN" else "zzzzz%099i" % _ipToInt(ip)
-    elif self.listingType == LIST_NICKNAME:
-      # alphanumeric nicknames followed by Unnamed then UNKNOWN entries
-      listingWrapper = lambda ip, port: self.getNickname(ip, port) if self.getNickname(ip, port) not in ("UNKNOWN", "Unnamed") else "zzzzz%i%099i" % (0 if self.getNickname(ip, port) == "Unnamed" else 1, _ipToInt(ip))
-    
-    for entry in self.sortOrdering:
-      if entry == ORD_FOREIGN_LISTING:
-        sorts.append(lambda x, y: cmp(listingWrapper(x[CONN_F_IP], x[CONN_F_PORT]), listingWrapper(y[CONN_F_IP], y[CONN_F_PORT])))
-      elif entry == ORD_SRC_LISTING:
-        sorts.append(lambda x, y: cmp(listingWrapper(x[CONN_F_IP] if x[CONN_TYPE] == "inbound" else x[CONN_L_IP], x[CONN_F_PORT]), listingWrapper(y[CONN_F_IP] if y[CONN_TYPE] == "inbound" else y[CONN_L_IP], y[CONN_F_PORT])))
-      elif entry == ORD_DST_LISTING:
-        sorts.append(lambda x, y: cmp(listingWrapper(x[CONN_L_IP] if x[CONN_TYPE] == "inbound" else x[CONN_F_IP], x[CONN_F_PORT]), listingWrapper(y[CONN_L_IP] if y[CONN_TYPE] == "inbound" else y[CONN_F_IP], y[CONN_F_PORT])))
-      else: sorts.append(SORT_TYPES[entry][2])
+    account secondary and tertiary sub-keys in case of ties. Both the current
+    and paused snapshots are sorted (replacing them with sorted copies).
+    
+    Each connection's sort key is computed once and cached until its listing
+    information changes, and snapshots are only resorted if their keys differ
+    from when they were sorted. This is called on each redraw when listing by
+    hostname (since resolutions arrive over time) so that needs to be cheap.
+    """
     
     self.connectionsLock.acquire()
-    try: self.connections.sort(lambda x, y: _multisort(x, y, sorts))
-    finally: self.connectionsLock.release()
-
+    
+    try:
+      sortKeyArgs = (tuple(self.sortOrdering), self.listingType)
+      if sortKeyArgs != self._sortKeyArgs:
+        self._sortKeys, self._sortKeyArgs = {}, sortKeyArgs
+      
+      invalidAddresses = self._invalidSortAddresses
+      self._invalidSortAddresses = set()
+      
+      # only retains cached keys for the connections of our snapshots
+      cachedKeys = {}
+      self._snapshot = self._getSortedSnapshot(self._snapshot, cachedKeys, invalidAddresses)
+      
+      if self._pausedSnapshot != None:
+        self._pausedSnapshot = self._getSortedSnapshot(self._pausedSnapshot, cachedKeys, invalidAddresses)
+      
+      self._sortKeys = cachedKeys
+    finally:
+      self.connectionsLock.release()
+  
+  def _getSortedSnapshot(self, snapshot, cachedKeys, invalidAddresses):
+    """
+    Provides a sorted copy of the given snapshot, or the snapshot itself if
+    it's already sorted.
+    
+    Arguments:
+      snapshot         - ConnSnapshot to be sorted
+      cachedKeys       - mapping of entries to their sort keys, which this
+                         adds the cachable keys of the snapshot's entries to
+      invalidAddresses - addresses whose cached keys are no longer valid
+    """
+    
+    connKeys = []
+    for entry in snapshot.connections:
+      isKeyValid = not (entry[CONN_F_IP] in invalidAddresses or entry[CONN_L_IP] in invalidAddresses)
+      
+      if isKeyValid and entry in self._sortKeys: sortKey = self._sortKeys[entry]
+      elif isKeyValid and entry in cachedKeys: sortKey = cachedKeys[entry]
+      else:
+        sortKey, isFinal = self._getSortKey(entry)
+        if not isFinal:
+          connKeys.append(sortKey)
+          continue
+      
+      cachedKeys[entry] = sortKey
+      connKeys.append(sortKey)
+    
+    if connKeys == snapshot.sortKeys: return snapshot
+    
+    sortedEntries = zip(connKeys, snapshot.connections)
+    sortedEntries.sort(key = lambda x: x[0])
+    
+    sortedConnections = [entry for sortKey, entry in sortedEntries]
+    sortedKeys = [sortKey for sortKey, entry in sortedEntries]
+    return ConnSnapshot(sortedConnections, snapshot.connectionCount, snapshot.familyResolutions, sortedKeys, snapshot.groups)
+  
+  def _getAggregate(self, connections):
+    """
+    Provides a ConnAggregate for our grouping, populated with the given
+    connections.
+    
+    Arguments:
+      connections - connection entries to be added
+    """
+    
+    aggregate = ConnAggregate(self.groupBy)
+    for entry in connections:
+      if entry[CONN_TYPE] in CONN_COUNT_LABELS:
+        aggregate.add((entry[CONN_F_IP], entry[CONN_F_PORT]), CONN_COUNT_LABELS.index(entry[CONN_TYPE]), self._getGroupLabel(entry, aggregate.groupBy), entry)
+    
+    return aggregate
+  
+  def _regroupConnections(self, connKeys = None):
+    """
+    Recomputes the family groups of the given connections, since they're
+    derived from fingerprint resolutions and descriptors that have changed.
+    This is a no-op unless we're grouping by family.
+    
+    Arguments:
+      connKeys - (foreign ip, foreign port) tuples of the connections, all of
+                 them if None
+    """
+    
+    self.connectionsLock.acquire()
+    
+    try:
+      aggregate = self._aggregate
+      if not aggregate or aggregate.groupBy != GROUP_FAMILY: return
+      
+      members = aggregate.getMembers(connKeys)
+      for entry in members:
+        connKey, typeIndex = (entry[CONN_F_IP], entry[CONN_F_PORT]), CONN_COUNT_LABELS.index(entry[CONN_TYPE])
+        aggregate.add(connKey, typeIndex, self._getGroupLabel(entry, GROUP_FAMILY), entry)
+      
+      if members: self._snapshot = _getGroupedSnapshot(self._snapshot, aggregate)
+    finally:
+      self.connectionsLock.release()
+  
+  def _getExportIdentity(self, snapshot, localhostEntry, ipAddr, port):
+    """
+    Provides the (fingerprint, nickname) for a connection being exported. This
+    is a read-only version of getFingerprint and getNickname (which populate
+    caches that are also modified by other threads) so it's safe to call
+    without the connectionsLock. Resolutions that aren't cached are made only
+    if the consensus has a single relay at the address or one with this
+    ORPort, being "UNKNOWN" otherwise.
+    
+    Arguments:
+      snapshot       - ConnSnapshot being exported
+      localhostEntry - localhostEntry from when the snapshot was taken
+      ipAddr         - foreign address of the connection
+      port           - foreign port of the connection
+    """
+    
+    torConn = torTools.getConn()
+    
+    if localhostEntry and ipAddr == localhostEntry[0][CONN_L_IP] and port == localhostEntry[0][CONN_L_PORT]:
+      fingerprint = localhostEntry[1]
+    elif (ipAddr, port) in snapshot.familyResolutions:
+      fingerprint = snapshot.familyResolutions[(ipAddr, port)]
+    else:
+      fingerprint = self.fingerprintLookupCache.get((ipAddr, int(port)))
+      
+      if fingerprint == None:
+        potentialMatches = torConn.getRelaysAt(ipAddr)
+        relayRecord = torConn.getRelayAt(ipAddr, port)
+        
+        if len(potentialMatches) == 1: fingerprint = potentialMatches[0][torTools.RELAY_FINGERPRINT]
+        elif relayRecord: fingerprint = relayRecord[torTools.RELAY_FINGERPRINT]
+        else: fingerprint = "UNKNOWN"
+    
+    nickname = self.nicknameLookupCache.get((ipAddr, port))
+    if nickname == None:
+      relayRecord = None
+      if fingerprint != "UNKNOWN": relayRecord = torConn.getRelay(fingerprint)
+      nickname = relayRecord[torTools.RELAY_NICKNAME] if relayRecord else "UNKNOWN"
+    
+    return (fingerprint, nickname)
+  
+  def _getGroupLabel(self, entry, groupBy):
+    """
+    Provides the group the given connection belongs to. Scrubbed connections
+    are grouped together so aggregates don't reveal their details.
+    
+    Arguments:
+      entry   - connection entry
+      groupBy - GROUP_* enum for the attribute being grouped by
+    """
+    
+    if groupBy == GROUP_FAMILY:
+      fingerprint = self.getFingerprint(entry[CONN_F_IP], entry[CONN_F_PORT])
+      if fingerprint == "UNKNOWN": return "not a relay"
+      return self._getFamilyLabel(fingerprint)
+    elif entry[CONN_PRIVATE]: return "<scrubbed>"
+    elif groupBy == GROUP_COUNTRY: return entry[CONN_COUNTRY]
+    elif groupBy == GROUP_PORT: return entry[CONN_F_PORT]
+    else: return "%s.0.0/16" % ".".join(entry[CONN_F_IP].split(".")[:2])
+  
+  def _getFamilyLabel(self, fingerprint):
+    """
+    Provides a label for the family the given relay declares in its
+    descriptor, this being the family member with the lowest fingerprint. This
+    is cached until we get a NEWDESC event for the relay.
+    
+    Arguments:
+      fingerprint - relay fingerprint to be looked up
+    """
+    
+    if fingerprint in self._familyKeys: return self._familyKeys[fingerprint]
+    
+    torConn = torTools.getConn()
+    familyKey = fingerprint
+    
+    # members are either nicknames or "$<fingerprint>" (optionally followed by
+    # "=<nickname>" or "~<nickname>"), only the later can be compared
+    for member in torConn.getRelayDescriptorField(fingerprint, "family", "").split():
+      if member.startswith("$") and len(member) >= 41:
+        familyKey = min(familyKey, member[1:41].upper())
+    
+    relayRecord = torConn.getRelay(familyKey)
+    nickname = relayRecord[torTools.RELAY_NICKNAME] if relayRecord else "UNKNOWN"
+    familyLabel = "%s ($%s)" % (nickname, familyKey[:8])
+    
+    self._familyKeys[fingerprint] = familyLabel
+    return familyLabel
+  
+  def _getSortKey(self, entry):
+    """
+    Provides a tuple of the form (sort key, isFinal) for the given connection
+    entry with the current ordering and listing type. The key's only cachable
+    if isFinal is true, otherwise it might change without notice (for
+    instance, if a hostname's being resolved).
+    
+    Arguments:
+      entry - connection entry to provide the sort key for
+    """
+    
+    sortKey, isFinal = [], True
+    
+    for sortType in self.sortOrdering:
+      if sortType == ORD_FOREIGN_LISTING: ipAddr = entry[CONN_F_IP]
+      elif sortType == ORD_SRC_LISTING: ipAddr = entry[CONN_F_IP] if entry[CONN_TYPE] == "inbound" else entry[CONN_L_IP]
+      elif sortType == ORD_DST_LISTING: ipAddr = entry[CONN_L_IP] if entry[CONN_TYPE] == "inbound" else entry[CONN_F_IP]
+      else:
+        sortKey.append(SORT_TYPES[sortType][2](entry))
+        continue
+      
+      port = entry[CONN_F_PORT]
+      
+      if self.listingType == LIST_IP:
+        sortKey.append(_ipToInt(ipAddr))
+      elif self.listingType == LIST_HOSTNAME:
+        # alphanumeric hostnames followed by unresolved IP addresses
+        try:
+          hostname = hostnames.resolve(ipAddr)
+          if hostname == None: isFinal = False # resolution's pending
+        except ValueError: hostname = None
+        
+        if hostname: sortKey.append(hostname.upper())
+        else: sortKey.append("zzzzz%099i" % _ipToInt(ipAddr))
+      elif self.listingType == LIST_FINGERPRINT:
+        # alphanumeric fingerprints followed by UNKNOWN entries
+        fingerprint = self.getFingerprint(ipAddr, port)
+        if fingerprint != "UNKNOWN": sortKey.append(fingerprint)
+        else: sortKey.append("zzzzz%099i" % _ipToInt(ipAddr))
+      elif self.listingType == LIST_NICKNAME:
+        # alphanumeric nicknames followed by Unnamed then UNKNOWN entries
+        nickname = self.getNickname(ipAddr, port)
+        if nickname not in ("UNKNOWN", "Unnamed"): sortKey.append(nickname)
+        else: sortKey.append("zzzzz%i%099i" % (0 if nickname == "Unnamed" else 1, _ipToInt(ipAddr)))
+        
+        # unresolved nicknames aren't cached by getNickname
+        if not (ipAddr, port) in self.nicknameLookupCache: isFinal = False
+    
+    return (tuple(sortKey), isFinal)
+  
+  def _invalidateLookups(self, fingerprints, addresses = ()):
+    """
+    Drops cached fingerprint and nickname resolutions involving any of the
+    given relays or addresses, resorting if anything's changed. Matching
+    entries are found via reverse indexes so this is proportional to the
+    number of invalidated resolutions rather than the cache size (events are
+    batched, so this can be called with hundreds of relays).
+    
+    Arguments:
+      fingerprints - relays whose resolutions are invalid
+      addresses    - addresses whose resolutions are invalid
+    """
+    
+    invalidEntries = set()
+    for fingerprint in fingerprints:
+      invalidEntries.update(self._fingerprintLookupKeys.get(fingerprint, ()))
+    
+    for address in addresses:
+      invalidEntries.update(self._addressLookupKeys.get(address, ()))
+    
+    for k in invalidEntries:
+      fingerprint = self.fingerprintLookupCache.pop(k, None)
+      
+      fingerprintKeys = self._fingerprintLookupKeys.get(fingerprint)
+      if fingerprintKeys != None:
+        fingerprintKeys.discard(k)
+        if not fingerprintKeys: del self._fingerprintLookupKeys[fingerprint]
+      
+      addressKeys = self._addressLookupKeys.get(k[0])
+      if addressKeys != None:
+        addressKeys.discard(k)
+        if not addressKeys: del self._addressLookupKeys[k[0]]
+      
+      # nicknameLookupCache keys are a subset of fingerprintLookupCache, but
+      # with the port as a string
+      nicknameKey = (k[0], str(k[1]))
+      if nicknameKey in self.nicknameLookupCache: del self.nicknameLookupCache[nicknameKey]
+    
+    # sort keys of connections with these addresses might be based on the
+    # dropped resolutions, so they're recomputed with the next sort
+    if invalidEntries:
+      self.connectionsLock.acquire()
+      self._invalidSortAddresses.update([k[0] for k in invalidEntries])
+      self.connectionsLock.release()
+      
+      # family groups are likewise based on these resolutions (this includes
+      # relays with a new descriptor, whose _familyKeys have been dropped)
+      self._regroupConnections([(k[0], str(k[1])) for k in invalidEntries])
+    
+    if invalidEntries and self.listingType != LIST_HOSTNAME: self.sortConnections()
+  
   def _resolveFamilyEntries(self):
     """
     Populates mappings of the torrc family entries to their fingerprints.
@@ -856,24 +1490,33 @@ class ConnPanel(TorCtl.PostEventListener, panel.Panel):
         self.familyFingerprints[familyEntry] = familyEntry[1:]
       else:
         # relay identified by nickname
-        descEntry = torTools.getConn().getInfo("desc/name/%s" % familyEntry)
-        
-        if descEntry:
-          fingerprintStart = descEntry.find("opt fingerprint") + 16
-          fingerprintEnd = descEntry.find("\n", fingerprintStart)
-          fingerprint = descEntry[fingerprintStart:fingerprintEnd].replace(" ", "")
-          
-          self.familyFingerprints[familyEntry] = fingerprint
+        fingerprint = torTools.getConn().getRelayFingerprint(familyEntry)
+        if fingerprint: self.familyFingerprints[familyEntry] = fingerprint
 
-# recursively checks primary, secondary, and tertiary sorting parameter in ties
-def _multisort(conn1, conn2, sorts):
-  comp = sorts[0](conn1, conn2)
-  if comp or len(sorts) == 1: return comp
-  else: return _multisort(conn1, conn2, sorts[1:])
+def _getGroupedSnapshot(snapshot, aggregate):
+  """
+  Provides a copy of the snapshot with the groups of the given aggregate.
+  
+  Arguments:
+    snapshot  - ConnSnapshot to be copied
+    aggregate - ConnAggregate to be listed, the copy isn't grouped if None
+  """
+  
+  groups = None
+  if aggregate: groups = aggregate.getGroups()
+  return ConnSnapshot(snapshot.connections, snapshot.connectionCount, snapshot.familyResolutions, snapshot.sortKeys, groups)
 
-def _getHostname(ipAddr):
-  try: return hostnames.resolve(ipAddr)
-  except ValueError: return None
+def _getJsonValue(value):
+  """
+  Provides the JSON encoding for the given string, integer, or None.
+  
+  Arguments:
+    value - value to be encoded
+  """
+  
+  if value == None: return "null"
+  elif isinstance(value, (int, long)): return str(value)
+  else: return "\"%s\"" % JSON_ESCAPED_CHARS.sub(lambda match: "\\u%04x" % ord(match.group(0)), str(value))
 
 # provides comparison int for sorting IP addresses
 def _ipToInt(ipAddr):
@@ -883,86 +1526,147 @@ def _ipToInt(ipAddr):
     total += int(comp)
   return total
 
-# uses consensus data to map IP addresses to port / fingerprint combinations
-def _getFingerprintMappings(conn, nsList = None):
-  ipToFingerprint = {}
-  
-  if not nsList:
-    try: nsList = conn.get_network_status()
-    except (socket.error, TorCtl.TorCtlClosed, TorCtl.ErrorReply): nsList = []
-    except TypeError: nsList = [] # TODO: temporary workaround for a TorCtl bug, remove when fixed
-  
-  for entry in nsList:
-    if entry.ip in ipToFingerprint.keys(): ipToFingerprint[entry.ip].append((entry.orport, entry.idhex, entry.nickname))
-    else: ipToFingerprint[entry.ip] = [(entry.orport, entry.idhex, entry.nickname)]
-  
-  return ipToFingerprint
-
 # provides client relays we're currently attached to (first hops in circuits)
 # this consists of the nicknames and ${fingerprint} if unnamed
 def _getClientConnections(conn):
   clients = []
   
-  try:
-    for line in conn.get_info("circuit-status")["circuit-status"].split("\n"):
-      components = line.split()
-      if len(components) > 3: clients += [components[2].split(",")[0]]
-  except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed): pass
+  for line in torTools.getConn().getInfo("circuit-status", "").split("\n"):
+    components = line.split()
+    if len(components) > 3: clients += [components[2].split(",")[0]]
   
   return clients
 
-def isExitAllowed(ip, port, exitPolicy, isPrivateRejected):
+def isPrivateAddress(ipAddr):
   """
-  Determines if a given connection is a permissable exit with the given 
-  policy or not (True if it's allowed to be an exit connection, False 
-  otherwise).
+  True if the address belongs to a private network (10.0.0.0/8,
+  172.16.0.0/12, or 192.168.0.0/16), false otherwise.
   
-  NOTE: this is a little tricky and liable to need some tweaks
+  Arguments:
+    ipAddr - ipv4 address to be checked
   """
   
-  # might not be set when first starting up
-  if not exitPolicy: return True
+  try: ipInt = struct.unpack("!L", socket.inet_aton(ipAddr))[0]
+  except (socket.error, struct.error): return False
+  
+  for network, netmask in PRIVATE_NETWORKS:
+    if ipInt & netmask == network: return True
   
-  # TODO: move into a utility and craft some unit tests (this is very error 
-  # prone...)
+  return False
+
+class ExitPolicy:
+  """
+  Exit policy compiled into ordered rules, for determining if connections are
+  permissible exits. Decisions are memoized per (address, port) since the
+  same connections are checked on each refresh.
+  """
   
-  # TODO: currently doesn't consider ExitPolicyRejectPrivate (which prevents 
-  # connections to private networks and local ip)
-  for entry in exitPolicy.split(","):
-    entry = entry.strip()
+  def __init__(self, exitPolicy, isPrivateRejected):
+    """
+    Compiles the given policy.
     
-    isAccept = entry.startswith("accept")
-    entry = entry[7:] # strips off "accept " or "reject "
+    Arguments:
+      exitPolicy        - comma separated policy entries like
+                          "reject 10.0.0.0/8:*" (this includes tor's default
+                          policy if appended)
+      isPrivateRejected - prepends a "reject private:*" rule if true (tor's
+                          ExitPolicyRejectPrivate option)
+    """
     
-    # parses ip address (with mask if provided) and port
-    if ":" in entry:
-      entryIP = entry[:entry.find(":")]
-      entryPort = entry[entry.find(":") + 1:]
-    else:
-      entryIP = entry
-      entryPort = "*"
+    # rules are tuples of the form:
+    # (isAccept, network, netmask, minPort, maxPort)
+    self.rules = []
+    self.isEmpty = not exitPolicy # might not be set when first starting up
+    self._decisions = {}
     
-    #raise AssertionError(str(exitPolicy) + " - " + entryIP + ":" + entryPort)
-    isIPMatch = entryIP == ip or entryIP[0] == "*"
+    if isPrivateRejected: self._addRule(False, "private", 1, 65535)
     
-    if not "-" in entryPort:
-      # single port
-      isPortMatch = entryPort == str(port) or entryPort[0] == "*"
-    else:
-      # port range
-      minPort = int(entryPort[:entryPort.find("-")])
-      maxPort = int(entryPort[entryPort.find("-") + 1:])
-      isPortMatch = port >= minPort and port <= maxPort
+    for entry in exitPolicy.split(","):
+      entry = entry.strip()
+      if not entry.startswith(("accept ", "reject ")): continue
+      
+      isAccept = entry.startswith("accept")
+      entry = entry[7:].strip() # strips off "accept " or "reject "
+      
+      # parses address (with mask if provided) and port
+      if ":" in entry: entryAddr, entryPort = entry.split(":", 1)
+      else: entryAddr, entryPort = entry, "*"
+      
+      try:
+        if entryPort == "*": minPort, maxPort = 1, 65535
+        elif "-" in entryPort:
+          minPort, maxPort = [int(port) for port in entryPort.split("-", 1)]
+        else: minPort = maxPort = int(entryPort)
+      except ValueError: minPort, maxPort = 1, 65535
+      
+      self._addRule(isAccept, entryAddr, minPort, maxPort)
+  
+  def isExitAllowed(self, ipAddr, port):
+    """
+    True if the policy permits exiting to the given destination, false
+    otherwise.
+    
+    Arguments:
+      ipAddr - destination ipv4 address
+      port   - destination port
+    """
+    
+    if self.isEmpty: return True
+    
+    port = int(port)
+    if (ipAddr, port) in self._decisions: return self._decisions[(ipAddr, port)]
+    
+    try: ipInt = struct.unpack("!L", socket.inet_aton(ipAddr))[0]
+    except (socket.error, struct.error): ipInt = None
+    
+    isAllowed = None
+    for isAccept, network, netmask, minPort, maxPort in self.rules:
+      if minPort <= port <= maxPort and (netmask == 0 or (ipInt != None and ipInt & netmask == network)):
+        isAllowed = isAccept
+        break
     
-    # TODO: Currently being lazy and considering subnet masks or 'private' 
-    # keyword to be equivilant to wildcard if it would reject, and none 
-    # if it would accept (ie, being conservative with acceptance). Would be 
-    # nice to fix at some point.
-    if not isAccept: isIPMatch |= "/" in entryIP or entryIP == "private"
+    if isAllowed == None:
+      # we shouldn't ever fall through due to default exit policy
+      log.log(log.WARN, "Exit policy left connection uncategorized: %s:%i" % (ipAddr, port))
+      isAllowed = False
     
-    if isIPMatch and isPortMatch: return isAccept
+    if len(self._decisions) >= EXIT_POLICY_CACHE_SIZE: self._decisions.clear()
+    self._decisions[(ipAddr, port)] = isAllowed
+    return isAllowed
   
-  # we shouldn't ever fall through due to default exit policy
-  log.log(log.WARN, "Exit policy left connection uncategorized: %s:%i" % (ip, port))
-  return False
-
+  def _addRule(self, isAccept, entryAddr, minPort, maxPort):
+    """
+    Appends rules for the given policy address, this being "*", "private", or
+    an address with an optional mask (either bit count or dotted quad).
+    Addresses we can't parse (like ipv6 entries) are treated as wildcards if
+    accepting and skipped if rejecting, so we err on the side of considering
+    connections to be exits.
+    
+    Arguments:
+      isAccept  - true if this is an accept rule, false if reject
+      entryAddr - address portion of the policy entry
+      minPort   - start of the rule's port range
+      maxPort   - end of the rule's port range
+    """
+    
+    if entryAddr == "*":
+      self.rules.append((isAccept, 0, 0, minPort, maxPort))
+    elif entryAddr == "private":
+      for network, netmask in POLICY_PRIVATE_NETWORKS:
+        self.rules.append((isAccept, network, netmask, minPort, maxPort))
+    else:
+      try:
+        if "/" in entryAddr:
+          entryAddr, entryMask = entryAddr.split("/", 1)
+          
+          if "." in entryMask: netmask = struct.unpack("!L", socket.inet_aton(entryMask))[0]
+          else:
+            maskBits = int(entryMask)
+            if not 0 <= maskBits <= 32: raise ValueError
+            netmask = (0xFFFFFFFFL << (32 - maskBits)) & 0xFFFFFFFFL
+        else: netmask = 0xFFFFFFFFL
+        
+        network = struct.unpack("!L", socket.inet_aton(entryAddr))[0] & netmask
+        self.rules.append((isAccept, network, netmask, minPort, maxPort))
+      except (ValueError, socket.error, struct.error):
+        if isAccept: self.rules.append((isAccept, 0, 0, minPort, maxPort))
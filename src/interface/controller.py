@@ -22,6 +22,7 @@ import logPanel
 import connPanel
 import configPanel
 import torrcPanel
+import diagnosticsPanel
 import descriptorPopup
 import fileDescriptorPopup
 
@@ -43,9 +44,15 @@ PAGES = [
   ["graph", "log"],
   ["conn"],
   ["config"],
-  ["torrc"]]
+  ["torrc"],
+  ["diagnostics"]]
 PAUSEABLE = ["header", "graph", "log", "conn"]
 
+# Tor events that can arrive by the thousands, which are only requested while
+# they'd be seen (the log panel is visible or events are being saved to a
+# file). Otherwise tor would serialize them just for us to drop them.
+VERBOSE_EVENTS = ("DEBUG", "INFO", "STREAM", "STREAM_BW", "ORCONN", "ADDRMAP")
+
 CONFIG = {"log.torrc.readFailed": log.WARN,
           "features.graph.type": 1,
           "features.config.prepopulateEditValues": True,
@@ -361,7 +368,17 @@ def showSortDialog(stdscr, panels, isPaused, page, titleLabel, options, oldSelec
     return newSelections
   else: return None
 
-def setEventListening(selectedEvents, isBlindMode):
+def setEventListening(selectedEvents, isBlindMode, isVerbose = True):
+  """
+  Requests the selected events from tor (along with those arm requires),
+  providing the selected events minus any that tor doesn't support.
+  
+  Arguments:
+    selectedEvents - set of event types selected for logging
+    isBlindMode    - true if the connection panel isn't being used
+    isVerbose      - if false then VERBOSE_EVENTS are omitted from the request
+  """
+  
   # creates a local copy, note that a suspected python bug causes *very*
   # puzzling results otherwise when trying to discard entries (silently
   # returning out of this function!)
@@ -379,6 +396,8 @@ def setEventListening(selectedEvents, isBlindMode):
   if isLoggingUnknown:
     events.update(set(logPanel.getMissingEventTypes()))
   
+  if not isVerbose: events.difference_update(VERBOSE_EVENTS)
+  
   setEvents = torTools.getConn().setControllerEvents(list(events))
   
   # temporary hack for providing user selected events minus those that failed
@@ -387,6 +406,18 @@ def setEventListening(selectedEvents, isBlindMode):
   returnVal.sort() # alphabetizes
   return returnVal
 
+def isVerboseListeningWanted(panels, page):
+  """
+  True if VERBOSE_EVENTS would be seen on the given page, either due to the log
+  panel being visible or events being saved to a log file.
+  
+  Arguments:
+    panels - mapping of panel names to their instances
+    page   - index of the page being displayed
+  """
+  
+  return "log" in PAGES[page] or panels["log"].logFile != None
+
 def connResetListener(conn, eventType):
   """
   Pauses connection resolution when tor's shut down, and resumes if started
@@ -397,6 +428,38 @@ def connResetListener(conn, eventType):
     resolver = connections.getResolver("tor")
     resolver.setPaused(eventType == torTools.TOR_CLOSED)
 
+def getDescriptorSummary(descriptor):
+  """
+  Provides the server descriptor fields shown in the connection details popup,
+  as a tuple of the form:
+  (dirPort, published, os, version, contact, exitPolicy)
+  
+  The exit policy is a list of its accept/reject rules. Fields missing from
+  the descriptor are "unknown" (zero for the dirPort and None for the contact).
+  
+  Arguments:
+    descriptor - raw server descriptor (desc/id/*)
+  """
+  
+  dirPort, published, osLabel, version, contact, exitPolicy = 0, "unknown", "unknown", "unknown", None, []
+  
+  for line in descriptor.split("\n"):
+    if line.startswith("opt "): line = line[4:]
+    
+    if line.startswith("router "):
+      # router <nickname> <address> <ORPort> <SOCKSPort> <DirPort>
+      comp = line.split()
+      if len(comp) > 5 and comp[5].isdigit(): dirPort = int(comp[5])
+    elif line.startswith("published "): published = line[10:]
+    elif line.startswith("platform "):
+      # platform Tor <version> on <os>
+      platformMatch = re.match("^platform Tor (\S*).* on (.*)$", line)
+      if platformMatch: version, osLabel = platformMatch.groups()
+    elif line.startswith("contact "): contact = line[8:]
+    elif line.startswith("accept ") or line.startswith("reject "): exitPolicy.append(line)
+  
+  return (dirPort, published, osLabel, version, contact, exitPolicy)
+
 def selectiveRefresh(panels, page):
   """
   This forces a redraw of content on the currently active page (should be done
@@ -555,6 +618,7 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
   panels["control"] = ControlPanel(stdscr, isBlindMode)
   panels["config"] = configPanel.ConfigPanel(stdscr, configPanel.TOR_STATE, config)
   panels["torrc"] = torrcPanel.TorrcPanel(stdscr, torrcPanel.TORRC, config)
+  panels["diagnostics"] = diagnosticsPanel.DiagnosticsPanel(stdscr, config)
   
   # provides error if pid coulnd't be determined (hopefully shouldn't happen...)
   if not torPid: log.log(log.WARN, "Unable to resolve tor pid, abandoning connection listing")
@@ -574,11 +638,11 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
   # listeners that update bandwidth and log panels with Tor status
   sighupTracker = sighupListener()
   #conn.add_event_listener(panels["log"])
-  conn.add_event_listener(panels["graph"].stats["bandwidth"])
-  conn.add_event_listener(panels["graph"].stats["system resources"])
-  if not isBlindMode: conn.add_event_listener(panels["graph"].stats["connections"])
-  conn.add_event_listener(panels["conn"])
-  conn.add_event_listener(sighupTracker)
+  torTools.getConn().addEventListener(panels["graph"].stats["bandwidth"])
+  torTools.getConn().addEventListener(panels["graph"].stats["system resources"])
+  if not isBlindMode: torTools.getConn().addEventListener(panels["graph"].stats["connections"])
+  torTools.getConn().addEventListener(panels["conn"], ("NEWDESC", "NS", "NEWCONSENSUS", "CIRC"))
+  torTools.getConn().addEventListener(sighupTracker)
   
   # prepopulates bandwidth values from state file
   if CONFIG["features.graph.bw.prepopulate"]:
@@ -606,19 +670,19 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
   panels["log"].start()
   
   # warns if tor isn't updating descriptors
-  try:
-    if conn.get_option("FetchUselessDescriptors")[0][1] == "0" and conn.get_option("DirPort")[0][1] == "0":
-      warning = """Descriptors won't be updated (causing some connection information to be stale) unless:
+  torConn = torTools.getConn()
+  if torConn.getOption("FetchUselessDescriptors") == "0" and torConn.getOption("DirPort") == "0":
+    warning = """Descriptors won't be updated (causing some connection information to be stale) unless:
   a. 'FetchUselessDescriptors 1' is set in your torrc
   b. the directory service is provided ('DirPort' defined)
   c. or tor is used as a client"""
-      log.log(log.WARN, warning)
-  except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed): pass
+    log.log(log.WARN, warning)
   
   isUnresponsive = False    # true if it's been over ten seconds since the last BW event (probably due to Tor closing)
   isPaused = False          # if true updates are frozen
   overrideKey = None        # immediately runs with this input rather than waiting for the user if set
   page = 0
+  isVerboseListening = True     # if tor's providing VERBOSE_EVENTS
   regexFilters = []             # previously used log regex filters
   panels["popup"].redraw(True)  # hack to make sure popup has a window instance (not entirely sure why...)
   
@@ -667,6 +731,15 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
         #panels["torrc"].loadConfig()
         sighupTracker.isReset = False
       
+      # if torTools has reattached to tor then uses the new TorCtl instance
+      # (this checks the reference directly since getTorCtl needs the connLock,
+      # which is held during control port round trips)
+      currentConn = torTools.getConn().conn
+      if currentConn and currentConn != conn:
+        conn = currentConn
+        panels["conn"].conn = conn
+        panels["conn"].resetOptions()
+      
       # gives panels a chance to take advantage of the maximum bounds
       # originally this checked in the bounds changed but 'recreate' is a no-op
       # if panel properties are unchanged and checking every redraw is more
@@ -813,6 +886,11 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
       # (otherwise they'll wait on the curses lock which might get demanding)
       setPauseState(panels, isPaused, page)
       
+      # only requests verbose events from tor while we'd use them
+      if isVerboseListeningWanted(panels, page) != isVerboseListening:
+        isVerboseListening = not isVerboseListening
+        setEventListening(set(loggedEvents), isBlindMode, isVerboseListening)
+      
       panels["control"].page = page + 1
       
       # TODO: this redraw doesn't seem necessary (redraws anyway after this
@@ -918,9 +996,13 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
           popup.addfstr(5, 41, "<b>s</b>: sort ordering")
           popup.addfstr(6, 2, "<b>c</b>: client circuits")
           
+          groupLabel = connPanel.GROUP_LABEL[panels["conn"].groupBy].lower()
+          popup.addfstr(6, 41, "<b>g</b>: group connections (<b>%s</b>)" % groupLabel)
+          popup.addfstr(7, 41, "<b>e</b>: export connections")
+          
           #popup.addfstr(5, 41, "c: toggle cursor (<b>%s</b>)" % ("on" if panels["conn"].isCursorEnabled else "off"))
           
-          pageOverrideKeys = (ord('d'), ord('l'), ord('s'), ord('c'))
+          pageOverrideKeys = (ord('d'), ord('l'), ord('s'), ord('c'), ord('g'), ord('e'))
         elif page == 2:
           popup.addfstr(1, 2, "<b>up arrow</b>: scroll up a line")
           popup.addfstr(1, 41, "<b>down arrow</b>: scroll down a line")
@@ -944,6 +1026,14 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
           
           popup.addfstr(4, 2, "<b>r</b>: reload torrc")
           popup.addfstr(4, 41, "<b>x</b>: reset tor (issue sighup)")
+        elif page == 4:
+          popup.addfstr(1, 2, "<b>up arrow</b>: scroll up a line")
+          popup.addfstr(1, 41, "<b>down arrow</b>: scroll down a line")
+          popup.addfstr(2, 2, "<b>page up</b>: scroll up a page")
+          popup.addfstr(2, 41, "<b>page down</b>: scroll down a page")
+          
+          sortLabel = diagnosticsPanel.SORT_LABELS[panels["diagnostics"].sortOrder].lower()
+          popup.addfstr(3, 2, "<b>s</b>: command ordering (<b>%s</b>)" % sortLabel)
         
         popup.addstr(7, 2, "Press any key...")
         popup.refresh()
@@ -1104,7 +1194,7 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
         if eventsInput:
           try:
             expandedEvents = logPanel.expandEvents(eventsInput)
-            loggedEvents = setEventListening(expandedEvents, isBlindMode)
+            loggedEvents = setEventListening(expandedEvents, isBlindMode, isVerboseListening)
             panels["log"].setLoggedEvents(loggedEvents)
           except ValueError, exc:
             panels["control"].setMsg("Invalid flags: %s" % str(exc), curses.A_STANDOUT)
@@ -1220,7 +1310,7 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
       panels["control"].resolvingCounter = -1
       hostnames.setPaused(True)
       panels["conn"].sortConnections()
-    elif page == 1 and panels["conn"].isCursorEnabled and key in (curses.KEY_ENTER, 10, ord(' ')):
+    elif page == 1 and panels["conn"].isCursorEnabled and panels["conn"].groupBy == connPanel.GROUP_NONE and key in (curses.KEY_ENTER, 10, ord(' ')):
       # provides details on selected connection
       panel.CURSES_LOCK.acquire()
       try:
@@ -1233,7 +1323,6 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
         panels["conn"].redraw(True)
         
         hostnames.setPaused(not panels["conn"].allowDNS)
-        relayLookupCache = {} # temporary cache of entry -> (ns data, desc data)
         
         curses.cbreak() # wait indefinitely for key presses (no timeout)
         key = 0
@@ -1244,7 +1333,7 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
           popup.addstr(0, 0, "Connection Details:", curses.A_STANDOUT)
           
           selection = panels["conn"].cursorSelection
-          if not selection or not panels["conn"].connections: break
+          if not selection or not panels["conn"].getSnapshot().connections: break
           selectionColor = connPanel.TYPE_COLORS[selection[connPanel.CONN_TYPE]]
           format = uiTools.getColor(selectionColor) | curses.A_BOLD
           
@@ -1287,16 +1376,17 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
             fingerprint = panels["conn"].getFingerprint(selectedIp, selectedPort)
             
             if fingerprint == "UNKNOWN":
-              if selectedIp not in panels["conn"].fingerprintMappings.keys():
+              matchings = torTools.getConn().getRelaysAt(selectedIp)
+              
+              if not matchings:
                 # no consensus entry for this ip address
                 popup.addstr(3, 2, "No consensus data found", format)
               else:
                 # couldn't resolve due to multiple matches - list them all
                 popup.addstr(3, 2, "Muliple matches, possible fingerprints are:", format)
-                matchings = panels["conn"].fingerprintMappings[selectedIp]
-                
                 line = 4
-                for (matchPort, matchFingerprint, matchNickname) in matchings:
+                for relayRecord in matchings:
+                  matchPort, matchFingerprint = relayRecord[torTools.RELAY_OR_PORT], relayRecord[torTools.RELAY_FINGERPRINT]
                   popup.addstr(line, 2, "%i. or port: %-5s fingerprint: %s" % (line - 3, matchPort, matchFingerprint), format)
                   line += 1
                   
@@ -1305,51 +1395,34 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
                     break
             else:
               # fingerprint found - retrieve related data
-              lookupErrored = False
-              if selection in relayLookupCache.keys(): nsEntry, descEntry = relayLookupCache[selection]
-              else:
-                try:
-                  nsCall = conn.get_network_status("id/%s" % fingerprint)
-                  if len(nsCall) == 0: raise TorCtl.ErrorReply() # no results provided
-                except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed):
-                  # ns lookup fails or provides empty results - can happen with
-                  # localhost lookups if relay's having problems (orport not
-                  # reachable) and this will be empty if network consensus
-                  # couldn't be fetched
-                  lookupErrored = True
-                
-                if not lookupErrored and nsCall:
-                  if len(nsCall) > 1:
-                    # multiple records for fingerprint (shouldn't happen)
-                    log.log(log.WARN, "Multiple consensus entries for fingerprint: %s" % fingerprint)
-                  
-                  nsEntry = nsCall[0]
-                  
-                  try:
-                    descLookupCmd = "desc/id/%s" % fingerprint
-                    descEntry = TorCtl.Router.build_from_desc(conn.get_info(descLookupCmd)[descLookupCmd].split("\n"), nsEntry)
-                    relayLookupCache[selection] = (nsEntry, descEntry)
-                  except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed): lookupErrored = True # desc lookup failed
+              # consensus entry is missing if the network consensus couldn't be
+              # fetched, or for localhost lookups if the relay's having problems
+              # (orport not reachable), and descriptors are cached by torTools
+              # so redrawing doesn't query tor again
+              torConn = torTools.getConn()
+              relayRecord, descriptor = torConn.getRelay(fingerprint), None
+              if relayRecord: descriptor = torConn.getRelayDescriptor(fingerprint)
               
-              if lookupErrored:
+              if not descriptor:
                 popup.addstr(3, 2, "Unable to retrieve consensus data", format)
               else:
                 popup.addstr(2, 15, "fingerprint: %s" % fingerprint, format)
+                dirPort, published, osLabel, version, contact, exitPolicy = getDescriptorSummary(descriptor)
                 
                 nickname = panels["conn"].getNickname(selectedIp, selectedPort)
-                dirPortLabel = "dirport: %i" % nsEntry.dirport if nsEntry.dirport else ""
-                popup.addstr(3, 2, "nickname: %-25s orport: %-10i %s" % (nickname, nsEntry.orport, dirPortLabel), format)
+                dirPortLabel = "dirport: %i" % dirPort if dirPort else ""
+                popup.addstr(3, 2, "nickname: %-25s orport: %-10i %s" % (nickname, relayRecord[torTools.RELAY_OR_PORT], dirPortLabel), format)
                 
-                popup.addstr(4, 2, "published: %-24s os: %-14s version: %s" % (descEntry.published, descEntry.os, descEntry.version), format)
-                popup.addstr(5, 2, "flags: %s" % ", ".join(nsEntry.flags), format)
+                popup.addstr(4, 2, "published: %-24s os: %-14s version: %s" % (published, osLabel, version), format)
+                popup.addstr(5, 2, "flags: %s" % ", ".join(relayRecord[torTools.RELAY_FLAGS]), format)
                 
-                exitLine = ", ".join([str(k) for k in descEntry.exitpolicy])
+                exitLine = ", ".join(exitPolicy)
                 if len(exitLine) > 63: exitLine = "%s..." % exitLine[:60]
                 popup.addstr(6, 2, "exit policy: %s" % exitLine, format)
                 
-                if descEntry.contact:
+                if contact:
                   # clears up some common obscuring
-                  contactAddr = descEntry.contact
+                  contactAddr = contact
                   obscuring = [(" at ", "@"), (" AT ", "@"), ("AT", "@"), (" dot ", "."), (" DOT ", ".")]
                   for match, replace in obscuring: contactAddr = contactAddr.replace(match, replace)
                   if len(contactAddr) > 67: contactAddr = "%s..." % contactAddr[:64]
@@ -1374,7 +1447,7 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
         curses.halfdelay(REFRESH_RATE * 10) # reset normal pausing behavior
       finally:
         panel.CURSES_LOCK.release()
-    elif page == 1 and panels["conn"].isCursorEnabled and key in (ord('d'), ord('D')):
+    elif page == 1 and panels["conn"].isCursorEnabled and panels["conn"].groupBy == connPanel.GROUP_NONE and key in (ord('d'), ord('D')):
       # presents popup for raw consensus data
       panel.CURSES_LOCK.acquire()
       try:
@@ -1416,7 +1489,7 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
           panels["control"].resolvingCounter = hostnames.getRequestCount() - hostnames.getPendingCount()
           
           hostnames.setPaused(not panels["conn"].allowDNS)
-          for connEntry in panels["conn"].connections:
+          for connEntry in panels["conn"].getSnapshot().connections:
             try: hostnames.resolve(connEntry[connPanel.CONN_F_IP])
             except ValueError: pass
         else:
@@ -1424,6 +1497,54 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
           hostnames.setPaused(True)
         
         panels["conn"].sortConnections()
+    elif page == 1 and (key == ord('g') or key == ord('G')):
+      # provides menu to pick the attribute connections are aggregated by
+      optionTypes = [connPanel.GROUP_NONE, connPanel.GROUP_COUNTRY, connPanel.GROUP_PORT, connPanel.GROUP_FAMILY, connPanel.GROUP_PREFIX]
+      options = [connPanel.GROUP_LABEL[groupType] for groupType in optionTypes]
+      initialSelection = panels["conn"].groupBy   # enums correspond to index
+      
+      # hides top label of conn panel and pauses panels
+      panels["conn"].showLabel = False
+      panels["conn"].redraw(True)
+      setPauseState(panels, isPaused, page, True)
+      
+      selection = showMenu(stdscr, panels["popup"], "Group By:", options, initialSelection)
+      
+      # reverts changes made for popup
+      panels["conn"].showLabel = True
+      setPauseState(panels, isPaused, page)
+      
+      if selection != -1: panels["conn"].setGrouping(optionTypes[selection])
+    elif page == 1 and (key == ord('e') or key == ord('E')):
+      # allow user to enter a path to export connections - abandons if left blank
+      panel.CURSES_LOCK.acquire()
+      try:
+        setPauseState(panels, isPaused, page, True)
+        
+        # provides prompt
+        panels["control"].setMsg("Path to export connections (.csv or JSON lines): ")
+        panels["control"].redraw(True)
+        
+        # gets user input (this blocks monitor updates)
+        pathInput = panels["control"].getstr(0, 49)
+        
+        if pathInput:
+          pathInput = os.path.expanduser(pathInput)
+          
+          try:
+            rowCount = panels["conn"].exportConnections(pathInput)
+            panels["control"].setMsg("Exported %i connections: %s" % (rowCount, pathInput), curses.A_STANDOUT)
+            panels["control"].redraw(True)
+            time.sleep(2)
+          except IOError, exc:
+            panels["control"].setMsg("Unable to export connections: %s" % sysTools.getFileErrorMsg(exc), curses.A_STANDOUT)
+            panels["control"].redraw(True)
+            time.sleep(2)
+        
+        panels["control"].setMsg(CTL_PAUSED if isPaused else CTL_HELP)
+        setPauseState(panels, isPaused, page)
+      finally:
+        panel.CURSES_LOCK.release()
     elif page == 1 and (key == ord('u') or key == ord('U')):
       # provides menu to pick identification resolving utility
       optionTypes = [None, connections.CMD_NETSTAT, connections.CMD_SOCKSTAT, connections.CMD_LSOF, connections.CMD_SS, connections.CMD_BSD_SOCKSTAT, connections.CMD_BSD_PROCSTAT]
@@ -1465,9 +1586,8 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
     elif page == 1 and (key == ord('c') or key == ord('C')):
       # displays popup with client circuits
       clientCircuits = None
-      try:
-        clientCircuits = conn.get_info("circuit-status")["circuit-status"].split("\n")
-      except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed): pass
+      circuitStatus = torTools.getConn().getInfo("circuit-status")
+      if circuitStatus != None: clientCircuits = circuitStatus.split("\n")
       
       maxEntryLength = 0
       if clientCircuits:
@@ -1775,6 +1895,8 @@ def drawTorMonitor(stdscr, startTime, loggedEvents, isBlindMode):
       panels["config"].handleKey(key)
     elif page == 3:
       panels["torrc"].handleKey(key)
+    elif page == 4:
+      panels["diagnostics"].handleKey(key)
 
 def startTorMonitor(startTime, loggedEvents, isBlindMode):
   try:
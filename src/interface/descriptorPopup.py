@@ -3,13 +3,11 @@
 # Released under the GPL v3 (http://www.gnu.org/licenses/gpl.html)
 
 import math
-import socket
 import curses
-from TorCtl import TorCtl
 
 import controller
 import connPanel
-from util import panel, uiTools
+from util import panel, torTools, uiTools
 
 # field keywords used to identify areas for coloring
 LINE_NUM_COLOR = "yellow"
@@ -47,20 +45,20 @@ class PopupProperties:
       self.showLineNum = False
       self.text.append(UNRESOLVED_MSG)
     else:
-      try:
-        self.showLineNum = True
-        nsCommand = "ns/id/%s" % fingerprint
-        self.text.append(nsCommand)
-        self.text = self.text + self.conn.get_info(nsCommand)[nsCommand].split("\n")
-      except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed):
-        self.text = self.text + [ERROR_MSG, ""]
+      # documents are cached by torTools, so flipping between connections
+      # doesn't need to query tor
+      conn = torTools.getConn()
+      self.showLineNum = True
       
-      try:
-        descCommand = "desc/id/%s" % fingerprint
-        self.text.append(descCommand)
-        self.text = self.text + self.conn.get_info(descCommand)[descCommand].split("\n")
-      except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed):
-        self.text = self.text + [ERROR_MSG]
+      self.text.append("ns/id/%s" % fingerprint)
+      nsEntry = conn.getRelayNetworkStatus(fingerprint)
+      if nsEntry: self.text = self.text + nsEntry.split("\n")
+      else: self.text = self.text + [ERROR_MSG, ""]
+      
+      self.text.append("desc/id/%s" % fingerprint)
+      descEntry = conn.getRelayDescriptor(fingerprint)
+      if descEntry: self.text = self.text + descEntry.split("\n")
+      else: self.text = self.text + [ERROR_MSG]
   
   def handleKey(self, key, height):
     if key == curses.KEY_UP: self.scroll = max(self.scroll - 1, 0)
@@ -83,7 +81,7 @@ def showDescriptorPopup(popup, stdscr, conn, connectionPanel):
   try:
     while isVisible:
       selection = connectionPanel.cursorSelection
-      if not selection or not connectionPanel.connections: break
+      if not selection or not connectionPanel.getSnapshot().connections: break
       fingerprint = connectionPanel.getFingerprint(selection[connPanel.CONN_F_IP], selection[connPanel.CONN_F_PORT])
       entryColor = connPanel.TYPE_COLORS[selection[connPanel.CONN_TYPE]]
       properties.reset(fingerprint, entryColor)
@@ -0,0 +1,160 @@
+"""
+Panel presenting arm's interactions with the control port: the traffic and
+round-trip times of the commands we've issued, contention for the control
+connection, and how well event listeners are keeping up. This is for figuring
+out the cause when arm stalls (for instance, on remote control ports). This
+also includes the churn and lifetimes of tor's connections.
+"""
+
+import curses
+import threading
+
+from util import connHistory, panel, torTools, uiTools
+
+DEFAULT_CONFIG = {"features.diagnostics.showScrollbars": True}
+
+# attributes used to order the command listing
+SORT_SENT, SORT_RECEIVED, SORT_COUNT, SORT_LATENCY = range(4)
+SORT_LABELS = {SORT_SENT: "Sent", SORT_RECEIVED: "Received",
+               SORT_COUNT: "Count", SORT_LATENCY: "Latency"}
+
+class DiagnosticsPanel(panel.Panel):
+  """
+  Scrollable listing of the control port diagnostics provided by torTools.
+  """
+  
+  def __init__(self, stdscr, config=None):
+    panel.Panel.__init__(self, stdscr, "diagnostics", 0)
+    
+    self._config = dict(DEFAULT_CONFIG)
+    if config: config.update(self._config)
+    
+    self.valsLock = threading.RLock()
+    self.scroll = 0
+    self.sortOrder = SORT_RECEIVED
+    self._lastContentHeight = 0
+  
+  def handleKey(self, key):
+    self.valsLock.acquire()
+    if uiTools.isScrollKey(key):
+      pageHeight = self.getPreferredSize()[0] - 1
+      newScroll = uiTools.getScrollPosition(key, self.scroll, pageHeight, self._lastContentHeight)
+      
+      if self.scroll != newScroll:
+        self.scroll = newScroll
+        self.redraw(True)
+    elif key == ord('s') or key == ord('S'):
+      self.sortOrder = (self.sortOrder + 1) % len(SORT_LABELS)
+      self.redraw(True)
+    
+    self.valsLock.release()
+  
+  def draw(self, subwindow, width, height):
+    self.valsLock.acquire()
+    conn = torTools.getConn()
+    
+    # lines are lists of (msg, format) tuples
+    contents = []
+    
+    lockStats = conn.getLockStats()
+    runtimeLabel = uiTools.getTimeLabel(lockStats["runtime"])
+    contents.append([("Commands (sorted by %s):" % SORT_LABELS[self.sortOrder].lower(), curses.A_BOLD)])
+    contents.append([("%-34s %7s %6s %9s %9s %8s %8s %8s %8s" % ("Type", "Count", "Fails", "Sent", "Received", "p50", "p90", "p99", "max"), curses.A_UNDERLINE)])
+    
+    commandStats = conn.getCommandStats()
+    commandStats.sort(key = self._getSortKey, reverse = True)
+    
+    for label, stats in commandStats:
+      failures = stats["failures"]
+      lineFormat = uiTools.getColor("red" if failures else "green")
+      
+      sentLabel = uiTools.getSizeLabel(stats["sent"], 1)
+      receivedLabel = uiTools.getSizeLabel(stats["received"], 1)
+      latencyLabels = tuple([_getMsLabel(latency) for latency in stats["latency"]])
+      
+      line = "%-34s %7i %6i %9s %9s %8s %8s %8s %8s" % ((uiTools.cropStr(label, 34), stats["count"], failures, sentLabel, receivedLabel) + latencyLabels)
+      contents.append([(line, lineFormat)])
+    
+    if not commandStats: contents.append([("  none issued in the last %s" % runtimeLabel, uiTools.getColor("white"))])
+    
+    # contention for the control connection
+    contents.append([])
+    contents.append([("Control Connection Lock:", curses.A_BOLD)])
+    
+    medianWait, p90Wait, p99Wait, maxWait = lockStats["waiting"]
+    waitRatio = 100.0 * lockStats["total"] / max(lockStats["runtime"], 1)
+    contents.append([("  %i acquisitions, %0.2f seconds waited in total (%0.2f%% of %s)" % (lockStats["count"], lockStats["total"], waitRatio, runtimeLabel), uiTools.getColor("cyan"))])
+    contents.append([("  recent waits: p50 %s, p90 %s, p99 %s, max %s" % (_getMsLabel(medianWait), _getMsLabel(p90Wait), _getMsLabel(p99Wait), _getMsLabel(maxWait)), uiTools.getColor("cyan"))])
+    
+    # how well event listeners are keeping up
+    contents.append([])
+    contents.append([("Event Listeners:", curses.A_BOLD)])
+    contents.append([("%-34s %7s %9s %9s %8s %8s %8s" % ("Listener", "Queued", "Processed", "Coalesced", "Dropped", "Lag", "Max Lag"), curses.A_UNDERLINE)])
+    
+    for listenerName, stats in conn.getEventListenerStats():
+      lineFormat = uiTools.getColor("red" if stats["dropped"] else "green")
+      line = "%-34s %7i %9i %9i %8i %8s %8s" % (uiTools.cropStr(listenerName, 34), stats["queued"], stats["processed"], stats["coalesced"], stats["dropped"], _getMsLabel(stats["lag"]), _getMsLabel(stats["maxLag"]))
+      contents.append([(line, lineFormat)])
+    
+    # churn and lifetimes of tor's connections
+    history = connHistory.getHistory()
+    bucketLabels = tuple(connHistory.LIFETIME_LABELS)
+    
+    contents.append([])
+    contents.append([("Connection Churn (last %s):" % uiTools.getTimeLabel(history.churnWindow * 60, 0, True), curses.A_BOLD)])
+    contents.append([("%-11s %8s %8s %8s %9s" % ("Type", "Opens/m", "Closes/m", "Closed", "Mean Life") + " %6s" * len(bucketLabels) % bucketLabels, curses.A_UNDERLINE)])
+    
+    lifetimes = history.getLifetimes()
+    for i, churnEntry in enumerate(history.getChurn()):
+      connType, opensPerMinute, closesPerMinute = churnEntry
+      closedCount, meanLifetime, buckets = lifetimes[i][1:]
+      
+      lineFormat = uiTools.getColor("cyan" if closedCount else "white")
+      line = "%-11s %8.1f %8.1f %8i %9s" % (connType, opensPerMinute, closesPerMinute, closedCount, uiTools.getTimeLabel(meanLifetime))
+      line += " %6i" * len(buckets) % tuple(buckets)
+      contents.append([(line, lineFormat)])
+    
+    self._lastContentHeight = len(contents)
+    
+    # restricts scroll location to valid bounds
+    self.scroll = max(0, min(self.scroll, self._lastContentHeight - height + 1))
+    
+    # draws left-hand scroll bar if content's longer than the height
+    scrollOffset = 0
+    if self._config["features.diagnostics.showScrollbars"] and self._lastContentHeight > height - 1:
+      scrollOffset = 3
+      self.addScrollBar(self.scroll, self.scroll + height - 1, self._lastContentHeight, 1)
+    
+    self.addstr(0, 0, "Control Port Diagnostics:", curses.A_STANDOUT)
+    
+    for lineNum in range(self.scroll, min(self._lastContentHeight, self.scroll + height - 1)):
+      cursorLoc = scrollOffset
+      
+      # content past the panel's width is clipped by addstr
+      for msg, format in contents[lineNum]:
+        self.addstr(lineNum - self.scroll + 1, cursorLoc, msg, format)
+        cursorLoc += len(msg)
+    
+    self.valsLock.release()
+  
+  def _getSortKey(self, commandEntry):
+    """
+    Provides the value used to order the given (command type, stats) entry.
+    """
+    
+    stats = commandEntry[1]
+    if self.sortOrder == SORT_SENT: return stats["sent"]
+    elif self.sortOrder == SORT_RECEIVED: return stats["received"]
+    elif self.sortOrder == SORT_COUNT: return stats["count"]
+    else: return stats["latency"][1]
+
+def _getMsLabel(seconds):
+  """
+  Provides a label for the given duration in milliseconds.
+  
+  Arguments:
+    seconds - duration to be labeled
+  """
+  
+  if seconds >= 10: return uiTools.getTimeLabel(seconds)
+  else: return "%0.1f ms" % (seconds * 1000)
@@ -30,7 +30,8 @@ class PopupProperties:
       # TODO: better rewrite to take advantage of sysTools
       
       if not sysTools.isAvailable("lsof"): raise Exception("error: lsof is unavailable")
-      results = sysTools.call("lsof -np %s -F Ln" % torPid)
+      # the user's waiting on the popup, so this isn't deferred
+      results = sysTools.call("lsof -np %s -F Ln" % torPid, priority = sysTools.PRIORITY_INTERACTIVE)
       
       # if we didn't get any results then tor's probably closed (keep defaults)
       if len(results) == 0: return
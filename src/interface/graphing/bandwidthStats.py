@@ -332,10 +332,14 @@ class BandwidthStats(graphPanel.GraphStats):
     
     conn = torTools.getConn()
     queried = dict([(arg, "") for arg in ACCOUNTING_ARGS])
-    queried["status"] = conn.getInfo("accounting/hibernating")
+    
+    # fetches all of the accounting stats in a single GETINFO
+    infoVals = conn.getInfoMany(("accounting/hibernating", "accounting/interval-end",
+                                 "accounting/bytes", "accounting/bytes-left"))
+    queried["status"] = infoVals["accounting/hibernating"]
     
     # provides a nicely formatted reset time
-    endInterval = conn.getInfo("accounting/interval-end")
+    endInterval = infoVals["accounting/interval-end"]
     if endInterval:
       # converts from gmt to local with respect to DST
       if time.localtime()[8]: tz_offset = time.altzone
@@ -354,8 +358,8 @@ class BandwidthStats(graphPanel.GraphStats):
         queried["resetTime"] = "%i:%02i:%02i:%02i" % (days, hours, minutes, sec)
     
     # number of bytes used and in total for the accounting period
-    used = conn.getInfo("accounting/bytes")
-    left = conn.getInfo("accounting/bytes-left")
+    used = infoVals["accounting/bytes"]
+    left = infoVals["accounting/bytes-left"]
     
     if used and left:
       usedComp, leftComp = used.split(" "), left.split(" ")
@@ -93,7 +93,7 @@ class PsStats(graphPanel.GraphStats):
     psResults = {} # mapping of stat names to their results
     if self.queryPid and self.queryParam and self.failedCount < FAILURE_THRESHOLD:
       queryCmd = "ps -p %s -o %s" % (self.queryPid, ",".join(self.queryParam))
-      psCall = sysTools.call(queryCmd, self.cacheTime, True)
+      psCall = sysTools.call(queryCmd, self.cacheTime, True, priority = sysTools.PRIORITY_POLLING)
       
       if psCall and len(psCall) == 2:
         # ps provided results (first line is headers, second is stats)
@@ -288,21 +288,27 @@ class HeaderPanel(panel.Panel, threading.Thread):
     if setStatic:
       # version is truncated to first part, for instance:
       # 0.2.2.13-alpha (git-feb8c1b5f67f2c6f) -> 0.2.2.13-alpha
-      self.vals["tor/version"] = conn.getInfo("version", "Unknown").split()[0]
-      self.vals["tor/versionStatus"] = conn.getInfo("status/version/current", "Unknown")
-      self.vals["tor/nickname"] = conn.getOption("Nickname", "")
-      self.vals["tor/orPort"] = conn.getOption("ORPort", "0")
-      self.vals["tor/dirPort"] = conn.getOption("DirPort", "0")
-      self.vals["tor/controlPort"] = conn.getOption("ControlPort", "")
-      self.vals["tor/isAuthPassword"] = conn.getOption("HashedControlPassword") != None
-      self.vals["tor/isAuthCookie"] = conn.getOption("CookieAuthentication") == "1"
+      infoVals = conn.getInfoMany(("version", "status/version/current"), "Unknown")
+      self.vals["tor/version"] = infoVals["version"].split()[0]
+      self.vals["tor/versionStatus"] = infoVals["status/version/current"]
+      
+      # fetches all of the options we need in a single GETCONF
+      confVals = conn.getOptionMany(("Nickname", "ORPort", "DirPort", "ControlPort",
+        "HashedControlPassword", "CookieAuthentication", "ORListenAddress"))
+      
+      self.vals["tor/nickname"] = confVals["Nickname"] or ""
+      self.vals["tor/orPort"] = confVals["ORPort"] or "0"
+      self.vals["tor/dirPort"] = confVals["DirPort"] or "0"
+      self.vals["tor/controlPort"] = confVals["ControlPort"] or ""
+      self.vals["tor/isAuthPassword"] = confVals["HashedControlPassword"] != None
+      self.vals["tor/isAuthCookie"] = confVals["CookieAuthentication"] == "1"
       
       # orport is reported as zero if unset
       if self.vals["tor/orPort"] == "0": self.vals["tor/orPort"] = ""
       
       # overwrite address if ORListenAddress is set (and possibly orPort too)
       self.vals["tor/address"] = "Unknown"
-      listenAddr = conn.getOption("ORListenAddress")
+      listenAddr = confVals["ORListenAddress"]
       if listenAddr:
         if ":" in listenAddr:
           # both ip and port overwritten
@@ -340,10 +346,14 @@ class HeaderPanel(panel.Panel, threading.Thread):
     
     # TODO: This can change, being reported by STATUS_SERVER -> EXTERNAL_ADDRESS
     # events. Introduce caching via torTools?
+    infoParams = ["fingerprint"]
+    if self.vals["tor/address"] == "Unknown": infoParams.append("address")
+    infoVals = conn.getInfoMany(infoParams)
+    
     if self.vals["tor/address"] == "Unknown":
-      volatile["tor/address"] = conn.getInfo("address", self.vals["tor/address"])
+      volatile["tor/address"] = infoVals["address"] or self.vals["tor/address"]
     
-    volatile["tor/fingerprint"] = conn.getInfo("fingerprint", self.vals["tor/fingerprint"])
+    volatile["tor/fingerprint"] = infoVals["fingerprint"] or self.vals["tor/fingerprint"]
     volatile["tor/flags"] = conn.getMyFlags(self.vals["tor/flags"])
     
     # ps derived stats
@@ -359,7 +369,7 @@ class HeaderPanel(panel.Panel, threading.Thread):
       # %CPU   RSS %MEM     ELAPSED
       # 0.3 14096  1.3       29:51
       psRate = self._config["queries.ps.rate"]
-      psCall = sysTools.call("ps -p %s -o %s" % (self.vals["stat/pid"], ",".join(psParams)), psRate, True)
+      psCall = sysTools.call("ps -p %s -o %s" % (self.vals["stat/pid"], ",".join(psParams)), psRate, True, priority = sysTools.PRIORITY_POLLING)
       
       if psCall and len(psCall) >= 2:
         stats = psCall[1].strip().split()
@@ -234,7 +234,8 @@ def getLogFileEntries(runlevels, readLimit = None, addLimit = None, config = Non
   lines = []
   try:
     if readLimit:
-      lines = sysTools.call("tail -n %i %s" % (readLimit, loggingLocation))
+      # run once when populating the panel so this isn't deferred
+      lines = sysTools.call("tail -n %i %s" % (readLimit, loggingLocation), priority = sysTools.PRIORITY_INTERACTIVE)
       if not lines: raise IOError()
     else:
       logFile = open(loggingLocation, "r")
@@ -12,10 +12,13 @@ import time
 import getopt
 
 import version
+import interface.connPanel
 import interface.controller
 import interface.logPanel
 import util.conf
+import util.connHistory
 import util.connections
+import util.geoip
 import util.hostnames
 import util.log
 import util.panel
@@ -41,8 +44,8 @@ CONFIG = {"startup.controlPassword": None,
           "log.configDescriptions.persistance.saveSuccess": util.log.INFO,
           "log.configDescriptions.persistance.saveFailed": util.log.NOTICE}
 
-OPT = "i:c:be:vh"
-OPT_EXPANDED = ["interface=", "config=", "blind", "event=", "version", "help"]
+OPT = "i:c:be:x:vh"
+OPT_EXPANDED = ["interface=", "config=", "blind", "event=", "export=", "version", "help"]
 HELP_MSG = """Usage arm [OPTION]
 Terminal status monitor for Tor relays.
 
@@ -52,12 +55,16 @@ Terminal status monitor for Tor relays.
   -b, --blind                     disable connection lookups
   -e, --event EVENT_FLAGS         event types in message log  (default: %s)
 %s
+  -x, --export EXPORT_PATH        writes tor's connections to EXPORT_PATH and
+                                    exits (CSV if it ends with '.csv', JSON
+                                    lines otherwise)
   -v, --version                   provides version information
   -h, --help                      presents this help
 
 Example:
 arm -b -i 1643          hide connection data, attaching to control port 1643
 arm -e we -c /tmp/cfg   use this configuration file with 'WARN'/'ERR' events
+arm -x /tmp/conns.csv   save tor's current connections as CSV
 """ % (CONFIG["startup.interface.ipAddress"], CONFIG["startup.interface.port"], DEFAULT_CONFIG, CONFIG["startup.events"], interface.logPanel.EVENT_LISTING)
 
 # messages related to loading the tor configuration descriptions
@@ -72,6 +79,12 @@ NO_INTERNAL_CFG_MSG = "Failed to load the parsing configuration. This will be pr
 STANDARD_CFG_LOAD_FAILED_MSG = "Failed to load configuration (using defaults): \"%s\""
 STANDARD_CFG_NOT_FOUND_MSG = "No configuration found at '%s', using defaults"
 
+# messages and timeout (in seconds) for exporting connections
+EXPORT_TIMEOUT = 30
+EXPORT_SUCCESS_MSG = "Exported %i connections to '%s'"
+EXPORT_FAILED_MSG = "Unable to export connections (%s)"
+EXPORT_BLIND_MSG = "Connections can't be exported in blind mode"
+
 def isValidIpAddr(ipStr):
   """
   Returns true if input is a valid IPv4 address, false otherwise.
@@ -147,10 +160,40 @@ def _loadConfigurationDescriptions():
           msg = DESC_SAVE_FAILED_MSG % util.sysTools.getFileErrorMsg(exc)
           util.log.log(CONFIG["log.configDescriptions.persistance.saveFailed"], msg)
 
+def _exportConnections(conn, path):
+  """
+  Writes tor's connections to the given path without starting the interface,
+  waiting for the first connection lookup to finish.
+  
+  Arguments:
+    conn - TorCtl connection
+    path - path where to save the connections
+  """
+  
+  torPid = util.torTools.getConn().getMyPid()
+  if torPid: resolver = util.connections.getResolver("tor", torPid)
+  else: resolver = util.connections.getResolver("tor")
+  
+  waitStart = time.time()
+  while resolver.lastLookup == -1 and time.time() - waitStart < EXPORT_TIMEOUT:
+    time.sleep(0.1)
+  
+  # the panel isn't drawn, just used for classifying connections
+  exportPanel = interface.connPanel.ConnPanel(None, conn, False)
+  
+  try:
+    rowCount = exportPanel.exportConnections(path)
+    print EXPORT_SUCCESS_MSG % (rowCount, path)
+  except IOError, exc:
+    print EXPORT_FAILED_MSG % util.sysTools.getFileErrorMsg(exc)
+  
+  resolver.stop()
+
 if __name__ == '__main__':
   startTime = time.time()
   param = dict([(key, None) for key in CONFIG.keys()])
   configPath = DEFAULT_CONFIG # path used for customized configuration
+  exportPath = None           # writes connections here rather than starting if set
   
   # parses user input, noting any issues
   try:
@@ -182,6 +225,8 @@ if __name__ == '__main__':
       param["startup.blindModeEnabled"] = True        # prevents connection lookups
     elif opt in ("-e", "--event"):
       param["startup.events"] = arg                   # set event flags
+    elif opt in ("-x", "--export"):
+      exportPath = os.path.expanduser(arg)            # exports connections
     elif opt in ("-v", "--version"):
       print "arm version %s (released %s)\n" % (version.VERSION, version.LAST_MODIFIED)
       sys.exit()
@@ -218,7 +263,7 @@ if __name__ == '__main__':
   config.update(CONFIG)
   
   # loads user preferences for utilities
-  for utilModule in (util.conf, util.connections, util.hostnames, util.log, util.panel, util.sysTools, util.torConfig, util.torTools, util.uiTools):
+  for utilModule in (util.conf, util.connHistory, util.connections, util.geoip, util.hostnames, util.log, util.panel, util.sysTools, util.torConfig, util.torTools, util.uiTools):
     utilModule.loadConfig(config)
   
   # overwrites undefined parameters with defaults
@@ -244,6 +289,10 @@ if __name__ == '__main__':
       print "Unrecognized event flag: %s" % flag
     sys.exit()
   
+  if exportPath and param["startup.blindModeEnabled"]:
+    print EXPORT_BLIND_MSG
+    sys.exit()
+  
   # temporarily disables TorCtl logging to prevent issues from going to stdout while starting
   TorCtl.TorUtil.loglevel = "NONE"
   
@@ -254,6 +303,12 @@ if __name__ == '__main__':
   conn = TorCtl.TorCtl.connect(controlAddr, controlPort, authPassword)
   if conn == None: sys.exit(1)
   
+  # the same credentials are used to reattach if tor's restarted, and for a
+  # second control connection for large queries (the controller only retains
+  # the password if features.retainControlPassword is set)
+  controller = util.torTools.getConn()
+  controller.setConnectionParams(controlAddr, controlPort, authPassword, conn.get_auth_type())
+  
   # removing references to the controller password so the memory can be freed
   # (unfortunately python does allow for direct access to the memory so this
   # is the best we can do)
@@ -273,9 +328,13 @@ if __name__ == '__main__':
   # initializing the connection may require user input (for the password)
   # skewing the startup time results so this isn't counted
   initTime = time.time() - startTime
-  controller = util.torTools.getConn()
   controller.init(conn)
   
+  if exportPath:
+    _exportConnections(conn, exportPath)
+    conn.close()
+    sys.exit()
+  
   # fetches descriptions for tor's configuration options
   _loadConfigurationDescriptions()
   
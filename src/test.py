@@ -5,12 +5,14 @@ Handler for arm tests and demos.
 """
 
 import time
+from TorCtl import TorCtl
 from util import connections, torTools, uiTools
 
 MENU = """Arm Test Options:
   1. Resolver Performance Test
   2. Resolver Dump
   3. Glyph Demo
+  4. Consensus Parsing Benchmark
   q. Quit
 
 Selection: """
@@ -18,12 +20,25 @@ Selection: """
 def printDivider():
   print("\n" + "-" * 40 + "\n")
 
+def getMemoryUsage():
+  """
+  Provides the resident memory of this process in kilobytes (via proc
+  contents), None if unavailable.
+  """
+  
+  try:
+    for line in open("/proc/self/status"):
+      if line.startswith("VmRSS:"): return int(line.split()[1])
+  except (IOError, ValueError): pass
+  
+  return None
+
 conn = None
 while True:
   userInput = raw_input(MENU)
   
   # initiate the TorCtl connection if the test needs it
-  if userInput in ("1", "2") and not conn:
+  if userInput in ("1", "2", "4") and not conn:
     conn = torTools.getConn()
     conn.init()
     
@@ -101,6 +116,29 @@ while True:
     # Switching to a curses context and back repetedy seems to screw up the
     # terminal. Just to be safe this ends the process after the demo.
     break
+  elif userInput == "4":
+    # compares our streaming parser with TorCtl's for the same ns/all content,
+    # memory is measured as the growth in resident size while holding the
+    # results (the streaming parser goes first since python rarely returns
+    # freed memory to the system)
+    printDivider()
+    nsContent = conn.getInfo("ns/all")
+    
+    if not nsContent:
+      print("Unable to fetch the consensus (GETINFO ns/all)")
+    else:
+      for label in ("arm", "TorCtl"):
+        startMemory, startTime = getMemoryUsage(), time.time()
+        
+        if label == "arm": results = list(torTools.parseNetworkStatus(nsContent.split("\n")))
+        else: results = TorCtl.parse_ns_body(nsContent)
+        
+        runtime, endMemory = time.time() - startTime, getMemoryUsage()
+        memoryLabel = "%6i KB" % (endMemory - startMemory) if startMemory != None and endMemory != None else "unknown"
+        print("%-10s %5i relays     %0.4f seconds     %s" % (label, len(results), runtime, memoryLabel))
+        del results
+    
+    printDivider()
   else:
     print("'%s' isn't a valid selection\n" % userInput)
 
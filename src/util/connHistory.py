@@ -0,0 +1,274 @@
+"""
+Bounded history of tor's closed connections, with the churn (connections
+opened and closed per minute) and lifetime distribution of each connection
+type. This is for spotting reconnect storms and short lived connections
+without resorting to packet captures.
+"""
+
+# Closed connections are kept in a ring buffer of fixed width records, held in
+# parallel arrays (open and close times as doubles, the type as a byte, and the
+# fingerprint as twenty raw bytes) so even large histories are compact. Churn
+# is counted in per-minute buckets and lifetimes in histogram buckets, both
+# updated as connections open and close rather than being derived from the
+# buffer.
+
+import time
+import array
+import binascii
+import threading
+
+from util import log
+
+# connection types the history is kept for
+TYPES = ("inbound", "outbound", "client", "directory", "control")
+
+# upper bounds (in seconds) for the lifetime histogram, with a final bucket
+# for anything longer
+LIFETIME_BOUNDS = (10, 60, 600, 3600, 86400)
+LIFETIME_LABELS = ("< 10s", "< 1m", "< 10m", "< 1h", "< 1d", "1d+")
+
+FINGERPRINT_WIDTH = 20 # bytes in a raw relay fingerprint
+UNKNOWN_FINGERPRINT = "UNKNOWN"
+
+HISTORY = None                    # singleton ConnHistory instance
+HISTORY_LOCK = threading.RLock()  # prevents concurrent instantiation
+
+CONFIG = {"cache.connHistory.size": 10000,
+          "queries.connHistory.churnWindow": 10,
+          "log.connHistoryTrimmed": log.DEBUG}
+
+def loadConfig(config):
+  config.update(CONFIG, {
+    "cache.connHistory.size": 10,
+    "queries.connHistory.churnWindow": 1})
+
+def getHistory():
+  """
+  Singleton constructor for the connection history. Its size is fixed by the
+  configuration when first called.
+  """
+  
+  global HISTORY
+  
+  HISTORY_LOCK.acquire()
+  if HISTORY == None: HISTORY = ConnHistory(CONFIG["cache.connHistory.size"], CONFIG["queries.connHistory.churnWindow"])
+  HISTORY_LOCK.release()
+  
+  return HISTORY
+
+class ConnHistory:
+  """
+  Records connection openings and closures. All calls are thread safe.
+  """
+  
+  def __init__(self, size, churnWindow):
+    """
+    Allocates a history with a fixed capacity.
+    
+    Arguments:
+      size        - maximum number of closed connections remembered
+      churnWindow - minutes of activity the churn rates are averaged over
+    """
+    
+    self.size = max(1, size)
+    self.churnWindow = max(1, churnWindow)
+    self.startTime = time.time()
+    self._lock = threading.RLock()
+    
+    # ring buffer of closed connections, _nextIndex being the slot to be
+    # written next and _count the number of populated slots
+    self._openTimes = array.array("d", [0.0]) * self.size
+    self._closeTimes = array.array("d", [0.0]) * self.size
+    self._types = array.array("B", [0]) * self.size
+    self._fingerprints = array.array("c", "\0") * (self.size * FINGERPRINT_WIDTH)
+    self._nextIndex = 0
+    self._count = 0
+    
+    # minute => [opens per type, closes per type] for the churn window
+    self._churnBuckets = {}
+    
+    # per type [count, total seconds, bucket counts] of closed connections
+    self._lifetimes = [[0, 0.0, [0] * len(LIFETIME_LABELS)] for _ in TYPES]
+  
+  def recordOpen(self, connType, openTime = None):
+    """
+    Notes that a connection of the given type was opened.
+    
+    Arguments:
+      connType - connection type (see TYPES)
+      openTime - time the connection was first seen, current time if None
+    """
+    
+    if not connType in TYPES: return
+    if openTime == None: openTime = time.time()
+    
+    self._lock.acquire()
+    self._getChurnBucket(openTime)[0][TYPES.index(connType)] += 1
+    self._lock.release()
+  
+  def recordClose(self, connType, openTime, closeTime = None, fingerprint = None):
+    """
+    Adds a closed connection to the history.
+    
+    Arguments:
+      connType    - connection type (see TYPES)
+      openTime    - time the connection was first seen
+      closeTime   - time the connection was last seen, current time if None
+      fingerprint - relay fingerprint of the peer, None or "UNKNOWN" if not a
+                    relay
+    """
+    
+    if not connType in TYPES: return
+    if closeTime == None: closeTime = time.time()
+    typeIndex = TYPES.index(connType)
+    
+    self._lock.acquire()
+    
+    # notes each time we've wrapped around the full buffer
+    if self._count == self.size and self._nextIndex == 0:
+      log.log(CONFIG["log.connHistoryTrimmed"], "connection history is full (%i entries), replacing its oldest entries" % self.size)
+    
+    index = self._nextIndex
+    self._openTimes[index] = openTime
+    self._closeTimes[index] = closeTime
+    self._types[index] = typeIndex
+    self._fingerprints[index * FINGERPRINT_WIDTH:(index + 1) * FINGERPRINT_WIDTH] = array.array("c", _packFingerprint(fingerprint))
+    self._nextIndex = (index + 1) % self.size
+    self._count = min(self._count + 1, self.size)
+    
+    self._getChurnBucket(closeTime)[1][typeIndex] += 1
+    
+    # lifetime histogram
+    lifetime = max(0, closeTime - openTime)
+    typeLifetimes = self._lifetimes[typeIndex]
+    typeLifetimes[0] += 1
+    typeLifetimes[1] += lifetime
+    
+    bucketIndex = len(LIFETIME_BOUNDS)
+    for i in range(len(LIFETIME_BOUNDS)):
+      if lifetime < LIFETIME_BOUNDS[i]:
+        bucketIndex = i
+        break
+    
+    typeLifetimes[2][bucketIndex] += 1
+    self._lock.release()
+  
+  def getClosed(self, limit = None):
+    """
+    Provides closed connections, most recent first, as tuples of the form:
+    (type, open time, close time, fingerprint)
+    
+    Arguments:
+      limit - maximum number of entries to provide, all if None
+    """
+    
+    self._lock.acquire()
+    
+    count = self._count
+    if limit != None: count = min(count, limit)
+    
+    results = []
+    for i in range(1, count + 1):
+      index = (self._nextIndex - i) % self.size
+      fingerprint = _unpackFingerprint(self._fingerprints[index * FINGERPRINT_WIDTH:(index + 1) * FINGERPRINT_WIDTH].tostring())
+      results.append((TYPES[self._types[index]], self._openTimes[index], self._closeTimes[index], fingerprint))
+    
+    self._lock.release()
+    return results
+  
+  def getChurn(self):
+    """
+    Provides the average connections opened and closed per minute over the
+    churn window as a list of (type, opens per minute, closes per minute). If
+    we've run for less than the window then this is averaged over our runtime.
+    """
+    
+    self._lock.acquire()
+    currentTime = time.time()
+    self._trimChurnBuckets(currentTime)
+    
+    opens, closes = [0] * len(TYPES), [0] * len(TYPES)
+    for bucketOpens, bucketCloses in self._churnBuckets.values():
+      for i in range(len(TYPES)):
+        opens[i] += bucketOpens[i]
+        closes[i] += bucketCloses[i]
+    
+    self._lock.release()
+    
+    minutes = float(min(self.churnWindow, max(1, (currentTime - self.startTime) / 60.0)))
+    return [(TYPES[i], opens[i] / minutes, closes[i] / minutes) for i in range(len(TYPES))]
+  
+  def getLifetimes(self):
+    """
+    Provides the lifetime distributions of closed connections as a list of
+    (type, count, mean seconds, bucket counts) where the buckets match
+    LIFETIME_LABELS. These cover all connections that have closed, including
+    ones that have since been dropped from the history.
+    """
+    
+    self._lock.acquire()
+    
+    results = []
+    for i in range(len(TYPES)):
+      count, totalTime, buckets = self._lifetimes[i]
+      meanTime = 0
+      if count: meanTime = totalTime / count
+      results.append((TYPES[i], count, meanTime, list(buckets)))
+    
+    self._lock.release()
+    return results
+  
+  def _getChurnBucket(self, timestamp):
+    """
+    Provides the [opens, closes] counters for the minute of the given time,
+    dropping buckets that have fallen out of the churn window.
+    
+    Arguments:
+      timestamp - time the bucket is for
+    """
+    
+    self._trimChurnBuckets(time.time())
+    
+    minute = int(timestamp / 60)
+    if not minute in self._churnBuckets:
+      self._churnBuckets[minute] = ([0] * len(TYPES), [0] * len(TYPES))
+    
+    return self._churnBuckets[minute]
+  
+  def _trimChurnBuckets(self, currentTime):
+    """
+    Drops churn buckets older than our window.
+    
+    Arguments:
+      currentTime - time the window ends
+    """
+    
+    oldestMinute = int(currentTime / 60) - self.churnWindow + 1
+    for minute in self._churnBuckets.keys():
+      if minute < oldestMinute: del self._churnBuckets[minute]
+
+def _packFingerprint(fingerprint):
+  """
+  Converts a hex fingerprint to its raw bytes, using null bytes if it's unknown
+  or malformed.
+  
+  Arguments:
+    fingerprint - hex encoded relay fingerprint
+  """
+  
+  if fingerprint and len(fingerprint) == FINGERPRINT_WIDTH * 2:
+    try: return binascii.unhexlify(fingerprint)
+    except TypeError: pass
+  
+  return "\0" * FINGERPRINT_WIDTH
+
+def _unpackFingerprint(rawFingerprint):
+  """
+  Reverses _packFingerprint, providing UNKNOWN_FINGERPRINT for null bytes.
+  
+  Arguments:
+    rawFingerprint - raw fingerprint bytes
+  """
+  
+  if rawFingerprint == "\0" * FINGERPRINT_WIDTH: return UNKNOWN_FINGERPRINT
+  else: return binascii.hexlify(rawFingerprint).upper()
@@ -112,7 +112,7 @@ def getResolverCommand(resolutionCmd, processName, processPid = ""):
   elif resolutionCmd == CMD_BSD_PROCSTAT: return RUN_BSD_PROCSTAT % processPid
   else: raise ValueError("Unrecognized resolution type: %s" % resolutionCmd)
 
-def getConnections(resolutionCmd, processName, processPid = ""):
+def getConnections(resolutionCmd, processName, processPid = "", cacheAge = 0):
   """
   Retrieves a list of the current connections for a given process, providing a
   tuple list of the form:
@@ -127,12 +127,15 @@ def getConnections(resolutionCmd, processName, processPid = ""):
     resolutionCmd - command to use in resolving the address
     processName   - name of the process for which connections are fetched
     processPid    - process ID (this helps improve accuracy)
+    cacheAge      - age of results that can be reused, this also lets the fork
+                    governor defer the lookup by providing stale results (up to
+                    a minute old) if we're forking too frequently
   """
   
   
   # raises an IOError if the command fails or isn't available
   cmd = getResolverCommand(resolutionCmd, processName, processPid)
-  results = sysTools.call(cmd)
+  results = sysTools.call(cmd, cacheAge, priority = sysTools.PRIORITY_POLLING)
   
   if not results: raise IOError("No results found using: %s" % cmd)
   
@@ -336,7 +339,9 @@ class ConnectionResolver(threading.Thread):
       
       try:
         resolveStart = time.time()
-        connResults = getConnections(resolver, self.processName, self.processPid)
+        # results from the prior lookup can be reused if we're being rate
+        # limited, so connections are at worst a little stale
+        connResults = getConnections(resolver, self.processName, self.processPid, minWait)
         lookupTime = time.time() - resolveStart
         
         self._connections = connResults
@@ -0,0 +1,164 @@
+"""
+Provides the country codes of addresses using tor's geoip file, rather than
+querying the control port (GETINFO ip-to-country/*) for each address. The
+file's location is fetched via GETCONF GeoIPFile and loaded into a sorted
+array of address ranges that's searched via bisection. The file is reloaded
+if it's modified, and if it can't be read then lookups fall back to querying
+tor.
+"""
+
+# Lookups don't require locking. Loaded databases are immutable tuples of the
+# form (rangeStarts, rangeEnds, countryCodes) that are only ever replaced via
+# reassignment, so callers make a local reference and work with that. The
+# lock is only used to prevent concurrent reloads.
+
+import os
+import time
+import array
+import bisect
+import socket
+import struct
+import threading
+
+from util import log, sysTools, torTools
+
+# country code tor provides for addresses that aren't in its database
+UNKNOWN_COUNTRY = "??"
+
+DATABASE = None                   # loaded (rangeStarts, rangeEnds, countryCodes) tuple
+DATABASE_PATH = None              # path and modification time of the loaded file
+DATABASE_MTIME = None
+DATABASE_LOCK = threading.RLock() # prevents concurrent reloads
+LAST_CHECKED = 0                  # last time we checked if the file was modified
+
+CONFIG = {"queries.geoip.checkRate": 5,
+          "log.geoipLoaded": log.INFO,
+          "log.geoipLoadFailed": log.NOTICE}
+
+def loadConfig(config):
+  config.update(CONFIG)
+
+def getCountry(ipAddr, default = None):
+  """
+  Provides the two letter country code (lowercase, like tor provides) for the
+  given address. This is UNKNOWN_COUNTRY if the address isn't covered by the
+  database, and the default if the database is unavailable and tor can't be
+  queried.
+  
+  Arguments:
+    ipAddr  - ipv4 address to be looked up
+    default - result if the lookup fails
+  """
+  
+  _refresh()
+  databaseRef = DATABASE
+  
+  if databaseRef:
+    try: ipInt = struct.unpack("!L", socket.inet_aton(ipAddr))[0]
+    except (socket.error, struct.error): return UNKNOWN_COUNTRY
+    
+    rangeStarts, rangeEnds, countryCodes = databaseRef
+    index = bisect.bisect_right(rangeStarts, ipInt) - 1
+    
+    if index >= 0 and ipInt <= rangeEnds[index]: return countryCodes[index]
+    else: return UNKNOWN_COUNTRY
+  else:
+    # unable to read the geoip file (for instance, if we're attached to a
+    # remote tor instance), so fall back to asking tor
+    return torTools.getConn().getInfo("ip-to-country/%s" % ipAddr, default)
+
+def isLoaded():
+  """
+  True if lookups are being done via a local copy of the geoip file, false if
+  they're falling back to querying tor.
+  """
+  
+  return DATABASE != None
+
+def _refresh():
+  """
+  Loads the geoip file if its location or modification time has changed. This
+  is checked at most once every few seconds (queries.geoip.checkRate).
+  """
+  
+  global DATABASE, DATABASE_PATH, DATABASE_MTIME, LAST_CHECKED
+  
+  if time.time() - LAST_CHECKED < CONFIG["queries.geoip.checkRate"]: return
+  
+  DATABASE_LOCK.acquire()
+  
+  # checks that another thread didn't refresh while we were waiting
+  if time.time() - LAST_CHECKED >= CONFIG["queries.geoip.checkRate"]:
+    LAST_CHECKED = time.time()
+    
+    conn = torTools.getConn()
+    geoipPath = conn.getOption("GeoIPFile")
+    if geoipPath: geoipPath = conn.getPathPrefix() + geoipPath
+    
+    try: geoipMtime = os.stat(geoipPath).st_mtime if geoipPath else None
+    except OSError: geoipMtime = None
+    
+    if geoipMtime == None:
+      if DATABASE_PATH != geoipPath or DATABASE:
+        msg = "Unable to read tor's geoip file (%s), falling back to querying tor for locales" % geoipPath
+        log.log(CONFIG["log.geoipLoadFailed"], msg)
+      
+      DATABASE, DATABASE_PATH, DATABASE_MTIME = None, geoipPath, None
+    elif (geoipPath, geoipMtime) != (DATABASE_PATH, DATABASE_MTIME):
+      startTime = time.time()
+      
+      try:
+        DATABASE = _loadDatabase(geoipPath)
+        
+        msg = "loaded tor's geoip file with %i ranges (runtime: %0.3f)" % (len(DATABASE[0]), time.time() - startTime)
+        log.log(CONFIG["log.geoipLoaded"], msg)
+      except IOError, exc:
+        DATABASE = None
+        
+        msg = "Unable to read tor's geoip file (%s), falling back to querying tor for locales" % sysTools.getFileErrorMsg(exc)
+        log.log(CONFIG["log.geoipLoadFailed"], msg)
+      
+      DATABASE_PATH, DATABASE_MTIME = geoipPath, geoipMtime
+  
+  DATABASE_LOCK.release()
+
+def _loadDatabase(path):
+  """
+  Parses the given geoip file, providing a tuple of the form:
+  (rangeStarts, rangeEnds, countryCodes)
+  
+  where the ranges are sorted and non-overlapping. Tor accepts two formats for
+  the file, both of which are supported:
+  16777216,16777471,AU
+  "1.0.0.0","1.0.0.255","16777216","16777471","AU","Australia"
+  
+  This raises an IOError if the file can't be read.
+  
+  Arguments:
+    path - location of the geoip file
+  """
+  
+  entries = []
+  geoipFile = open(path, "r")
+  
+  for line in geoipFile:
+    line = line.strip()
+    if not line or line.startswith("#"): continue
+    
+    fields = [field.strip("\"") for field in line.split(",")]
+    
+    try:
+      if len(fields) == 3: entries.append((long(fields[0]), long(fields[1]), fields[2].lower()))
+      elif len(fields) >= 5: entries.append((long(fields[2]), long(fields[3]), fields[4].lower()))
+    except ValueError: pass # malformed entry
+  
+  geoipFile.close()
+  entries.sort()
+  
+  rangeStarts, rangeEnds, countryCodes = array.array("L"), array.array("L"), []
+  for rangeStart, rangeEnd, countryCode in entries:
+    rangeStarts.append(rangeStart)
+    rangeEnds.append(rangeEnd)
+    countryCodes.append(countryCode)
+  
+  return (rangeStarts, rangeEnds, tuple(countryCodes))
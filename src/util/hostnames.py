@@ -228,7 +228,7 @@ def _resolveViaHost(ipAddr):
     ipAddr - ip address to be resolved
   """
   
-  hostname = sysTools.call("host %s" % ipAddr)[0].split()[-1:][0]
+  hostname = sysTools.call("host %s" % ipAddr, priority = sysTools.PRIORITY_DNS)[0].split()[-1:][0]
   
   if hostname == "reached":
     # got message: ";; connection timed out; no servers could be reached"
@@ -16,14 +16,157 @@ CALL_CACHE = {}
 IS_FAILURES_CACHED = True           # caches both successful and failed results if true
 CALL_CACHE_LOCK = threading.RLock() # governs concurrent modifications of CALL_CACHE
 
+# Priorities for system calls, used to determine which are deferred when we're
+# forking too rapidly (lower values take precedence). These are, in order:
+# calls blocking the user (popups, startup), periodic polling (connection
+# resolution, ps), and hostname lookups.
+PRIORITY_INTERACTIVE, PRIORITY_POLLING, PRIORITY_DNS = range(1, 4)
+PRIORITY_LABELS = {PRIORITY_INTERACTIVE: "interactive",
+                   PRIORITY_POLLING: "polling",
+                   PRIORITY_DNS: "dns"}
+
 CONFIG = {"cache.sysCalls.size": 600,
+          "queries.sysCalls.forkRate": 0,
+          "queries.sysCalls.maxDeferral": 5,
           "log.sysCallMade": log.DEBUG,
           "log.sysCallCached": None,
+          "log.sysCallDeferred": log.DEBUG,
           "log.sysCallFailed": log.INFO,
           "log.sysCallCacheGrowing": log.INFO}
 
 def loadConfig(config):
-  config.update(CONFIG)
+  config.update(CONFIG, {"queries.sysCalls.forkRate": 0,
+                         "queries.sysCalls.maxDeferral": 0})
+
+class _ForkGovernor:
+  """
+  Token bucket shared by all system calls, limiting how frequently arm forks.
+  Interactive calls are never delayed (though they still deplete the budget)
+  while lower priority calls wait until a token is available and no higher
+  priority calls are waiting for one. Identical calls that are made while one
+  is already underway are coalesced, sharing its results.
+  """
+  
+  def __init__(self):
+    self.cond = threading.Condition()
+    self.tokens = None            # forks we can currently make (unset until used)
+    self.lastRefill = time.time() # last time tokens were replenished
+    self.waiting = {}             # priority => number of calls waiting on tokens
+    self.inFlight = {}            # command => [event, results, exc] for calls underway
+  
+  def isUnderPressure(self):
+    """
+    True if we've exhausted our fork budget, false otherwise.
+    """
+    
+    rate = CONFIG["queries.sysCalls.forkRate"]
+    if rate <= 0: return False
+    
+    self.cond.acquire()
+    self._refill(rate)
+    isExhausted = self.tokens < 1
+    self.cond.release()
+    
+    return isExhausted
+  
+  def acquire(self, priority):
+    """
+    Blocks until we're permitted to fork, providing the number of seconds we
+    were deferred. Calls are never deferred longer than the maxDeferral config
+    option so low priority requests can't be starved indefinitely.
+    
+    Arguments:
+      priority - priority of the system call being made
+    """
+    
+    rate = CONFIG["queries.sysCalls.forkRate"]
+    if rate <= 0: return 0
+    
+    startTime, maxDeferral = time.time(), CONFIG["queries.sysCalls.maxDeferral"]
+    
+    self.cond.acquire()
+    self.waiting[priority] = self.waiting.get(priority, 0) + 1
+    
+    while priority != PRIORITY_INTERACTIVE:
+      self._refill(rate)
+      
+      isPreempted = False
+      for waitingPriority, waitingCount in self.waiting.items():
+        if waitingPriority < priority and waitingCount > 0:
+          isPreempted = True
+          break
+      
+      if self.tokens >= 1 and not isPreempted: break
+      
+      timeLeft = maxDeferral - (time.time() - startTime)
+      if timeLeft <= 0: break
+      
+      # sleeps until the next token is due or another call is admitted
+      self.cond.wait(min(timeLeft, max(0.01, (1 - self.tokens) / rate)))
+    
+    # interactive calls may dip into the next second's budget, but not further
+    self._refill(rate)
+    self.tokens = max(-max(1.0, rate), self.tokens - 1)
+    self.waiting[priority] -= 1
+    
+    self.cond.notifyAll()
+    self.cond.release()
+    
+    return time.time() - startTime
+  
+  def joinCall(self, command):
+    """
+    Provides a tuple of the form (pendingCall, isIssuer) for a call about to be
+    made. If an identical command is underway then we're not the issuer and
+    should wait on its results (the pendingCall's event is set when they're
+    available). Issuers need to call finishCall when done.
+    
+    Arguments:
+      command - command about to be issued
+    """
+    
+    self.cond.acquire()
+    if command in self.inFlight:
+      pendingCall, isIssuer = self.inFlight[command], False
+    else:
+      pendingCall, isIssuer = [threading.Event(), None, None], True
+      self.inFlight[command] = pendingCall
+    self.cond.release()
+    
+    return (pendingCall, isIssuer)
+  
+  def finishCall(self, command, results, errorExc):
+    """
+    Provides the results of a call we issued to any others waiting on it.
+    
+    Arguments:
+      command  - command that was issued
+      results  - lines of output from the call
+      errorExc - exception raised by the call, None if it succeeded
+    """
+    
+    self.cond.acquire()
+    pendingCall = self.inFlight.pop(command, None)
+    self.cond.release()
+    
+    if pendingCall:
+      pendingCall[1], pendingCall[2] = results, errorExc
+      pendingCall[0].set()
+  
+  def _refill(self, rate):
+    """
+    Replenishes tokens for the time that has elapsed, holding at most a
+    second's worth. This expects the caller to hold our condition.
+    """
+    
+    capacity, currentTime = max(1.0, rate), time.time()
+    
+    if self.tokens == None: self.tokens = capacity
+    else: self.tokens = min(capacity, self.tokens + (currentTime - self.lastRefill) * rate)
+    
+    self.lastRefill = currentTime
+
+FORK_GOVERNOR = _ForkGovernor()
 
 def isAvailable(command, cached=True):
   """
@@ -74,7 +217,7 @@ def getFileErrorMsg(exc):
   
   return excStr
 
-def call(command, cacheAge=0, suppressExc=False, quiet=True):
+def call(command, cacheAge=0, suppressExc=False, quiet=True, priority=PRIORITY_INTERACTIVE):
   """
   Convenience function for performing system calls, providing:
   - suppression of any writing to stdout, both directing stderr to /dev/null
@@ -82,6 +225,9 @@ def call(command, cacheAge=0, suppressExc=False, quiet=True):
   - logging of results (command issued, runtime, success/failure, etc)
   - optional exception suppression and caching (the max age for cached results
     is a minute)
+  - rate limiting via the fork governor, deferring lower priority calls when
+    we're forking too frequently (if cached results are available then these
+    are used instead, even if older than the cacheAge)
   
   Arguments:
     command     - command to be issued
@@ -91,6 +237,8 @@ def call(command, cacheAge=0, suppressExc=False, quiet=True):
     suppressExc - provides None in cases of failure if True, otherwise IOErrors
                   are raised
     quiet       - if True, "2> /dev/null" is appended to all commands
+    priority    - PRIORITY_* constant for the call, determining if it can be
+                  deferred when we're low on fork budget
   """
   
   # caching functionality (fetching and trimming)
@@ -127,8 +275,19 @@ def call(command, cacheAge=0, suppressExc=False, quiet=True):
         CALL_CACHE = newCache
       CALL_CACHE_LOCK.release()
     
-    # checks if we can make use of cached results
-    if command in CALL_CACHE and time.time() - CALL_CACHE[command][0] < cacheAge:
+    # checks if we can make use of cached results, settling for stale ones
+    # rather than waiting if we're low on fork budget
+    isCacheUsable = False
+    if command in CALL_CACHE:
+      entryAge = time.time() - CALL_CACHE[command][0]
+      
+      if entryAge < cacheAge: isCacheUsable = True
+      elif priority != PRIORITY_INTERACTIVE and entryAge < 60 and FORK_GOVERNOR.isUnderPressure():
+        msg = "system call (%s) deferred via stale cache: %s (age: %0.1f)" % (PRIORITY_LABELS[priority], command, entryAge)
+        log.log(CONFIG["log.sysCallDeferred"], msg)
+        isCacheUsable = True
+    
+    if isCacheUsable:
       cachedResults = CALL_CACHE[command][1]
       cacheAge = time.time() - CALL_CACHE[command][0]
       
@@ -141,13 +300,34 @@ def call(command, cacheAge=0, suppressExc=False, quiet=True):
           else: raise cachedResults
         else:
           # flag was toggled after a failure was cached - reissue call, ignoring the cache
-          return call(command, 0, suppressExc, quiet)
+          return call(command, 0, suppressExc, quiet, priority)
       else:
         msg = "system call (cached): %s (age: %0.1f)" % (command, cacheAge)
         log.log(CONFIG["log.sysCallCached"], msg)
         
         return cachedResults
   
+  # if an identical call is already underway then share its results
+  pendingCall, isIssuer = FORK_GOVERNOR.joinCall(command)
+  
+  if not isIssuer:
+    pendingCall[0].wait()
+    results, errorExc = pendingCall[1], pendingCall[2]
+    
+    msg = "system call (coalesced): %s" % command
+    log.log(CONFIG["log.sysCallCached"], msg)
+    
+    if errorExc:
+      if suppressExc: return None
+      else: raise errorExc
+    else: return results
+  
+  deferredTime = FORK_GOVERNOR.acquire(priority)
+  
+  if deferredTime >= 0.01:
+    msg = "system call (%s) deferred: %s (delay: %0.2f)" % (PRIORITY_LABELS[priority], command, deferredTime)
+    log.log(CONFIG["log.sysCallDeferred"], msg)
+  
   startTime = time.time()
   commandCall, results, errorExc = None, None, None
   
@@ -176,10 +356,17 @@ def call(command, cacheAge=0, suppressExc=False, quiet=True):
       results = commandCall.readlines()
     except IOError, exc:
       errorExc = exc
+    except:
+      # unexpected issue (for instance, unable to fork) - make sure anyone
+      # coalesced with this call isn't left waiting before we propagate it
+      FORK_GOVERNOR.finishCall(command, None, IOError("system call failed"))
+      raise
   
   # make sure sys call is closed
   if commandCall: commandCall.close()
   
+  FORK_GOVERNOR.finishCall(command, results, errorExc)
+  
   if errorExc:
     # log failure and either provide None or re-raise exception
     msg = "system call (failed): %s (error: %s)" % (command, str(errorExc))
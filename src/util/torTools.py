@@ -10,10 +10,14 @@ fetch a TorCtl instance to experiment with use the following:
 """
 
 import os
+import copy
 import time
+import base64
 import socket
 import thread
 import threading
+import Queue
+import itertools
 
 from TorCtl import TorCtl, TorUtil
 
@@ -27,15 +31,16 @@ TOR_INIT, TOR_CLOSED = range(1, 3)
 # message logged by default when a controller can't set an event type
 DEFAULT_FAILED_EVENT_MSG = "Unsupported event type: %s"
 
-# TODO: check version when reattaching to controller and if version changes, flush?
 # Skips attempting to set events we've failed to set before. This avoids
 # logging duplicate warnings but can be problematic if controllers belonging
 # to multiple versions of tor are attached, making this unreflective of the
-# controller's capabilites. However, this is a pretty bizarre edge case.
+# controller's capabilites. However, this is a pretty bizarre edge case (and
+# these are flushed if we reattach to a different version of tor).
 DROP_FAILED_EVENTS = True
 FAILED_EVENTS = set()
 
 CONTROLLER = None # singleton Controller instance
+DESC_CACHE_COUNTER = itertools.count() # provides the last used time of descriptor cache entries (for trimming)
 
 # Valid keys for the controller's getInfo cache. This includes static GETINFO
 # options (unchangable, even with a SETCONF) and other useful stats
@@ -44,13 +49,62 @@ CACHE_ARGS = ("version", "config-file", "exit-policy/default", "fingerprint",
               "nsEntry", "descEntry", "bwRate", "bwBurst", "bwObserved",
               "bwMeasured", "flags", "pid", "pathPrefix")
 
+# Cached GETINFO options that only change with tor's version. These are kept
+# when the control port closes and, if we reattach to the same version of tor,
+# reused rather than fetched again.
+VERSION_CACHE_ARGS = ("version", "config/names", "info/names", "features/names",
+                      "events/names", "exit-policy/default")
+
+# GETINFO options with large responses, which are fetched via a separate bulk
+# control connection (if available) so they don't delay other queries
+BULK_QUERIES = ("ns/all", "desc/all-recent", "config-text", "config/names",
+                "info/names", "circuit-status", "orconn-status", "stream-status",
+                "dir/")
+
+# GETINFO keys that take an argument (like "ip-to-country/<address>"), which
+# are grouped together in the control port traffic stats
+PARAMETERIZED_QUERIES = ("ip-to-country/", "ns/id/", "ns/name/", "desc/id/",
+                         "desc/name/", "extra-info/digest/", "dir/server/",
+                         "dir/status/", "addr-mappings/")
+
+# control port commands issued by the TorCtl methods we use
+COMMAND_LABELS = {"get_info": "GETINFO", "get_option": "GETCONF",
+                  "set_option": "SETCONF", "set_options": "SETCONF",
+                  "set_events": "SETEVENTS", "send_signal": "SIGNAL"}
+
+# Fields of the compact relay records in the controller's consensus index,
+# which are tuples of the form:
+# (fingerprint, nickname, address, orPort (int), flags (tuple), bandwidth (int))
+RELAY_FINGERPRINT, RELAY_NICKNAME, RELAY_ADDRESS, RELAY_OR_PORT, RELAY_FLAGS, RELAY_BANDWIDTH = range(6)
+
 TOR_CTL_CLOSE_MSG = "Tor closed control connection. Exiting event thread."
 UNKNOWN = "UNKNOWN" # value used by cached information if undefined
 CONFIG = {"torrc.map": {},
           "features.pathPrefix": "",
+          "queries.torConf.pollRate": 30,
+          "features.bulkConnection": True,
+          "features.autoReconnect": True,
+          "features.retainControlPassword": False,
+          "queries.reconnect.minDelay": 1,
+          "queries.reconnect.maxDelay": 60,
+          "queries.bulkConnection.retryRate": 60,
+          "queries.events.queueSize": 1000,
+          "queries.events.batchWindow": 0.5,
+          "queries.diagnostics.sampleSize": 500,
+          "cache.descriptors.size": 250,
+          "cache.descriptors.trimSize": 50,
           "log.torCtlPortClosed": log.NOTICE,
           "log.torGetInfo": log.DEBUG,
           "log.torGetConf": log.DEBUG,
+          "log.torConsensusLoaded": log.INFO,
+          "log.torBulkConnOpened": log.INFO,
+          "log.torReconnected": log.NOTICE,
+          "log.torPasswordNotRetained": log.INFO,
+          "log.torAuthFailed": log.WARN,
+          "log.torVersionChanged": log.INFO,
+          "log.torBulkConnFailed": log.NOTICE,
+          "log.torEventsDropped": log.NOTICE,
+          "log.torConsensusFileUnreadable": log.INFO,
           "log.torSetConf": log.INFO,
           "log.torPrefixPathInvalid": log.NOTICE,
           "log.bsdJailFound": log.INFO,
@@ -64,26 +118,41 @@ REQ_EVENTS = {"NOTICE": "this will be unable to detect when tor is shut down",
               "NS": "information related to the consensus will grow stale",
               "NEWCONSENSUS": "information related to the consensus will grow stale"}
 
+# events used if available, with a fallback if tor doesn't support them:
+# CONF_CHANGED - used for config cache invalidation (tor 0.2.3.3-alpha and later)
+OPT_EVENTS = {"CONF_CHANGED": "cached config values will be periodically rechecked instead"}
+
+# cached relay attributes that are derived from the given config options
+CONF_DEPENDENT_ATTR = {"bandwidthrate": ("bwRate",),
+                       "relaybandwidthrate": ("bwRate",),
+                       "maxadvertisedbandwidth": ("bwRate",),
+                       "bandwidthburst": ("bwBurst",),
+                       "relaybandwidthburst": ("bwBurst",),
+                       "controlport": ("pid",),
+                       "pidfile": ("pid",)}
+
 # provides int -> str mappings for torctl event runlevels
 TORCTL_RUNLEVELS = dict([(val, key) for (key, val) in TorUtil.loglevels.items()])
 
 def loadConfig(config):
-  config.update(CONFIG)
+  config.update(CONFIG, {"queries.torConf.pollRate": 1})
 
 def getPid(controlPort=9051, pidFilePath=None):
   """
   Attempts to determine the process id for a running tor process, using the
   following:
   1. GETCONF PidFile
-  2. "pgrep -x tor"
-  3. "pidof tor"
-  4. "netstat -npl | grep 127.0.0.1:%s" % <tor control port>
-  5. "ps -o pid -C tor"
-  6. "sockstat -4l -P tcp -p %i | grep tor" % <tor control port>
+  2. proc contents (tor process owning the control port's listening socket)
+  3. "pgrep -x tor"
+  4. "pidof tor"
+  5. "netstat -npl | grep 127.0.0.1:%s" % <tor control port>
+  6. "ps -o pid -C tor"
+  7. "sockstat -4l -P tcp -p %i | grep tor" % <tor control port>
   
   If pidof or ps provide multiple tor instances then their results are
-  discarded (since only netstat can differentiate using the control port). This
-  provides None if either no running process exists or it can't be determined.
+  discarded (since only proc and netstat can differentiate using the control
+  port). This provides None if either no running process exists or it can't be
+  determined.
   
   Arguments:
     controlPort - control port of the tor process if multiple exist
@@ -103,11 +172,23 @@ def getPid(controlPort=9051, pidFilePath=None):
       if pidEntry.isdigit(): return pidEntry
     except: pass
   
+  # attempts to resolve via proc contents (no system calls), failing if:
+  # - proc isn't available (non-linux systems)
+  # - tor is running under a different name
+  # - there are multiple instances of tor and we lack permissions to read
+  #   their file descriptors (for instance, if they're run by another user)
+  pid = _getPidViaProc(controlPort)
+  if pid: return pid
+  
+  # the following are one-off lookups that attaching to tor waits on (and
+  # their result is cached), so they're issued as interactive calls rather
+  # than being deferred by the fork governor
+  
   # attempts to resolve using pgrep, failing if:
   # - tor is running under a different name
   # - there are multiple instances of tor
   try:
-    results = sysTools.call("pgrep -x tor")
+    results = sysTools.call("pgrep -x tor", priority = sysTools.PRIORITY_INTERACTIVE)
     if len(results) == 1 and len(results[0].split()) == 1:
       pid = results[0].strip()
       if pid.isdigit(): return pid
@@ -117,7 +198,7 @@ def getPid(controlPort=9051, pidFilePath=None):
   # - tor's running under a different name
   # - there's multiple instances of tor
   try:
-    results = sysTools.call("pidof tor")
+    results = sysTools.call("pidof tor", priority = sysTools.PRIORITY_INTERACTIVE)
     if len(results) == 1 and len(results[0].split()) == 1:
       pid = results[0].strip()
       if pid.isdigit(): return pid
@@ -126,7 +207,7 @@ def getPid(controlPort=9051, pidFilePath=None):
   # attempts to resolve using netstat, failing if:
   # - tor's being run as a different user due to permissions
   try:
-    results = sysTools.call("netstat -npl | grep 127.0.0.1:%i" % controlPort)
+    results = sysTools.call("netstat -npl | grep 127.0.0.1:%i" % controlPort, priority = sysTools.PRIORITY_INTERACTIVE)
     
     if len(results) == 1:
       results = results[0].split()[6] # process field (ex. "7184/tor")
@@ -138,7 +219,7 @@ def getPid(controlPort=9051, pidFilePath=None):
   # - tor's running under a different name
   # - there's multiple instances of tor
   try:
-    results = sysTools.call("ps -o pid -C tor")
+    results = sysTools.call("ps -o pid -C tor", priority = sysTools.PRIORITY_INTERACTIVE)
     if len(results) == 2:
       pid = results[1].strip()
       if pid.isdigit(): return pid
@@ -153,7 +234,7 @@ def getPid(controlPort=9051, pidFilePath=None):
   # TODO: the later two issues could be solved by filtering for the control
   # port IP address instead of the process name.
   try:
-    results = sysTools.call("sockstat -4l -P tcp -p %i | grep tor" % controlPort)
+    results = sysTools.call("sockstat -4l -P tcp -p %i | grep tor" % controlPort, priority = sysTools.PRIORITY_INTERACTIVE)
     if len(results) == 1 and len(results[0].split()) == 7:
       pid = results[0].split()[2]
       if pid.isdigit(): return pid
@@ -175,7 +256,7 @@ def getBsdJailId():
   #    1
   
   torPid = getConn().getMyPid()
-  psOutput = sysTools.call("ps -p %s -o jid" % torPid)
+  psOutput = sysTools.call("ps -p %s -o jid" % torPid, priority = sysTools.PRIORITY_INTERACTIVE)
   
   if len(psOutput) == 2 and len(psOutput[1].split()) == 1:
     jid = psOutput[1].strip()
@@ -184,6 +265,44 @@ def getBsdJailId():
   log.log(CONFIG["log.unknownBsdJailId"], "Failed to figure out the FreeBSD jail id. Assuming 0.")
   return 0
 
+def parseNetworkStatus(nsLines):
+  """
+  Generator that parses router status entries (as provided by GETINFO ns/all
+  or the cached-consensus file) into relay records. This is considerably
+  cheaper than TorCtl's get_network_status since it only reads the fields arm
+  needs and doesn't construct an object for each relay, so when given a file
+  it never holds more than a single entry in memory.
+  
+  Arguments:
+    nsLines - iterable for the lines of the network status document
+  """
+  
+  flagsCache = {} # relays share flag combinations, so we keep a single copy
+  entry = None    # [fingerprint, nickname, address, orPort, flags, bandwidth]
+  
+  for line in nsLines:
+    if line.startswith("r "):
+      if entry: yield tuple(entry)
+      
+      # r <nickname> <identity> <digest> <date> <time> <address> <ORPort> <DirPort>
+      comp = line.split()
+      
+      try:
+        fingerprint = base64.b64decode(comp[2] + "=").encode("hex").upper()
+        entry = [fingerprint, comp[1], comp[6], int(comp[7]), (), 0]
+      except (IndexError, ValueError, TypeError): entry = None # malformed entry
+    elif not entry: continue
+    elif line.startswith("s "):
+      flags = tuple(line.split()[1:])
+      entry[RELAY_FLAGS] = flagsCache.setdefault(flags, flags)
+    elif line.startswith("w "):
+      for comp in line.split()[1:]:
+        if comp.startswith("Bandwidth="):
+          try: entry[RELAY_BANDWIDTH] = int(comp[10:])
+          except ValueError: pass
+  
+  if entry: yield tuple(entry)
+
 def getConn():
   """
   Singleton constructor for a Controller. Be aware that this starts as being
@@ -194,6 +313,269 @@ def getConn():
   if CONTROLLER == None: CONTROLLER = Controller()
   return CONTROLLER
 
+class ControlRequest:
+  """
+  Pending request for the control port, executed by the controller's I/O
+  thread. This provides the result once it's available, and can be cancelled
+  if it hasn't yet been sent.
+  """
+  
+  def __init__(self, func, args):
+    self._func = func
+    self._args = args
+    self._result = None
+    self._exc = None
+    self._isStarted = False
+    self._isCancelled = False
+    self._callbacks = []
+    self._doneEvent = threading.Event()
+    self._stateLock = threading.RLock()
+  
+  def isDone(self):
+    """
+    True if the request has been processed (or cancelled), false otherwise.
+    """
+    
+    return self._doneEvent.isSet()
+  
+  def cancel(self):
+    """
+    Prevents the request from being sent, in which case its result is None.
+    This returns True if successful and False if it's already been sent.
+    """
+    
+    self._stateLock.acquire()
+    isCancelled = not self._isStarted
+    if isCancelled: self._isCancelled = True
+    self._stateLock.release()
+    
+    return isCancelled
+  
+  def getResult(self, timeout = None):
+    """
+    Blocks until the request has been processed, then provides its result or
+    raises the exception it encountered. This raises a socket.timeout if the
+    result isn't available within the timeout.
+    
+    Arguments:
+      timeout - maximum number of seconds to wait, blocking indefinitely if
+                None
+    """
+    
+    self._doneEvent.wait(timeout)
+    
+    if not self.isDone(): raise socket.timeout("control port request timed out")
+    elif self._exc: raise self._exc
+    else: return self._result
+  
+  def addCallback(self, callback):
+    """
+    Calls the given function when the request has been processed (immediately
+    if it's already done). Callbacks are made from the I/O thread so they
+    should be quick, for instance just triggering a redraw.
+    
+    Arguments:
+      callback - functor that'll accept the request, expected to be of the form:
+                 myFunction(request)
+    """
+    
+    self._stateLock.acquire()
+    isDone = self.isDone()
+    if not isDone: self._callbacks.append(callback)
+    self._stateLock.release()
+    
+    if isDone: self._notify(callback)
+  
+  def _execute(self):
+    """
+    Processes the request (unless it's been cancelled) and notifies callbacks.
+    """
+    
+    self._stateLock.acquire()
+    isCancelled, self._isStarted = self._isCancelled, True
+    self._stateLock.release()
+    
+    if not isCancelled:
+      try: self._result = self._func(*self._args)
+      except Exception, exc: self._exc = exc
+    
+    self._stateLock.acquire()
+    self._doneEvent.set()
+    callbacks, self._callbacks = self._callbacks, []
+    self._stateLock.release()
+    
+    for callback in callbacks: self._notify(callback)
+  
+  def _notify(self, callback):
+    # issues in callbacks are logged rather than killing the I/O thread
+    try: callback(self)
+    except Exception, exc:
+      log.log(log.ERR, "BUG: control port request callback failed (%s)" % exc)
+
+class EventListenerQueue(TorCtl.PostEventListener):
+  """
+  Buffers TorCtl events for a listener, which are handled by its own worker
+  thread. This keeps slow listeners from stalling TorCtl's event thread (and
+  with it all other listeners). The queue is bounded, dropping the oldest
+  events if the listener falls too far behind, and events of the coalesced
+  types are merged with any unprocessed event of the same type so bursts
+  result in a single notification.
+  
+  Coalescing preserves the order of events that aren't merged, but a merged
+  event keeps the position of the first one in its burst.
+  """
+  
+  def __init__(self, listener, coalescedEvents = (), maxSize = 1000, batchWindow = 0):
+    """
+    Creates and starts a queue for the given listener.
+    
+    Arguments:
+      listener        - TorCtl.PostEventListener instance listening for events
+      coalescedEvents - event types (such as "NEWDESC") where the listener
+                        only cares about the latest state, in which case
+                        pending events are merged
+      maxSize         - maximum number of pending events
+      batchWindow     - seconds coalesced events are held before being
+                        provided, so bursts are batched together
+    """
+    
+    TorCtl.PostEventListener.__init__(self)
+    self.listener = listener
+    self.coalescedEvents = set(coalescedEvents)
+    self.maxSize = maxSize
+    self.batchWindow = batchWindow
+    
+    # pending entries are lists of the form [event, arrival time, event type],
+    # and unprocessed entries of coalesced types are referenced by their type
+    self._pending = []
+    self._pendingByType = {}
+    self._cond = threading.Condition()
+    self._isDropping = False
+    
+    # stats for the queue's performance
+    self._processedCount = 0
+    self._coalescedCount = 0
+    self._droppedCount = 0
+    self._lastLag = 0.0
+    self._maxLag = 0.0
+    
+    self._workerThread = threading.Thread(target = self._processEvents)
+    self._workerThread.setDaemon(True)
+    self._workerThread.start()
+  
+  def getName(self):
+    """
+    Provides the class name of the listener we're buffering for.
+    """
+    
+    return self.listener.__class__.__name__
+  
+  def getStats(self):
+    """
+    Provides a mapping with the following performance metrics:
+      queued    - number of pending events
+      processed - number of events provided to the listener
+      coalesced - number of events merged into a pending one
+      dropped   - number of events dropped due to the queue being full
+      lag       - seconds the oldest pending event has been waiting
+      lastLag   - seconds the last processed event spent in the queue
+      maxLag    - longest time an event has spent in the queue
+    """
+    
+    self._cond.acquire()
+    if self._pending: currentLag = time.time() - self._pending[0][1]
+    else: currentLag = 0.0
+    
+    stats = {"queued": len(self._pending),
+             "processed": self._processedCount,
+             "coalesced": self._coalescedCount,
+             "dropped": self._droppedCount,
+             "lag": currentLag,
+             "lastLag": self._lastLag,
+             "maxLag": max(self._maxLag, currentLag)}
+    self._cond.release()
+    
+    return stats
+  
+  def listen(self, event):
+    # called by TorCtl's event thread, so this just queues the event
+    eventType = getattr(event, "event_name", None)
+    
+    self._cond.acquire()
+    
+    pendingEntry = self._pendingByType.get(eventType)
+    if pendingEntry:
+      pendingEntry[0] = _mergeEvents(pendingEntry[0], event)
+      self._coalescedCount += 1
+    else:
+      if len(self._pending) >= self.maxSize:
+        # drops the oldest event, sparing coalesced ones since those are
+        # already bounded (one per type) and tend to reflect state changes
+        dropIndex = 0
+        for entry in self._pending:
+          if not self._pendingByType.get(entry[2]) is entry: break
+          dropIndex += 1
+        
+        droppedEntry = self._pending.pop(min(dropIndex, len(self._pending) - 1))
+        if self._pendingByType.get(droppedEntry[2]) is droppedEntry:
+          del self._pendingByType[droppedEntry[2]]
+        
+        self._droppedCount += 1
+        
+        if not self._isDropping:
+          self._isDropping = True
+          msg = "%s isn't keeping up with tor events, dropping the oldest" % self.getName()
+          log.log(CONFIG["log.torEventsDropped"], msg)
+      
+      newEntry = [event, time.time(), eventType]
+      self._pending.append(newEntry)
+      if eventType in self.coalescedEvents: self._pendingByType[eventType] = newEntry
+      
+      self._cond.notify()
+    
+    self._cond.release()
+  
+  def _processEvents(self):
+    """
+    Worker loop, providing queued events to the listener.
+    """
+    
+    while True:
+      self._cond.acquire()
+      
+      while True:
+        if not self._pending:
+          self._cond.wait()
+          continue
+        
+        # holds back coalesced events until the burst's had time to arrive
+        headEntry = self._pending[0]
+        if self.batchWindow and self._pendingByType.get(headEntry[2]) is headEntry:
+          remainingWait = headEntry[1] + self.batchWindow - time.time()
+          
+          if remainingWait > 0:
+            self._cond.wait(remainingWait)
+            continue
+        
+        break
+      
+      event, arrivalTime, eventType = entry = self._pending.pop(0)
+      if self._pendingByType.get(eventType) is entry: del self._pendingByType[eventType]
+      if not self._pending: self._isDropping = False
+      
+      self._lastLag = time.time() - arrivalTime
+      self._maxLag = max(self._maxLag, self._lastLag)
+      self._cond.release()
+      
+      # issues in listeners are logged rather than killing the worker
+      try: self.listener.listen(event)
+      except Exception, exc:
+        log.log(log.ERR, "BUG: %s failed to handle a %s event (%s)" % (self.getName(), eventType, exc))
+      
+      self._cond.acquire()
+      self._processedCount += 1
+      self._cond.release()
+
 class Controller(TorCtl.PostEventListener):
   """
   TorCtl wrapper providing convenience functions, listener functionality for
@@ -205,7 +587,7 @@ class Controller(TorCtl.PostEventListener):
     TorCtl.PostEventListener.__init__(self)
     self.conn = None                    # None if uninitialized or controller's been closed
     self.connLock = threading.RLock()
-    self.eventListeners = []            # instances listening for tor controller events
+    self.eventListeners = []            # EventListenerQueues for instances listening to tor events
     self.torctlListeners = []           # callback functions for TorCtl events
     self.statusListeners = []           # callback functions for tor's state changes
     self.controllerEvents = []          # list of successfully set controller events
@@ -219,12 +601,82 @@ class Controller(TorCtl.PostEventListener):
     # messages.
     self._pathPrefixLogging = True
     
+    # The GETINFO and GETCONF caches are snapshots that are never modified
+    # once assigned. Changes are made by building a new copy (under the
+    # cacheLock) and swapping it in, so cache hits don't need any locking and
+    # the connLock is only held by the I/O thread when communicating with the
+    # control port.
+    self._cacheLock = threading.RLock()
+    self._relayAttrLock = threading.RLock() # prevents duplicate relay attr lookups
+    
+    # Commands to the control port are issued by a dedicated I/O thread,
+    # processing ControlRequests from this queue. The thread's started when
+    # the first request is made.
+    self._requestQueue = Queue.Queue()
+    self._requestThread = None
+    self._requestThreadLock = threading.RLock()
+    
+    # Parameters for opening control connections (the address, port, and
+    # password), used to reattach if the control port is closed and for the
+    # bulk connection.
+    self._connParams = None
+    self._reconnectThread = None
+    
+    # Queries with large responses (BULK_QUERIES) are made via a second control
+    # connection, with its own I/O thread, so they don't hold up other
+    # requests. It's opened when first needed using the same credentials as the
+    # main connection, and falls back to the main connection if unavailable.
+    self._bulkConn = None
+    self._bulkConnLock = threading.RLock()
+    self._bulkRetryTime = 0             # time when a failed connection can be retried
+    self._bulkQueue = Queue.Queue()
+    self._bulkThread = None
+    
+    # Accounting of the commands issued to the control port, for diagnosing
+    # stalls. Command types (like "GETINFO ip-to-country/*") map to lists of
+    # the form [count, failures, bytes sent, bytes received, recent latencies],
+    # byte counts being estimated from the commands and their parsed responses.
+    # Time spent waiting on the connLock is likewise tracked.
+    self._commandStats = {}
+    self._lockWaits = []                # recent connLock wait times
+    self._lockWaitTotal = 0.0
+    self._lockWaitCount = 0
+    self._diagnosticsStart = time.time()
+    self._diagnosticsLock = threading.RLock()
+    
     # cached GETINFO parameters (None if unset or possibly changed)
     self._cachedParam = dict([(arg, "") for arg in CACHE_ARGS])
     
     # cached GETCONF parameters, entries consisting of:
     # (option, fetch_type) => value
     self._cachedConf = {}
+    self._confEvictions = 0 # incremented when config values are dropped
+    
+    # Index for the consensus, loaded when first needed and then kept current
+    # via NS and NEWCONSENSUS events. Like the caches this is an immutable
+    # snapshot, of the form (byFingerprint, byAddress, byEndpoint) where:
+    # byFingerprint - fingerprint => relay record
+    # byAddress     - address => tuple of relay records
+    # byEndpoint    - (address, orPort) => relay record
+    self._consensusIndex = None
+    self._consensusLock = threading.RLock() # prevents concurrent index loading
+    
+    # Least recently used cache for the ns/id/* and desc/id/* documents of
+    # relays. This maps (queryType, fingerprint) tuples to lists of the form
+    # [raw document, parsed fields (lazily populated), last used count]. Entries
+    # are dropped when NS and NEWDESC events report that they've changed.
+    self._descCache = {}
+    self._descNicknames = {}          # nickname => fingerprint for resolved relays
+    self._descInvalidations = 0       # incremented when entries are invalidated
+    self._descCacheLock = threading.RLock()
+    
+    # Cached config values are kept current via CONF_CHANGED events if tor
+    # supports them, and otherwise periodically rechecked. TorCtl provides the
+    # lines of CONF_CHANGED events as separate unknown events, so this tracks
+    # the arrival time of the last one to recognize its contents.
+    self._isConfChangedEnabled = False
+    self._confChangedTime = None
+    self._lastConfCheck = time.time()
     
     # directs TorCtl to notify us of events
     TorUtil.logger = self
@@ -253,12 +705,22 @@ class Controller(TorCtl.PostEventListener):
       self.conn.add_event_listener(self)
       for listener in self.eventListeners: self.conn.add_event_listener(listener)
       
+      self.connLock.release()
+      
+      # this might be a different tor instance, so cached config values
+      # can't be trusted
+      self._resetCaches(True)
+      
+      # the bulk connection is reopened for the new tor instance when needed
+      if self._isBulkEnabled(): self._queueBulkRequest(self._closeBulkConn)
+      
+      # checks if version dependent information is still valid
+      self._revalidateVersion()
+      
       # sets the events listened for by the new controller (incompatible events
       # are dropped with a logged warning)
       self.setControllerEvents(self.controllerEvents)
       
-      self.connLock.release()
-      
       self._status = TOR_INIT
       self._statusTime = time.time()
       
@@ -279,10 +741,60 @@ class Controller(TorCtl.PostEventListener):
       self._status = TOR_CLOSED
       self._statusTime = time.time()
       
+      if self._isBulkEnabled(): self._queueBulkRequest(self._closeBulkConn)
+      
       # notifies listeners that the controller's been shut down
       thread.start_new_thread(self._notifyStatusListeners, (TOR_CLOSED,))
+      
+      # tries to reattach (a no-op if this is due to being given a new
+      # connection, since then we'll already be alive again)
+      if CONFIG["features.autoReconnect"] and self._connParams:
+        self._requestThreadLock.acquire()
+        
+        if not self._reconnectThread or not self._reconnectThread.isAlive():
+          self._reconnectThread = threading.Thread(target = self._reconnect, name = "torTools reconnect")
+          self._reconnectThread.setDaemon(True)
+          self._reconnectThread.start()
+        
+        self._requestThreadLock.release()
     else: self.connLock.release()
   
+  def setConnectionParams(self, controlAddr, controlPort, authPassword = None, authType = None):
+    """
+    Provides the parameters for opening further control connections, which are
+    used to reattach if the control port is closed (features.autoReconnect) and
+    for a second connection for queries with large responses
+    (features.bulkConnection). This is a no-op if both are disabled. If the
+    control port uses password authentication then the password is only kept
+    (and these are only available) if features.retainControlPassword is set.
+    
+    Arguments:
+      controlAddr  - ip address of tor's control port
+      controlPort  - tor's control port
+      authPassword - controller password, if one's needed
+      authType     - authentication method of the control port (a
+                     TorCtl.AUTH_TYPE value)
+    """
+    
+    if not CONFIG["features.autoReconnect"] and not CONFIG["features.bulkConnection"]: return
+    
+    if authType == TorCtl.AUTH_TYPE.PASSWORD:
+      if not CONFIG["features.retainControlPassword"]:
+        msg = "Controller password isn't retained, so a second control connection and reattaching to tor are unavailable (see features.retainControlPassword)"
+        log.log(CONFIG["log.torPasswordNotRetained"], msg)
+        return
+      elif authPassword == None:
+        # the password was entered at TorCtl's prompt, which doesn't provide it
+        msg = "Reattaching to tor and a second control connection need the controller password to be in the armrc (startup.controlPassword)"
+        log.log(CONFIG["log.torPasswordNotRetained"], msg)
+        return
+    else: authPassword = None # not needed, so don't retain it
+    
+    self._bulkConnLock.acquire()
+    self._connParams = (controlAddr, controlPort, authPassword)
+    self._bulkRetryTime = 0
+    self._bulkConnLock.release()
+  
   def isAlive(self):
     """
     Returns True if this has been initialized with a working TorCtl instance,
@@ -334,34 +846,110 @@ class Controller(TorCtl.PostEventListener):
                     otherwise this raises the original exception
     """
     
-    self.connLock.acquire()
-    
     startTime = time.time()
     result, raisedExc, isFromCache = default, None, False
-    if self.isAlive():
-      if param in CACHE_ARGS and self._cachedParam[param]:
-        result = self._cachedParam[param]
-        isFromCache = True
-      else:
-        try:
-          getInfoVal = self.conn.get_info(param)[param]
-          if getInfoVal != None: result = getInfoVal
-        except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed), exc:
-          if type(exc) == TorCtl.TorCtlClosed: self.close()
-          raisedExc = exc
     
-    if not isFromCache and result and param in CACHE_ARGS:
-      self._cachedParam[param] = result
+    cacheRef = self._cachedParam
+    if self.conn and param in CACHE_ARGS and cacheRef[param]:
+      result = cacheRef[param]
+      isFromCache = True
+    else:
+      try:
+        getInfoVals = self._queueConnCall(_isBulkQuery(param), "get_info", param).getResult()
+        if getInfoVals and getInfoVals.get(param) != None: result = getInfoVals[param]
+      except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed), exc:
+        if type(exc) == TorCtl.TorCtlClosed: self.close()
+        raisedExc = exc
+      
+      if result and param in CACHE_ARGS:
+        self._updateParamCache({param: result})
     
     runtimeLabel = "cache fetch" if isFromCache else "runtime: %0.4f" % (time.time() - startTime)
     msg = "GETINFO %s (%s)" % (param, runtimeLabel)
     log.log(CONFIG["log.torGetInfo"], msg)
     
-    self.connLock.release()
-    
     if not suppressExc and raisedExc: raise raisedExc
     else: return result
   
+  def getInfoAsync(self, param, default = None):
+    """
+    Non-blocking counterpart of getInfo, providing a ControlRequest for the
+    result (raising the original exception if the lookup fails). Cached values
+    are provided via a request that's already done.
+    
+    Arguments:
+      param   - GETINFO option to be queried
+      default - result if the response is undefined
+    """
+    
+    request = ControlRequest(self.getInfo, (param, default, False))
+    
+    cacheRef = self._cachedParam
+    if self.conn and param in CACHE_ARGS and cacheRef[param]: request._execute()
+    elif _isBulkQuery(param) and self._isBulkEnabled(): self._queueBulkRequest(request)
+    else: self._queueRequest(request)
+    
+    return request
+  
+  def getInfoMany(self, params, default = None, suppressExc = True):
+    """
+    Queries the control port for a series of GETINFO options, providing a
+    mapping of the params to their values (or the default if undefined or the
+    lookup fails). Uncached values are fetched via a single multi-key GETINFO
+    so this only pays for one round trip. If tor rejects the batch (for
+    instance, due to an unrecognized key) then this falls back to querying the
+    options individually.
+    
+    Arguments:
+      params      - GETINFO options to be queried
+      default     - result for options that are undefined or fail
+      suppressExc - suppresses lookup errors (returning the default) if true,
+                    otherwise this raises the original exception
+    """
+    
+    startTime = time.time()
+    results, raisedExc, uncachedParams = {}, None, []
+    
+    cacheRef = self._cachedParam
+    for param in params:
+      if self.conn and param in CACHE_ARGS and cacheRef[param]:
+        results[param] = cacheRef[param]
+      elif not param in uncachedParams:
+        uncachedParams.append(param)
+    
+    if uncachedParams:
+      try:
+        isBulk = bool([param for param in uncachedParams if _isBulkQuery(param)])
+        getInfoVals = self._queueConnCall(isBulk, "get_info", uncachedParams).getResult()
+        
+        if getInfoVals != None:
+          cacheUpdates = {}
+          for param in uncachedParams:
+            if getInfoVals.get(param) != None:
+              results[param] = getInfoVals[param]
+              if param in CACHE_ARGS: cacheUpdates[param] = getInfoVals[param]
+          
+          if cacheUpdates: self._updateParamCache(cacheUpdates)
+          
+          msg = "GETINFO %s (runtime: %0.4f)" % (" ".join(uncachedParams), time.time() - startTime)
+          log.log(CONFIG["log.torGetInfo"], msg)
+      except TorCtl.ErrorReply:
+        # at least one of the keys was rejected, query them one by one
+        for param in uncachedParams:
+          try: results[param] = self.getInfo(param, default, False)
+          except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed), exc:
+            results[param], raisedExc = default, exc
+      except (socket.error, TorCtl.TorCtlClosed), exc:
+        if type(exc) == TorCtl.TorCtlClosed: self.close()
+        raisedExc = exc
+    
+    if not suppressExc and raisedExc: raise raisedExc
+    
+    for param in params:
+      if results.get(param) == None: results[param] = default
+    
+    return results
+  
   def getOption(self, param, default = None, multiple = False, suppressExc = True):
     """
     Queries the control port for the given configuration option, providing the
@@ -392,6 +980,27 @@ class Controller(TorCtl.PostEventListener):
     else:
       return self._getOption(param, default, fetchType, suppressExc)
   
+  def getOptionAsync(self, param, default = None, multiple = False):
+    """
+    Non-blocking counterpart of getOption, providing a ControlRequest for the
+    result (raising the original exception if the lookup fails). Cached values
+    are provided via a request that's already done.
+    
+    Arguments:
+      param    - configuration option to be queried
+      default  - result if the response is undefined
+      multiple - provides a list with all returned values if true, otherwise
+                 this just provides the first result
+    """
+    
+    request = ControlRequest(self.getOption, (param, default, multiple, False))
+    
+    cacheRef = self._cachedConf
+    if self.conn and (param, "list" if multiple else "str") in cacheRef: request._execute()
+    else: self._queueRequest(request)
+    
+    return request
+  
   def getOptionMap(self, param, default = None, suppressExc = True):
     """
     Queries the control port for the given configuration option, providing back
@@ -422,50 +1031,128 @@ class Controller(TorCtl.PostEventListener):
     
     return self._getOption(param, default, "map", suppressExc)
   
-  # TODO: cache isn't updated (or invalidated) during SETCONF events:
-  # https://trac.torproject.org/projects/tor/ticket/1692
+  def getOptionMany(self, params, default = None, multiple = False, suppressExc = True):
+    """
+    Queries the control port for a series of configuration options, providing
+    a mapping of the params to their values (or the default if undefined or
+    the lookup fails). Uncached options are fetched via a single multi-key
+    GETCONF, and if tor rejects the batch then this falls back to querying
+    them individually.
+    
+    Arguments:
+      params      - configuration options to be queried
+      default     - result for options that are undefined or fail
+      multiple    - provides lists with all returned values if true, otherwise
+                    this just provides the first result for each option
+      suppressExc - suppresses lookup errors (returning the default) if true,
+                    otherwise this raises the original exception
+    """
+    
+    fetchType = "list" if multiple else "str"
+    self._checkConfCache()
+    
+    startTime = time.time()
+    results, raisedExc, uncachedParams = {}, None, []
+    
+    cacheRef = self._cachedConf
+    for param in params:
+      if param in CONFIG["torrc.map"] or (self.conn and (param, fetchType) in cacheRef):
+        # special options and cache hits are handled by getOption
+        results[param] = self.getOption(param, default, multiple)
+      elif not param in uncachedParams:
+        uncachedParams.append(param)
+    
+    if uncachedParams:
+      evictionCount = self._getConfEvictionCount()
+      
+      try:
+        confVals = self._queueConnCall(False, "get_option", uncachedParams).getResult()
+        
+        if confVals != None:
+          # tor provides the option names with its own capitalization
+          fetchedValues = dict([(param.lower(), []) for param in uncachedParams])
+          
+          for key, value in confVals:
+            if key.lower() in fetchedValues and value != None:
+              fetchedValues[key.lower()].append(value)
+          
+          cacheUpdates = {}
+          for param in uncachedParams:
+            values = fetchedValues[param.lower()]
+            
+            if values:
+              cacheUpdates[(param, "str")] = values[0]
+              cacheUpdates[(param, "list")] = tuple(values)
+              results[param] = values if multiple else values[0]
+          
+          if cacheUpdates: self._updateConfCache(cacheUpdates, evictionCount)
+          
+          msg = "GETCONF %s (runtime: %0.4f)" % (" ".join(uncachedParams), time.time() - startTime)
+          log.log(CONFIG["log.torGetConf"], msg)
+      except TorCtl.ErrorReply:
+        # at least one of the options was rejected, query them one by one
+        for param in uncachedParams:
+          try: results[param] = self.getOption(param, default, multiple, False)
+          except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed), exc:
+            results[param], raisedExc = default, exc
+      except (socket.error, TorCtl.TorCtlClosed), exc:
+        if type(exc) == TorCtl.TorCtlClosed: self.close()
+        raisedExc = exc
+    
+    if not suppressExc and raisedExc: raise raisedExc
+    
+    for param in params:
+      if results.get(param) in (None, []): results[param] = default
+    
+    return results
+  
   def _getOption(self, param, default, fetchType, suppressExc):
     if not fetchType in ("str", "list", "map"):
       msg = "BUG: unrecognized fetchType in torTools._getOption (%s)" % fetchType
       log.log(log.ERR, msg)
       return default
     
-    self.connLock.acquire()
+    self._checkConfCache()
     startTime, raisedExc, isFromCache = time.time(), None, False
     result = {} if fetchType == "map" else []
     
-    if self.isAlive():
-      if (param, fetchType) in self._cachedConf:
-        isFromCache = True
-        result = self._cachedConf[(param, fetchType)]
-      else:
-        try:
-          if fetchType == "str":
-            getConfVal = self.conn.get_option(param)[0][1]
-            if getConfVal != None: result = getConfVal
-          else:
-            for key, value in self.conn.get_option(param):
-              if value != None:
-                if fetchType == "list": result.append(value)
-                elif fetchType == "map":
-                  if key in result: result.append(value)
-                  else: result[key] = [value]
-        except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed), exc:
-          if type(exc) == TorCtl.TorCtlClosed: self.close()
-          result, raisedExc = default, exc
-    
-    if not isFromCache and result:
-      cacheValue = result
-      if fetchType == "list": cacheValue = list(result)
-      elif fetchType == "map": cacheValue = dict(result)
-      self._cachedConf[(param, fetchType)] = cacheValue
+    cacheRef = self._cachedConf
+    if self.conn and (param, fetchType) in cacheRef:
+      isFromCache = True
+      result = cacheRef[(param, fetchType)]
+      
+      # cached values are shared, so provide copies of mutable types
+      if fetchType == "list": result = list(result)
+      elif fetchType == "map": result = dict([(key, list(values)) for key, values in result.items()])
+    else:
+      evictionCount = self._getConfEvictionCount()
+      
+      try:
+        confVals = self._queueConnCall(False, "get_option", param).getResult()
+        
+        if confVals and fetchType == "str":
+          if confVals[0][1] != None: result = confVals[0][1]
+        elif confVals:
+          for key, value in confVals:
+            if value != None:
+              if fetchType == "list": result.append(value)
+              elif fetchType == "map":
+                if key in result: result[key].append(value)
+                else: result[key] = [value]
+      except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed), exc:
+        if type(exc) == TorCtl.TorCtlClosed: self.close()
+        result, raisedExc = default, exc
+      
+      if result and not raisedExc:
+        cacheValue = result
+        if fetchType == "list": cacheValue = tuple(result)
+        elif fetchType == "map": cacheValue = dict([(key, tuple(values)) for key, values in result.items()])
+        self._updateConfCache({(param, fetchType): cacheValue}, evictionCount)
     
     runtimeLabel = "cache fetch" if isFromCache else "runtime: %0.4f" % (time.time() - startTime)
     msg = "GETCONF %s (%s)" % (param, runtimeLabel)
     log.log(CONFIG["log.torGetConf"], msg)
     
-    self.connLock.release()
-    
     if not suppressExc and raisedExc: raise raisedExc
     elif result == []: return default
     else: return result
@@ -482,20 +1169,16 @@ class Controller(TorCtl.PostEventListener):
     """
     
     isMultiple = isinstance(value, list) or isinstance(value, tuple)
-    self.connLock.acquire()
     
     startTime, raisedExc = time.time(), None
     if self.isAlive():
       try:
-        if isMultiple: self.conn.set_options([(param, val) for val in value])
-        else: self.conn.set_option(param, value)
+        if isMultiple: self._queueRequest(self._connCall, "set_options", [(param, val) for val in value]).getResult()
+        else: self._queueRequest(self._connCall, "set_option", param, value).getResult()
         
-        # flushing cached values (needed until we can detect SETCONF calls)
-        for fetchType in ("str", "list", "map"):
-          entry = (param, fetchType)
-          
-          if entry in self._cachedConf:
-            del self._cachedConf[entry]
+        # flushing cached values (the CONF_CHANGED event will do this too, but
+        # might not arrive before our next query)
+        self._evictConf([param])
       except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed), exc:
         if type(exc) == TorCtl.TorCtlClosed: self.close()
         elif type(exc) == TorCtl.ErrorReply:
@@ -514,8 +1197,6 @@ class Controller(TorCtl.PostEventListener):
         
         raisedExc = exc
     
-    self.connLock.release()
-    
     setCall = "%s %s" % (param, ", ".join(value) if isMultiple else value)
     excLabel = "failed: \"%s\", " % raisedExc if raisedExc else ""
     msg = "SETCONF %s (%sruntime: %0.4f)" % (setCall.strip(), excLabel, time.time() - startTime)
@@ -631,84 +1312,258 @@ class Controller(TorCtl.PostEventListener):
     if result == UNKNOWN: return ""
     else: return result
   
-  def getStatus(self):
+  def getRelay(self, fingerprint):
     """
-    Provides a tuple consisting of the control port's current status and unix
-    time-stamp for when it became this way (zero if no status has yet to be
-    set).
+    Provides the consensus record for the relay with the given fingerprint,
+    None if it isn't in the consensus. Records are tuples that can be accessed
+    via the RELAY_* indices.
+    
+    Arguments:
+      fingerprint - relay fingerprint to be looked up
     """
     
-    return (self._status, self._statusTime)
+    return self._getConsensusIndex()[0].get(fingerprint)
   
-  def addEventListener(self, listener):
+  def getRelaysAt(self, address):
     """
-    Directs further tor controller events to callback functions of the
-    listener. If a new control connection is initialized then this listener is
-    reattached.
+    Provides a tuple with the consensus records for relays at the given
+    address (empty if there's none).
     
     Arguments:
-      listener - TorCtl.PostEventListener instance listening for events
+      address - ip address to be looked up
     """
     
-    self.connLock.acquire()
-    self.eventListeners.append(listener)
-    if self.isAlive(): self.conn.add_event_listener(listener)
-    self.connLock.release()
+    return self._getConsensusIndex()[1].get(address, ())
   
-  def addTorCtlListener(self, callback):
+  def getRelayAt(self, address, orPort):
     """
-    Directs further TorCtl events to the callback function. Events are composed
-    of a runlevel and message tuple.
+    Provides the consensus record for the relay with the given address and
+    ORPort, None if there isn't one.
     
     Arguments:
-      callback - functor that'll accept the events, expected to be of the form:
-                 myFunction(runlevel, msg)
+      address - ip address to be looked up
+      orPort  - relay's ORPort
     """
     
-    self.torctlListeners.append(callback)
+    try: orPort = int(orPort)
+    except ValueError: return None
+    
+    return self._getConsensusIndex()[2].get((address, orPort))
   
-  def addStatusListener(self, callback):
+  def getRelayNetworkStatus(self, fingerprint, default = None):
     """
-    Directs further events related to tor's controller status to the callback
-    function.
+    Provides the raw network status entry (ns/id/*) for the given relay. This
+    is cached until an NS or NEWCONSENSUS event indicates that it's changed.
     
     Arguments:
-      callback - functor that'll accept the events, expected to be of the form:
-                 myFunction(controller, eventType)
+      fingerprint - relay fingerprint to be looked up
+      default     - result if the query fails
     """
     
-    self.statusListeners.append(callback)
+    return self._getRelayDocument("ns", fingerprint, default)
   
-  def removeStatusListener(self, callback):
+  def getRelayDescriptor(self, fingerprint, default = None):
     """
-    Stops listener from being notified of further events. This returns true if a
-    listener's removed, false otherwise.
+    Provides the raw server descriptor (desc/id/*) for the given relay. This is
+    cached until a NEWDESC event indicates that it's changed.
     
     Arguments:
-      callback - functor to be removed
+      fingerprint - relay fingerprint to be looked up
+      default     - result if the query fails
     """
     
-    if callback in self.statusListeners:
-      self.statusListeners.remove(callback)
-      return True
-    else: return False
+    return self._getRelayDocument("desc", fingerprint, default)
   
-  def getControllerEvents(self):
+  def getRelayDescriptorField(self, fingerprint, keyword, default = None):
     """
-    Provides the events the controller's currently configured to listen for.
+    Provides the value from the first line of the relay's descriptor with the
+    given keyword, for instance "hibernating" or "platform" (ignoring any "opt"
+    prefix).
+    
+    Arguments:
+      fingerprint - relay fingerprint to be looked up
+      keyword     - descriptor field to be provided
+      default     - result if the query fails or the field isn't present
     """
     
-    return list(self.controllerEvents)
+    descFields = self._getRelayDocument("desc", fingerprint, None, True)
+    if descFields: return descFields.get(keyword, default)
+    else: return default
   
-  def setControllerEvents(self, events):
+  def getRelayFingerprint(self, nickname, default = None):
     """
-    Sets the events being requested from any attached tor instance, logging
-    warnings for event types that aren't supported (possibly due to version
-    issues). Events in REQ_EVENTS will also be included, logging at the error
-    level with an additional description in case of failure.
+    Provides the fingerprint of the relay with the given nickname, using its
+    descriptor (desc/name/*). Resolved descriptors are cached with the others,
+    so this only queries tor again after a NEWDESC for that relay.
     
-    This remembers the successfully set events and tries to request them from
-    any tor instance it attaches to in the future too (again logging and
+    Arguments:
+      nickname - relay nickname to be looked up
+      default  - result if the query fails
+    """
+    
+    self._descCacheLock.acquire()
+    fingerprint = self._descNicknames.get(nickname)
+    if fingerprint and not ("desc", fingerprint) in self._descCache: fingerprint = None
+    invalidationCount = self._descInvalidations
+    self._descCacheLock.release()
+    
+    if fingerprint: return fingerprint
+    
+    descEntry = self.getInfo("desc/name/%s" % nickname)
+    if not descEntry: return default
+    
+    descFields = _parseDescriptor(descEntry)
+    fingerprint = descFields.get("fingerprint", "").replace(" ", "")
+    if not fingerprint: return default
+    
+    self._cacheRelayDocument(("desc", fingerprint), descEntry, descFields, invalidationCount)
+    
+    self._descCacheLock.acquire()
+    if ("desc", fingerprint) in self._descCache: self._descNicknames[nickname] = fingerprint
+    self._descCacheLock.release()
+    
+    return fingerprint
+  
+  def getStatus(self):
+    """
+    Provides a tuple consisting of the control port's current status and unix
+    time-stamp for when it became this way (zero if no status has yet to be
+    set).
+    """
+    
+    return (self._status, self._statusTime)
+  
+  def addEventListener(self, listener, coalescedEvents = ()):
+    """
+    Directs further tor controller events to callback functions of the
+    listener. If a new control connection is initialized then this listener is
+    reattached. Events are handled by a separate thread for each listener (so
+    slow listeners don't delay others), and bursts of the coalesced event
+    types are merged into a single notification (after being held for
+    queries.events.batchWindow seconds to gather the burst).
+    
+    Arguments:
+      listener        - TorCtl.PostEventListener instance listening for events
+      coalescedEvents - event types (for instance "NEWDESC") that can be merged
+                        if the listener hasn't yet processed a prior one
+    """
+    
+    listenerQueue = EventListenerQueue(listener, coalescedEvents, CONFIG["queries.events.queueSize"], CONFIG["queries.events.batchWindow"])
+    
+    self.connLock.acquire()
+    self.eventListeners.append(listenerQueue)
+    if self.isAlive(): self.conn.add_event_listener(listenerQueue)
+    self.connLock.release()
+  
+  def getEventListenerStats(self):
+    """
+    Provides a list of (listener name, stats) tuples for the performance of our
+    event listeners, stats being the mapping provided by
+    EventListenerQueue.getStats.
+    """
+    
+    return [(listenerQueue.getName(), listenerQueue.getStats()) for listenerQueue in self.eventListeners]
+  
+  def getCommandStats(self):
+    """
+    Provides a list of (command type, stats) tuples for the commands we've
+    issued to the control port, where command types are things like "GETCONF"
+    or "GETINFO ip-to-country/*". Stats are a mapping of:
+      count    - number of times the command was issued
+      failures - number of times it failed
+      sent     - estimated bytes sent to tor
+      received - estimated bytes received from tor
+      latency  - (median, 90th, 99th percentile, max) round-trip time of recent
+                 calls in seconds
+    """
+    
+    self._diagnosticsLock.acquire()
+    results = []
+    for label, (count, failures, sent, received, latencies) in self._commandStats.items():
+      stats = {"count": count,
+               "failures": failures,
+               "sent": sent,
+               "received": received,
+               "latency": _getPercentiles(latencies)}
+      results.append((label, stats))
+    self._diagnosticsLock.release()
+    
+    return results
+  
+  def getLockStats(self):
+    """
+    Provides a mapping with the time spent waiting to acquire the connLock
+    before issuing commands:
+      count   - number of commands that acquired the lock
+      total   - seconds spent waiting in total
+      waiting - (median, 90th, 99th percentile, max) wait time of recent
+                commands in seconds
+      runtime - seconds we've been collecting these stats
+    """
+    
+    self._diagnosticsLock.acquire()
+    stats = {"count": self._lockWaitCount,
+             "total": self._lockWaitTotal,
+             "waiting": _getPercentiles(self._lockWaits),
+             "runtime": time.time() - self._diagnosticsStart}
+    self._diagnosticsLock.release()
+    
+    return stats
+  
+  def addTorCtlListener(self, callback):
+    """
+    Directs further TorCtl events to the callback function. Events are composed
+    of a runlevel and message tuple.
+    
+    Arguments:
+      callback - functor that'll accept the events, expected to be of the form:
+                 myFunction(runlevel, msg)
+    """
+    
+    self.torctlListeners.append(callback)
+  
+  def addStatusListener(self, callback):
+    """
+    Directs further events related to tor's controller status to the callback
+    function.
+    
+    Arguments:
+      callback - functor that'll accept the events, expected to be of the form:
+                 myFunction(controller, eventType)
+    """
+    
+    self.statusListeners.append(callback)
+  
+  def removeStatusListener(self, callback):
+    """
+    Stops listener from being notified of further events. This returns true if a
+    listener's removed, false otherwise.
+    
+    Arguments:
+      callback - functor to be removed
+    """
+    
+    if callback in self.statusListeners:
+      self.statusListeners.remove(callback)
+      return True
+    else: return False
+  
+  def getControllerEvents(self):
+    """
+    Provides the events the controller's currently configured to listen for.
+    """
+    
+    return list(self.controllerEvents)
+  
+  def setControllerEvents(self, events):
+    """
+    Sets the events being requested from any attached tor instance, logging
+    warnings for event types that aren't supported (possibly due to version
+    issues). Events in REQ_EVENTS will also be included, logging at the error
+    level with an additional description in case of failure.
+    
+    This remembers the successfully set events and tries to request them from
+    any tor instance it attaches to in the future too (again logging and
     dropping unsuccessful event types).
     
     This returns the listing of event types that were successfully set. If not
@@ -719,12 +1574,26 @@ class Controller(TorCtl.PostEventListener):
       events - listing of events to be set
     """
     
+    return self._queueRequest(self._setControllerEvents, events).getResult()
+  
+  def _setControllerEvents(self, events):
+    """
+    Sets the events being requested from tor. This is executed by the I/O
+    thread on behalf of setControllerEvents.
+    
+    Arguments:
+      events - listing of events to be set
+    """
+    
+    waitStart = time.time()
     self.connLock.acquire()
+    lockWait = time.time() - waitStart
     
     returnVal = []
     if self.isAlive():
       events = set(events)
       events = events.union(set(REQ_EVENTS.keys()))
+      events = events.union(set(OPT_EVENTS.keys()))
       unavailableEvents = set()
       
       # removes anything we've already failed to set
@@ -746,7 +1615,7 @@ class Controller(TorCtl.PostEventListener):
       
       while not isEventsSet and not isAbandoned:
         try:
-          self.conn.set_events(list(events))
+          self._issueCall(self.conn, "set_events", (list(events),), lockWait)
           isEventsSet = True
         except TorCtl.ErrorReply, exc:
           msg = str(exc)
@@ -773,10 +1642,13 @@ class Controller(TorCtl.PostEventListener):
           defaultMsg = DEFAULT_FAILED_EVENT_MSG % eventType
           if eventType in REQ_EVENTS:
             log.log(log.ERR, defaultMsg + " (%s)" % REQ_EVENTS[eventType])
+          elif eventType in OPT_EVENTS:
+            log.log(log.INFO, defaultMsg + " (%s)" % OPT_EVENTS[eventType])
           else:
             log.log(log.WARN, defaultMsg)
         
         self.controllerEvents = list(events)
+        self._isConfChangedEnabled = "CONF_CHANGED" in events
         returnVal = list(events)
     else:
       # attempts to set the events when next attached to a control port
@@ -803,15 +1675,12 @@ class Controller(TorCtl.PostEventListener):
       issueSighup - issues a sighup rather than a controller RELOAD signal
     """
     
-    self.connLock.acquire()
-    
     raisedException = None
     if self.isAlive():
       if not issueSighup:
         try:
-          self.conn.send_signal("RELOAD")
-          self._cachedParam = dict([(arg, "") for arg in CACHE_ARGS])
-          self._cachedConf = {}
+          self._queueRequest(self._connCall, "send_signal", "RELOAD").getResult()
+          self._forceConfCheck()
         except Exception, exc:
           # new torrc parameters caused an error (tor's likely shut down)
           # BUG: this doesn't work - torrc errors still cause TorCtl to crash... :(
@@ -855,13 +1724,10 @@ class Controller(TorCtl.PostEventListener):
             if errorLine: raise IOError(" ".join(errorLine.split()[3:]))
             else: raise IOError("failed silently")
           
-          self._cachedParam = dict([(arg, "") for arg in CACHE_ARGS])
-          self._cachedConf = {}
+          self._forceConfCheck()
         except IOError, exc:
           raisedException = exc
     
-    self.connLock.release()
-    
     if raisedException: raise raisedException
   
   def msg_event(self, event):
@@ -872,6 +1738,7 @@ class Controller(TorCtl.PostEventListener):
     
     if event.level == "NOTICE" and event.msg.startswith("Received reload signal (hup)"):
       self._isReset = True
+      self._forceConfCheck()
       
       self._status = TOR_INIT
       self._statusTime = time.time()
@@ -880,34 +1747,32 @@ class Controller(TorCtl.PostEventListener):
   
   def ns_event(self, event):
     self._updateHeartbeat()
+    self._updateConsensusIndex([_getRelayRecord(nsEntry) for nsEntry in event.nslist], False)
+    self._invalidateRelayDocuments("ns", [nsEntry.idhex for nsEntry in event.nslist])
     
     myFingerprint = self.getInfo("fingerprint")
     if myFingerprint:
       for ns in event.nslist:
         if ns.idhex == myFingerprint:
-          self._cachedParam["nsEntry"] = None
-          self._cachedParam["flags"] = None
-          self._cachedParam["bwMeasured"] = None
+          self._updateParamCache({"nsEntry": None, "flags": None, "bwMeasured": None})
           return
     else:
-      self._cachedParam["nsEntry"] = None
-      self._cachedParam["flags"] = None
-      self._cachedParam["bwMeasured"] = None
+      self._updateParamCache({"nsEntry": None, "flags": None, "bwMeasured": None})
   
   def new_consensus_event(self, event):
     self._updateHeartbeat()
+    self._updateConsensusIndex([_getRelayRecord(nsEntry) for nsEntry in event.nslist], True)
+    self._invalidateRelayDocuments("ns")
     
-    self._cachedParam["nsEntry"] = None
-    self._cachedParam["flags"] = None
-    self._cachedParam["bwMeasured"] = None
+    self._updateParamCache({"nsEntry": None, "flags": None, "bwMeasured": None})
   
   def new_desc_event(self, event):
     self._updateHeartbeat()
+    self._invalidateRelayDocuments("desc", event.idlist)
     
     myFingerprint = self.getInfo("fingerprint")
     if not myFingerprint or myFingerprint in event.idlist:
-      self._cachedParam["descEntry"] = None
-      self._cachedParam["bwObserved"] = None
+      self._updateParamCache({"descEntry": None, "bwObserved": None})
   
   def circ_status_event(self, event):
     self._updateHeartbeat()
@@ -932,6 +1797,21 @@ class Controller(TorCtl.PostEventListener):
   
   def unknown_event(self, event):
     self._updateHeartbeat()
+    
+    # CONF_CHANGED events list the modified options on the following lines,
+    # which TorCtl provides as separate events arriving at the same time. These
+    # are of the form "OPTION=VALUE" or just "OPTION" if the value was unset,
+    # though TorCtl uppercases the portion before the first space.
+    if event.event_name == "CONF_CHANGED":
+      self._confChangedTime = event.arrived_at
+      
+      changedOptions = []
+      for line in event.event_string.split("\n"):
+        if line.strip(): changedOptions.append(line.strip().split("=", 1)[0])
+      
+      if changedOptions: self._evictConf(changedOptions)
+    elif event.arrived_at == self._confChangedTime and event.event_name != "OK":
+      self._evictConf([event.event_name.split("=", 1)[0]])
   
   def log(self, level, msg, *args):
     """
@@ -953,6 +1833,655 @@ class Controller(TorCtl.PostEventListener):
     # alternative is to use the event's timestamp (via event.arrived_at)
     self.lastHeartbeat = time.time()
   
+  def _queueRequest(self, request, *args):
+    """
+    Provides a ControlRequest that'll be processed by the I/O thread. If we're
+    already on the I/O thread then this is processed immediately (otherwise it
+    would be waiting on itself).
+    
+    Arguments:
+      request - ControlRequest to be processed, or a function to make one for
+      args    - arguments for the function
+    """
+    
+    if not isinstance(request, ControlRequest): request = ControlRequest(request, args)
+    
+    self._requestThreadLock.acquire()
+    if not self._requestThread:
+      self._requestThread = threading.Thread(target = self._processRequests, args = (self._requestQueue,), name = "torTools I/O")
+      self._requestThread.setDaemon(True)
+      self._requestThread.start()
+    self._requestThreadLock.release()
+    
+    if threading.currentThread() == self._requestThread: request._execute()
+    else: self._requestQueue.put(request)
+    
+    return request
+  
+  def _queueBulkRequest(self, request, *args):
+    """
+    Counterpart of _queueRequest for the bulk connection's I/O thread.
+    
+    Arguments:
+      request - ControlRequest to be processed, or a function to make one for
+      args    - arguments for the function
+    """
+    
+    if not isinstance(request, ControlRequest): request = ControlRequest(request, args)
+    
+    self._requestThreadLock.acquire()
+    if not self._bulkThread:
+      self._bulkThread = threading.Thread(target = self._processRequests, args = (self._bulkQueue,), name = "torTools bulk I/O")
+      self._bulkThread.setDaemon(True)
+      self._bulkThread.start()
+    self._requestThreadLock.release()
+    
+    if threading.currentThread() == self._bulkThread: request._execute()
+    else: self._bulkQueue.put(request)
+    
+    return request
+  
+  def _queueConnCall(self, isBulk, method, *args):
+    """
+    Queues a call to TorCtl, routing it to the bulk connection if it's
+    expected to have a large response and that connection's enabled.
+    
+    Arguments:
+      isBulk - routes to the bulk connection if true
+      method - name of the TorCtl method to be called
+      args   - arguments for the call
+    """
+    
+    if isBulk and self._isBulkEnabled(): return self._queueBulkRequest(self._bulkCall, method, *args)
+    else: return self._queueRequest(self._connCall, method, *args)
+  
+  def _processRequests(self, requestQueue):
+    """
+    Runs an I/O thread, processing requests as they're queued.
+    
+    Arguments:
+      requestQueue - queue with the ControlRequests for this thread
+    """
+    
+    while True:
+      requestQueue.get()._execute()
+  
+  def _connCall(self, method, *args):
+    """
+    Issues a call to our TorCtl instance, providing None if we aren't attached
+    to a control port. This is expected to be run on the I/O thread.
+    
+    Arguments:
+      method - name of the TorCtl method to be called
+      args   - arguments for the call
+    """
+    
+    waitStart = time.time()
+    self.connLock.acquire()
+    lockWait = time.time() - waitStart
+    
+    try:
+      if self.isAlive(): return self._issueCall(self.conn, method, args, lockWait)
+      else: return None
+    finally:
+      self.connLock.release()
+  
+  def _issueCall(self, conn, method, args, lockWait = None):
+    """
+    Calls the given TorCtl connection, recording the command's traffic and
+    round-trip time. Exceptions are propagated.
+    
+    Arguments:
+      conn     - TorCtl connection to be used
+      method   - name of the TorCtl method to be called
+      args     - arguments for the call
+      lockWait - seconds spent waiting on the connLock for this call (not
+                 recorded if None)
+    """
+    
+    startTime, result, isSuccessful = time.time(), None, False
+    
+    try:
+      result = getattr(conn, method)(*args)
+      isSuccessful = True
+      return result
+    finally:
+      runtime = time.time() - startTime
+      label, sentBytes, receivedBytes = _getCommandTraffic(method, args, result, isSuccessful)
+      sampleSize = max(1, CONFIG["queries.diagnostics.sampleSize"])
+      
+      self._diagnosticsLock.acquire()
+      
+      if not label in self._commandStats:
+        self._commandStats[label] = [0, 0, 0, 0, []]
+      
+      commandStats = self._commandStats[label]
+      commandStats[0] += 1
+      if not isSuccessful: commandStats[1] += 1
+      commandStats[2] += sentBytes
+      commandStats[3] += receivedBytes
+      commandStats[4].append(runtime)
+      if len(commandStats[4]) > sampleSize: del commandStats[4][0]
+      
+      if lockWait != None:
+        self._lockWaitCount += 1
+        self._lockWaitTotal += lockWait
+        self._lockWaits.append(lockWait)
+        if len(self._lockWaits) > sampleSize: del self._lockWaits[0]
+      
+      self._diagnosticsLock.release()
+  
+  def _bulkCall(self, method, *args):
+    """
+    Issues a call via the bulk connection, opening it if it isn't yet
+    available. If it can't be opened then this uses the main connection
+    instead. This is expected to be run on the bulk I/O thread.
+    
+    Arguments:
+      method - name of the TorCtl method to be called
+      args   - arguments for the call
+    """
+    
+    self._bulkConnLock.acquire()
+    
+    try:
+      if self._bulkConn and not self._bulkConn.is_live(): self._bulkConn = None
+      
+      if not self._bulkConn and self._isBulkEnabled() and time.time() >= self._bulkRetryTime and self.isAlive():
+        try: self._bulkConn = self._openControlConn()
+        except ValueError, exc: self._dropConnectionParams(exc)
+        
+        if self._bulkConn:
+          log.log(CONFIG["log.torBulkConnOpened"], "Opened a second control connection for bulk queries")
+        else:
+          msg = "Unable to open a second control connection, bulk queries will use the main connection"
+          log.log(CONFIG["log.torBulkConnFailed"], msg)
+          self._bulkRetryTime = time.time() + CONFIG["queries.bulkConnection.retryRate"]
+      
+      if self._bulkConn:
+        try: return self._issueCall(self._bulkConn, method, args)
+        except (socket.error, TorCtl.TorCtlClosed):
+          # issue with the bulk connection rather than the query
+          self._closeBulkConn()
+    finally:
+      self._bulkConnLock.release()
+    
+    return self._connCall(method, *args)
+  
+  def _openControlConn(self):
+    """
+    Opens and authenticates a control connection using our connection
+    parameters, providing None if unsuccessful. If authentication is rejected
+    (or needs a password we don't have) then retrying won't help, so this
+    raises a ValueError instead.
+    """
+    
+    connParams = self._connParams
+    if not connParams: raise ValueError("connection parameters are unavailable")
+    
+    controlAddr, controlPort, authPassword = connParams
+    newConn = None
+    
+    try:
+      controlSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      controlSocket.connect((controlAddr, controlPort))
+      newConn = TorCtl.Connection(controlSocket)
+      
+      authType = newConn.get_auth_type()
+      if authType == TorCtl.AUTH_TYPE.PASSWORD:
+        if authPassword == None: raise ValueError("controller password is unavailable")
+        authValue = authPassword
+      elif authType == TorCtl.AUTH_TYPE.COOKIE: authValue = newConn.get_auth_cookie_path()
+      else: authValue = ""
+      
+      try: newConn.authenticate(authValue)
+      except TorCtl.ErrorReply, exc: raise ValueError("authentication failed (%s)" % exc)
+      
+      return newConn
+    except (socket.error, IOError, TorCtl.ErrorReply, TorCtl.TorCtlClosed):
+      if newConn: newConn.close()
+      return None
+    except ValueError:
+      if newConn: newConn.close()
+      raise
+  
+  def _dropConnectionParams(self, exc):
+    """
+    Stops attempting further control connections after an authentication
+    failure, logging the reason.
+    
+    Arguments:
+      exc - ValueError raised by _openControlConn
+    """
+    
+    self._bulkConnLock.acquire()
+    isDropped = self._connParams != None
+    self._connParams = None
+    self._bulkConnLock.release()
+    
+    if isDropped:
+      msg = "Unable to open further control connections, so a second control connection and reattaching to tor are disabled: %s" % exc
+      log.log(CONFIG["log.torAuthFailed"], msg)
+  
+  def _isBulkEnabled(self):
+    """
+    True if bulk queries should be made via a second control connection, false
+    otherwise.
+    """
+    
+    return bool(self._connParams) and CONFIG["features.bulkConnection"]
+  
+  def _reconnect(self):
+    """
+    Attempts to reattach to tor after the control port has closed, retrying
+    with an exponential backoff (between queries.reconnect.minDelay and
+    maxDelay seconds) until successful or authentication fails.
+    """
+    
+    retryDelay = max(0.1, CONFIG["queries.reconnect.minDelay"])
+    
+    while not self.isAlive():
+      time.sleep(retryDelay)
+      if self.isAlive(): break # reattached by something else
+      
+      try: newConn = self._openControlConn()
+      except ValueError, exc:
+        # retrying won't help with authentication failures
+        self._dropConnectionParams(exc)
+        break
+      
+      if newConn:
+        self.init(newConn)
+        log.log(CONFIG["log.torReconnected"], "Reattached to tor's control port")
+        break
+      
+      retryDelay = min(retryDelay * 2, CONFIG["queries.reconnect.maxDelay"])
+  
+  def _revalidateVersion(self):
+    """
+    Checks if tor's version has changed since our version dependent cache
+    entries (VERSION_CACHE_ARGS) were fetched. If so then they're dropped, as
+    are the events we've failed to set (since a different version may support
+    them). This also fetches the version so it's available for comparison the
+    next time we attach.
+    """
+    
+    cachedVersion = self._cachedParam["version"]
+    
+    self._updateParamCache({"version": ""})
+    currentVersion = self.getInfo("version")
+    
+    if currentVersion != cachedVersion:
+      # without a prior version we can't tell if cached values are still valid
+      self._updateParamCache(dict([(arg, "") for arg in VERSION_CACHE_ARGS if arg != "version"]))
+      
+      if cachedVersion:
+        FAILED_EVENTS.clear()
+        
+        msg = "Tor's version has changed (%s -> %s), dropping version dependent information" % (cachedVersion, currentVersion)
+        log.log(CONFIG["log.torVersionChanged"], msg)
+  
+  def _closeBulkConn(self):
+    """
+    Closes the bulk connection if it's open. This is expected to be run on the
+    bulk I/O thread, since that acquires the connLock while holding the
+    bulkConnLock (so others might be holding them in the opposite order).
+    """
+    
+    self._bulkConnLock.acquire()
+    
+    if self._bulkConn:
+      self._bulkConn.close()
+      self._bulkConn = None
+    
+    self._bulkRetryTime = 0
+    self._bulkConnLock.release()
+  
+  def _updateParamCache(self, updates):
+    """
+    Replaces the GETINFO cache with a copy that includes the given values.
+    
+    Arguments:
+      updates - mapping of CACHE_ARGS keys to their new values
+    """
+    
+    self._cacheLock.acquire()
+    newCache = dict(self._cachedParam)
+    newCache.update(updates)
+    self._cachedParam = newCache
+    self._cacheLock.release()
+  
+  def _updateConfCache(self, updates, evictionCount):
+    """
+    Replaces the GETCONF cache with a copy that includes the given values.
+    These are expected to be immutable (tuples rather than lists, etc). This
+    is skipped if config values were dropped since we started fetching them
+    (since they might be stale).
+    
+    Arguments:
+      updates       - mapping of (option, fetchType) tuples to their new values
+      evictionCount - eviction count from before the values were fetched
+    """
+    
+    self._cacheLock.acquire()
+    
+    if evictionCount == self._confEvictions:
+      newCache = dict(self._cachedConf)
+      newCache.update(updates)
+      self._cachedConf = newCache
+    
+    self._cacheLock.release()
+  
+  def _getConfEvictionCount(self):
+    """
+    Provides the number of times config values have been dropped from the
+    GETCONF cache, for checking if fetched values are still valid.
+    """
+    
+    self._cacheLock.acquire()
+    evictionCount = self._confEvictions
+    self._cacheLock.release()
+    
+    return evictionCount
+  
+  def _resetCaches(self, isVersionKept = False, isConfKept = False):
+    """
+    Drops cached GETINFO and GETCONF values.
+    
+    Arguments:
+      isVersionKept - keeps the GETINFO values that only change with tor's
+                      version (VERSION_CACHE_ARGS) if true
+      isConfKept    - keeps the GETCONF values if true
+    """
+    
+    self._cacheLock.acquire()
+    newParamCache = dict([(arg, "") for arg in CACHE_ARGS])
+    
+    if isVersionKept:
+      for arg in VERSION_CACHE_ARGS: newParamCache[arg] = self._cachedParam[arg]
+    
+    self._cachedParam = newParamCache
+    
+    if not isConfKept:
+      self._cachedConf = {}
+      self._confEvictions += 1
+    self._cacheLock.release()
+    
+    self._invalidateRelayDocuments("ns")
+    self._invalidateRelayDocuments("desc")
+  
+  def _evictConf(self, params):
+    """
+    Drops the cached values for the given config options (case insensitive),
+    along with any relay attributes derived from them.
+    
+    Arguments:
+      params - configuration options that have changed
+    """
+    
+    # options fetched via a special command are cached under its name
+    evictedParams, evictedAttr = set(), {}
+    for param in params:
+      evictedParams.add(param.lower())
+      
+      for mappedParam, mappedCommand in CONFIG["torrc.map"].items():
+        if mappedParam.lower() == param.lower(): evictedParams.add(mappedCommand.lower())
+      
+      for attr in CONF_DEPENDENT_ATTR.get(param.lower(), ()):
+        evictedAttr[attr] = ""
+    
+    self._cacheLock.acquire()
+    
+    newCache = {}
+    for entry, value in self._cachedConf.items():
+      if not entry[0].lower() in evictedParams: newCache[entry] = value
+    
+    self._cachedConf = newCache
+    self._confEvictions += 1
+    if evictedAttr: self._updateParamCache(evictedAttr)
+    
+    self._cacheLock.release()
+  
+  def _forceConfCheck(self):
+    """
+    Rechecks our cached config values on the next lookup if tor doesn't
+    provide CONF_CHANGED events (otherwise tor reports the options a reload
+    changes).
+    """
+    
+    self._lastConfCheck = 0
+  
+  def _checkConfCache(self):
+    """
+    If tor doesn't provide CONF_CHANGED events then this periodically rechecks
+    our cached config values (queries.torConf.pollRate), fetching all of them
+    via a single GETCONF and dropping any that have changed.
+    """
+    
+    cacheRef = self._cachedConf
+    if self._isConfChangedEnabled or not cacheRef: return
+    elif time.time() - self._lastConfCheck < CONFIG["queries.torConf.pollRate"]: return
+    
+    self._lastConfCheck = time.time()
+    
+    # options fetched via special commands can't be batched, so just drop them
+    checkedParams, changedParams = set(), []
+    for param, fetchType in cacheRef.keys():
+      if fetchType == "map": changedParams.append(param)
+      else: checkedParams.add(param)
+    
+    if checkedParams:
+      try:
+        confVals = self._queueConnCall(False, "get_option", list(checkedParams)).getResult()
+        if confVals == None: raise TorCtl.TorCtlClosed
+        
+        currentValues = dict([(param.lower(), []) for param in checkedParams])
+        for key, value in confVals:
+          if key.lower() in currentValues and value != None:
+            currentValues[key.lower()].append(value)
+        
+        for param in checkedParams:
+          values = currentValues[param.lower()]
+          cachedStr = cacheRef.get((param, "str"))
+          cachedList = cacheRef.get((param, "list"))
+          
+          if (cachedStr != None and (not values or cachedStr != values[0])) or \
+             (cachedList != None and list(cachedList) != values):
+            changedParams.append(param)
+      except (socket.error, TorCtl.ErrorReply, TorCtl.TorCtlClosed), exc:
+        if type(exc) == TorCtl.TorCtlClosed: self.close()
+        changedParams += list(checkedParams)
+    
+    if changedParams: self._evictConf(changedParams)
+  
+  def _getConsensusIndex(self):
+    """
+    Provides the current consensus index, loading it if this is the first
+    time it's been requested since attaching to tor. If the consensus can't be
+    fetched then this provides an empty index (retrying on the next call).
+    """
+    
+    indexRef = self._consensusIndex
+    if indexRef: return indexRef
+    
+    self._consensusLock.acquire()
+    
+    # checks that it wasn't loaded while we were waiting
+    indexRef = self._consensusIndex
+    if not indexRef:
+      startTime = time.time()
+      
+      # Reads tor's cached-consensus file if we can, falling back to GETINFO
+      # ns/all (which pulls the whole document over the control port) if it's
+      # unavailable, for instance if we're attached to a remote tor instance or
+      # lack permissions to its data directory.
+      source, consensusFile = "cached-consensus", None
+      dataDir = self.getOption("DataDirectory")
+      
+      if dataDir:
+        consensusPath = os.path.join(self.getPathPrefix() + dataDir, "cached-consensus")
+        
+        try: consensusFile = open(consensusPath, "r")
+        except IOError, exc:
+          msg = "Unable to read tor's cached consensus, querying it from the control port instead (%s)" % sysTools.getFileErrorMsg(exc)
+          log.log(CONFIG["log.torConsensusFileUnreadable"], msg)
+      
+      if consensusFile:
+        try: self._updateConsensusIndex(parseNetworkStatus(consensusFile), True)
+        except IOError: pass
+        consensusFile.close()
+      
+      if not self._consensusIndex or not self._consensusIndex[0]:
+        source = "GETINFO ns/all"
+        nsContent = self.getInfo("ns/all")
+        if nsContent: self._updateConsensusIndex(parseNetworkStatus(nsContent.split("\n")), True)
+      
+      indexRef = self._consensusIndex
+      
+      if indexRef and indexRef[0]:
+        msg = "loaded consensus with %i relays from %s (runtime: %0.3f)" % (len(indexRef[0]), source, time.time() - startTime)
+        log.log(CONFIG["log.torConsensusLoaded"], msg)
+      else:
+        self._consensusIndex = None
+        indexRef = ({}, {}, {})
+    
+    self._consensusLock.release()
+    return indexRef
+  
+  def _updateConsensusIndex(self, records, isFullConsensus):
+    """
+    Revises the consensus index with the given relay records. If this is the
+    full consensus then it replaces the index, otherwise only the listed relays
+    are replaced. Partial updates are ignored if the index hasn't been loaded
+    yet.
+    
+    Arguments:
+      records         - iterable of relay records
+      isFullConsensus - replaces the index if true, otherwise updates it
+    """
+    
+    self._consensusLock.acquire()
+    
+    if isFullConsensus: byFingerprint, byAddress, byEndpoint = {}, {}, {}
+    elif self._consensusIndex:
+      byFingerprint, byAddress, byEndpoint = [dict(index) for index in self._consensusIndex]
+    else:
+      self._consensusLock.release()
+      return
+    
+    for record in records:
+      # drops the relay's prior record from the address indices
+      oldRecord = byFingerprint.get(record[RELAY_FINGERPRINT])
+      if oldRecord:
+        oldAddress = oldRecord[RELAY_ADDRESS]
+        byAddress[oldAddress] = tuple([entry for entry in byAddress.get(oldAddress, ()) if entry != oldRecord])
+        if not byAddress[oldAddress]: del byAddress[oldAddress]
+        
+        oldEndpoint = (oldAddress, oldRecord[RELAY_OR_PORT])
+        if byEndpoint.get(oldEndpoint) == oldRecord: del byEndpoint[oldEndpoint]
+      
+      byFingerprint[record[RELAY_FINGERPRINT]] = record
+      byAddress[record[RELAY_ADDRESS]] = byAddress.get(record[RELAY_ADDRESS], ()) + (record,)
+      byEndpoint[(record[RELAY_ADDRESS], record[RELAY_OR_PORT])] = record
+    
+    self._consensusIndex = (byFingerprint, byAddress, byEndpoint)
+    self._consensusLock.release()
+  
+  def _getRelayDocument(self, queryType, fingerprint, default, isParsed = False):
+    """
+    Provides a relay's ns/id/* or desc/id/* document, using the descriptor
+    cache if it's available.
+    
+    Arguments:
+      queryType   - "ns" or "desc"
+      fingerprint - relay fingerprint to be looked up
+      default     - result if the query fails
+      isParsed    - provides a mapping of keywords to their (first) values if
+                    true, the raw document otherwise
+    """
+    
+    key = (queryType, fingerprint)
+    
+    self._descCacheLock.acquire()
+    cacheEntry = self._descCache.get(key)
+    if cacheEntry: cacheEntry[2] = DESC_CACHE_COUNTER.next()
+    invalidationCount = self._descInvalidations
+    self._descCacheLock.release()
+    
+    if not cacheEntry:
+      document = self.getInfo("%s/id/%s" % key)
+      if not document: return default
+      cacheEntry = self._cacheRelayDocument(key, document, None, invalidationCount)
+    
+    if isParsed:
+      # parsed lazily since most callers only want the raw document (races
+      # are harmless since both threads would produce the same mapping)
+      if cacheEntry[1] == None: cacheEntry[1] = _parseDescriptor(cacheEntry[0])
+      return cacheEntry[1]
+    else: return cacheEntry[0]
+  
+  def _cacheRelayDocument(self, key, document, parsed, invalidationCount):
+    """
+    Adds a document to the descriptor cache, trimming the least recently used
+    entries if it's grown too large. This is skipped if entries were
+    invalidated since we started fetching it (since it might be stale).
+    Provides the cache entry.
+    
+    Arguments:
+      key               - (queryType, fingerprint) tuple for the document
+      document          - raw ns or desc content
+      parsed            - parsed fields of the document, None if not yet parsed
+      invalidationCount - invalidation count from before the document was fetched
+    """
+    
+    cacheEntry = [document, parsed, DESC_CACHE_COUNTER.next()]
+    
+    self._descCacheLock.acquire()
+    
+    if invalidationCount == self._descInvalidations:
+      self._descCache[key] = cacheEntry
+      
+      cacheSize = CONFIG["cache.descriptors.size"]
+      if len(self._descCache) > cacheSize:
+        # keeps only the most recently used entries
+        newCacheSize = max(1, cacheSize - CONFIG["cache.descriptors.trimSize"])
+        lastUsed = sorted([entry[2] for entry in self._descCache.values()])
+        threshold = lastUsed[-newCacheSize]
+        
+        for entryKey, entry in self._descCache.items():
+          if entry[2] < threshold: del self._descCache[entryKey]
+        
+        for nickname, fingerprint in self._descNicknames.items():
+          if not ("desc", fingerprint) in self._descCache: del self._descNicknames[nickname]
+    
+    self._descCacheLock.release()
+    return cacheEntry
+  
+  def _invalidateRelayDocuments(self, queryType, fingerprints = None):
+    """
+    Drops cached documents of the given type.
+    
+    Arguments:
+      queryType    - "ns" or "desc"
+      fingerprints - relays whose documents have changed, all of them if None
+    """
+    
+    self._descCacheLock.acquire()
+    self._descInvalidations += 1
+    
+    if fingerprints == None:
+      for key in self._descCache.keys():
+        if key[0] == queryType: del self._descCache[key]
+    else:
+      for fingerprint in fingerprints:
+        if (queryType, fingerprint) in self._descCache: del self._descCache[(queryType, fingerprint)]
+    
+    if queryType == "desc":
+      for nickname, fingerprint in self._descNicknames.items():
+        if not ("desc", fingerprint) in self._descCache: del self._descNicknames[nickname]
+    
+    self._descCacheLock.release()
+  
   def _getRelayAttr(self, key, default, cacheUndefined = True):
     """
     Provides information associated with this relay, using the cached value if
@@ -970,7 +2499,9 @@ class Controller(TorCtl.PostEventListener):
       if currentVal == UNKNOWN: return default
       else: return currentVal
     
-    self.connLock.acquire()
+    # the lookups below lock the connection as needed, this just prevents
+    # concurrent calls from making the same queries
+    self._relayAttrLock.acquire()
     
     currentVal, result = self._cachedParam[key], None
     if not currentVal and self.isAlive():
@@ -1042,7 +2573,7 @@ class Controller(TorCtl.PostEventListener):
             # Output should be something like:
             #    JID  IP Address      Hostname      Path
             #      1  10.0.0.2        tor-jail      /usr/jails/tor-jail
-            jlsOutput = sysTools.call("jls -j %s" % jid)
+            jlsOutput = sysTools.call("jls -j %s" % jid, priority = sysTools.PRIORITY_INTERACTIVE)
             
             if len(jlsOutput) == 2 and len(jlsOutput[1].split()) == 4:
               prefixPath = jlsOutput[1].split()[3]
@@ -1065,11 +2596,11 @@ class Controller(TorCtl.PostEventListener):
         result = prefixPath
       
       # cache value
-      if result: self._cachedParam[key] = result
-      elif cacheUndefined: self._cachedParam[key] = UNKNOWN
+      if result: self._updateParamCache({key: result})
+      elif cacheUndefined: self._updateParamCache({key: UNKNOWN})
     elif currentVal == UNKNOWN: result = currentVal
     
-    self.connLock.release()
+    self._relayAttrLock.release()
     
     if result: return result
     else: return default
@@ -1083,9 +2614,12 @@ class Controller(TorCtl.PostEventListener):
       eventType - enum representing tor's new status
     """
     
-    # resets cached GETINFO and GETCONF parameters
-    self._cachedParam = dict([(arg, "") for arg in CACHE_ARGS])
-    self._cachedConf = {}
+    # resets cached GETINFO parameters and the consensus index (version
+    # dependent values are kept, and revalidated when reattaching). Config
+    # values are only dropped if tor's closed, since they're otherwise kept
+    # current via CONF_CHANGED events or polling.
+    self._resetCaches(True, eventType != TOR_CLOSED)
+    self._consensusIndex = None
     
     # gives a notice that the control port has closed
     if eventType == TOR_CLOSED:
@@ -1094,3 +2628,230 @@ class Controller(TorCtl.PostEventListener):
     for callback in self.statusListeners:
       callback(self, eventType)
 
+def _getRelayRecord(nsEntry):
+  """
+  Converts a TorCtl NetworkStatus instance into a relay record.
+  
+  Arguments:
+    nsEntry - TorCtl NetworkStatus to be converted
+  """
+  
+  flags = tuple(nsEntry.flags) if nsEntry.flags else ()
+  return (nsEntry.idhex, nsEntry.nickname, nsEntry.ip, int(nsEntry.orport), flags, nsEntry.bandwidth or 0)
+
+def _isBulkQuery(param):
+  """
+  True if the GETINFO option is expected to have a large response (matching
+  BULK_QUERIES), false otherwise.
+  
+  Arguments:
+    param - GETINFO option
+  """
+  
+  for bulkQuery in BULK_QUERIES:
+    if param.startswith(bulkQuery): return True
+  
+  return False
+
+def _getCommandTraffic(method, args, response, isSuccessful):
+  """
+  Provides a tuple of the form (command type, bytes sent, bytes received) for a
+  call to TorCtl. Tor's raw replies aren't available so the sizes are
+  estimated from the command and parsed response, and the received bytes are
+  zero if the call failed.
+  
+  Arguments:
+    method       - name of the TorCtl method that was called
+    args         - arguments of the call
+    response     - value returned by the call
+    isSuccessful - false if the call raised an exception
+  """
+  
+  command = COMMAND_LABELS.get(method, method)
+  
+  if method in ("get_info", "get_option"):
+    params = args[0]
+    if isinstance(params, str): params = [params]
+    sentBytes = len("%s %s\r\n" % (command, " ".join(params)))
+    
+    if method == "get_info":
+      # keys are grouped by their family if all are the same type
+      families = set([_getQueryFamily(param) for param in params])
+      if len(families) == 1: label = "%s %s" % (command, families.pop())
+      else: label = "%s (multiple)" % command
+    else: label = command
+  else:
+    label = command
+    
+    if method == "set_option": sentArgs = "%s=%s" % args
+    elif method == "set_options": sentArgs = " ".join(["%s=%s" % entry for entry in args[0]])
+    elif method == "set_events": sentArgs = " ".join(args[0])
+    else: sentArgs = " ".join([str(arg) for arg in args])
+    
+    sentBytes = len("%s %s\r\n" % (command, sentArgs))
+  
+  receivedBytes = 0
+  if isSuccessful:
+    # GETINFO responses are mappings and GETCONF a list of key/value tuples
+    if method == "get_info" and isinstance(response, dict): entries = response.items()
+    elif method == "get_option" and isinstance(response, list): entries = response
+    else: entries = []
+    
+    # replies are lines like "250-key=value", or "250+key=" followed by the
+    # value and a terminating period if it's multi-line
+    for key, value in entries:
+      value = str(value)
+      if "\n" in value: receivedBytes += len("250+%s=\r\n%s\r\n.\r\n" % (key, value))
+      else: receivedBytes += len("250-%s=%s\r\n" % (key, value))
+    
+    receivedBytes += len("250 OK\r\n")
+  
+  return (label, sentBytes, receivedBytes)
+
+def _getQueryFamily(param):
+  """
+  Provides the key used to group GETINFO queries, this being the query itself
+  unless it's a PARAMETERIZED_QUERIES entry (for instance, "ns/id/*").
+  
+  Arguments:
+    param - GETINFO key that was queried
+  """
+  
+  for prefix in PARAMETERIZED_QUERIES:
+    if param.startswith(prefix): return prefix + "*"
+  
+  return param
+
+def _getPercentiles(samples):
+  """
+  Provides a (median, 90th percentile, 99th percentile, max) tuple for the
+  given values, these all being zero if there aren't any.
+  
+  Arguments:
+    samples - list of numeric values
+  """
+  
+  if not samples: return (0, 0, 0, 0)
+  
+  sortedSamples = sorted(samples)
+  lastIndex = len(sortedSamples) - 1
+  return tuple([sortedSamples[int(round(lastIndex * percentile))] for percentile in (0.5, 0.9, 0.99)] + [sortedSamples[-1]])
+
+def _mergeEvents(pendingEvent, event):
+  """
+  Provides an event reflecting both a pending event and a more recent one of
+  the same type. This is the newer event, except that the relays reported by
+  NEWDESC and NS events are combined. Events are shared between listeners so
+  this is done on a copy.
+  
+  Arguments:
+    pendingEvent - unprocessed event
+    event        - newly arrived event of the same type
+  """
+  
+  eventType = getattr(event, "event_name", None)
+  
+  if eventType == "NEWDESC":
+    mergedEvent = copy.copy(event)
+    mergedEvent.idlist = list(pendingEvent.idlist) + [entry for entry in event.idlist if not entry in pendingEvent.idlist]
+    return mergedEvent
+  elif eventType == "NS":
+    mergedEvent = copy.copy(event)
+    mergedEvent.nslist = list(pendingEvent.nslist) + list(event.nslist)
+    return mergedEvent
+  else: return event
+
+def _parseDescriptor(document):
+  """
+  Provides a mapping of keywords to the value of their first line in the given
+  ns or desc document, dropping any "opt" prefix.
+  
+  Arguments:
+    document - raw document to be parsed
+  """
+  
+  fields = {}
+  
+  for line in document.split("\n"):
+    if line.startswith("opt "): line = line[4:]
+    
+    divIndex = line.find(" ")
+    if divIndex == -1: keyword, value = line, ""
+    else: keyword, value = line[:divIndex], line[divIndex + 1:]
+    
+    if keyword and not keyword in fields: fields[keyword] = value
+  
+  return fields
+
+def _getPidViaProc(controlPort):
+  """
+  Scans proc for tor processes, providing the pid of the one that owns the
+  socket listening on the control port. If the owner can't be determined (for
+  instance, due to insufficient permissions) then this only provides a pid if
+  there's a single tor process. This provides None if proc is unavailable or
+  the pid can't be determined.
+  
+  Arguments:
+    controlPort - control port of the tor process if multiple exist
+  """
+  
+  if not os.path.exists("/proc/net/tcp"): return None
+  
+  # inodes for sockets listening on the control port (entries are of the form
+  # "sl local_address rem_address st ... inode", with hex addresses/ports and
+  # a state of 0A for listening sockets)
+  socketInodes = set()
+  
+  for tcpPath in ("/proc/net/tcp", "/proc/net/tcp6"):
+    try:
+      tcpFile = open(tcpPath, "r")
+      tcpFile.readline() # skips the header
+      
+      for line in tcpFile:
+        comp = line.split()
+        if len(comp) < 10 or comp[3] != "0A": continue
+        
+        if int(comp[1].split(":")[-1], 16) == controlPort:
+          socketInodes.add("socket:[%s]" % comp[9])
+      
+      tcpFile.close()
+    except (IOError, ValueError): pass
+  
+  # tor processes, checking their name via comm (falling back to cmdline for
+  # older kernels)
+  torPids = []
+  
+  try: procEntries = os.listdir("/proc")
+  except OSError: return None
+  
+  for procEntry in procEntries:
+    if not procEntry.isdigit(): continue
+    
+    try:
+      commFile = open("/proc/%s/comm" % procEntry, "r")
+      processName = commFile.readline().strip()
+      commFile.close()
+    except IOError:
+      try:
+        cmdlineFile = open("/proc/%s/cmdline" % procEntry, "r")
+        processName = os.path.basename(cmdlineFile.read().split("\0")[0])
+        cmdlineFile.close()
+      except IOError: continue # process has exited
+    
+    if processName == "tor": torPids.append(procEntry)
+  
+  if not torPids: return None
+  
+  if socketInodes:
+    for pid in torPids:
+      fdDir = "/proc/%s/fd" % pid
+      
+      try:
+        for fd in os.listdir(fdDir):
+          try:
+            if os.readlink(os.path.join(fdDir, fd)) in socketInodes: return pid
+          except OSError: pass # descriptor was closed
+      except OSError: pass # insufficient permissions or the process has exited
+  
+  if len(torPids) == 1: return torPids[0]
+  else: return None